@@ -0,0 +1,71 @@
+"""Benchmarks for django-address.
+
+The benchmark modules follow asv's conventions (`setup`, `teardown` and `time_*` methods on
+plain classes), so they can be run by asv, or without it by `python -m benchmarks.run`.
+They configure a standalone Django project on a SQLite file rather than using example_site, so
+the database can be kept between runs.
+
+The synthetic dataset is chosen by `DJ_ADDRESS_BENCH_DATASET`, one of `DATASETS` ('1m' by
+default), each kept in its own database file; `DJ_ADDRESS_BENCH_ROWS` and `DJ_ADDRESS_BENCH_DB`
+override its size and where it lives. Nothing needs the network: geocoding is timed against
+`dj_address.testing.StubGeocodeServer`.
+"""
+import os
+
+import django
+from django.conf import settings
+
+
+DATASETS = {
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+
+def dataset():
+    """The name of the dataset to benchmark against."""
+    name = os.environ.get('DJ_ADDRESS_BENCH_DATASET', '1m')
+    if name not in DATASETS:
+        raise ValueError('Unknown benchmark dataset %r, expected one of %s.' % (name, ', '.join(DATASETS)))
+    return name
+
+
+def dataset_rows():
+    return int(os.environ.get('DJ_ADDRESS_BENCH_ROWS', DATASETS[dataset()]))
+
+
+def default_db():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench-%s.sqlite3' % dataset())
+
+
+def setup_django(db=None):
+    if settings.configured:
+        return
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': db or os.environ.get('DJ_ADDRESS_BENCH_DB') or default_db(),
+            },
+        },
+        INSTALLED_APPS=['dj_address'],
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        GOOGLE_API_KEY='benchmark',
+        DJ_ADDRESS_HIERARCHY_CACHE_SIZE=0,
+        DJ_ADDRESS_SUBPREMISE_GEOCODE_RETRY_WITH_REPLACE=False,
+        DJ_ADDRESS_SUBPREMISE_REPLACE_ONLY=True,
+        DJ_ADDRESS_IGNORE_MISSING_SUBPREMISE=True,
+        # Time the geocoding itself, not the cache.
+        DJ_ADDRESS_GEOCODE_CACHE_SIZE=0,
+        DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None,
+    )
+    django.setup()
+
+
+def migrate(target='dj_address'):
+    """Migrate the benchmark database, e.g. to `('dj_address', '0003_auto_20190222_2348')`
+    to time lookups without the indexes from 0005."""
+    from django.core.management import call_command
+    args = ['dj_address'] if target == 'dj_address' else list(target)
+    call_command('migrate', *args, verbosity=0)
@@ -0,0 +1,65 @@
+"""Compare two sets of results saved by `python -m benchmarks.run --json`.
+
+    python -m benchmarks.compare BASELINE.json RESULTS.json [--threshold 1.2]
+
+Prints each benchmark's median time in both, their ratio, and any change in its query count.
+A benchmark has regressed if it's slower by more than `--threshold` times, or makes more
+queries; the exit status is 1 if any has.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        return {(r['dataset'], r['benchmark']): r for r in json.load(f)['results']}
+
+
+def compare(baseline, results, threshold):
+    """Return the report's rows, as `(dataset, benchmark, before, after, ratio, queries, note)`,
+    and whether anything regressed."""
+    rows = []
+    regressed = False
+    for key in sorted(set(baseline) | set(results)):
+        before, after = baseline.get(key), results.get(key)
+        if before is None or after is None:
+            rows.append(key + (before and before['median_ms'], after and after['median_ms'], None, '',
+                               'removed' if after is None else 'new'))
+            continue
+        ratio = after['median_ms'] / before['median_ms'] if before['median_ms'] else None
+        queries = str(after['queries'])
+        if after['queries'] != before['queries']:
+            queries = '%d -> %d' % (before['queries'], after['queries'])
+        note = ''
+        if ratio is not None and ratio > threshold or after['queries'] > before['queries']:
+            note = 'REGRESSED'
+            regressed = True
+        elif ratio is not None and ratio < 1 / threshold or after['queries'] < before['queries']:
+            note = 'improved'
+        rows.append(key + (before['median_ms'], after['median_ms'], ratio, queries, note))
+    return rows, regressed
+
+
+def _ms(value):
+    return '%10.3f' % value if value is not None else '%10s' % '-'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('results')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    options = parser.parse_args(argv)
+
+    rows, regressed = compare(load(options.baseline), load(options.results), options.threshold)
+    print('%-5s %-50s %10s %10s %7s  %-10s' % ('', 'benchmark', 'before ms', 'after ms', 'ratio', 'queries'))
+    for dataset, benchmark, before, after, ratio, queries, note in rows:
+        print('%-5s %-50s %s %s %7s  %-10s %s' % (
+            dataset, benchmark, _ms(before), _ms(after), '%.2f' % ratio if ratio is not None else '-', queries, note,
+        ))
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
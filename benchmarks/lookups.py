@@ -0,0 +1,96 @@
+"""Time the lookups `_to_python` and the admin make against a large address table.
+
+The table is built once and kept in the benchmark database: as many addresses as the dataset
+has (see `benchmarks.DATASETS`) spread over a thousand localities, a tenth of them raw-only. The
+rest are spread over a grid of coordinates about 100km across.
+"""
+from . import dataset_rows, migrate, setup_django
+
+
+LOCALITIES = 1000
+CHUNK_SIZE = 10000
+
+
+def populate(rows=None):
+    from django.db import connection, transaction
+    from dj_address.models import Address, Country, Locality, State
+
+    rows = dataset_rows() if rows is None else rows
+    if Address.objects.count() >= rows and Address.objects.exclude(geohash='').exists():
+        return
+    Address.objects.all().delete()
+    Country.objects.all().delete()
+    with transaction.atomic():
+        country = Country.objects.create(name='Australia', code='AU')
+        state = State.objects.create(name='Victoria', code='VIC', country=country)
+        Locality.objects.bulk_create(
+            Locality(name='Locality %d' % i, postal_code='%04d' % i, state=state) for i in range(LOCALITIES)
+        )
+    locality_ids = list(Locality.objects.values_list('pk', flat=True))
+    for start in range(0, rows, CHUNK_SIZE):
+        objs = []
+        for i in range(start, min(start + CHUNK_SIZE, rows)):
+            if i % 10 == 0:
+                objs.append(Address(raw='%d Unknown Lane' % i))
+            else:
+                objs.append(Address(
+                    street_number=str(i % 500),
+                    route='Street %d' % (i // 500),
+                    locality_id=locality_ids[i % LOCALITIES],
+                    raw='%d Street %d' % (i % 500, i // 500),
+                    latitude=-38.2 + (i % 1000) * 0.001,
+                    longitude=144.5 + (i // 1000 % 1000) * 0.001,
+                ))
+        for obj in objs:
+            obj.set_fingerprint()
+            obj.set_geohash()
+        with transaction.atomic():
+            Address.objects.bulk_create(objs)
+    # Give the query planner statistics for the new table, as a bulk load in production would.
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+class AddressLookups:
+    timeout = 3600
+    # Dropped by `python -m benchmarks.run --without-indexes`.
+    indexes = [
+        ('dj_address.Address', 'dj_address_raw_prefix_idx'),
+        ('dj_address.Address', 'dj_address_unidentified_idx'),
+        ('dj_address.Locality', 'dj_address_postal_code_idx'),
+    ]
+
+    def setup(self):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address, Locality, _fetch_raw
+        self.Address = Address
+        self.Locality = Locality
+        self.fetch_raw = _fetch_raw
+        sample = Address.objects.filter(locality__isnull=False).order_by('-pk').first()
+        self.components = {
+            'street_number': sample.street_number,
+            'route': sample.route,
+            'subpremise': sample.subpremise,
+            'locality': sample.locality_id,
+        }
+        self.raw = Address.objects.filter(locality=None).order_by('-pk').values_list('raw', flat=True)[0]
+        self.postal_code = Locality.objects.order_by('-pk').values_list('postal_code', flat=True)[0]
+
+    def time_components_lookup(self):
+        self.Address.objects.filter(**self.components).first()
+
+    def time_raw_lookup(self):
+        # The lookup for raw-only rows saved before fingerprints were added.
+        self.fetch_raw(self.Address.objects.all(), [self.raw])
+
+    def time_postal_code_lookup(self):
+        list(self.Locality.objects.filter(postal_code=self.postal_code))
+
+    def time_unidentified_count(self):
+        self.Address.objects.filter(locality=None).count()
+
+    def time_unidentified_page(self):
+        # The admin's "unidentified" filter: the first page of raw-only addresses.
+        list(self.Address.objects.filter(locality=None).order_by('raw')[:100])
@@ -0,0 +1,102 @@
+"""Time resolving values to addresses, and formatting and rendering them, against the table
+built by `lookups.populate`.
+
+Benchmarks that would write roll their transaction back, so every run starts from the same
+table.
+"""
+from . import migrate, setup_django
+from .lookups import populate
+
+
+class _RolledBack(Exception):
+    pass
+
+
+def rolled_back(func, *args):
+    """Call `func` in a transaction that is then rolled back."""
+    from django.db import transaction
+    try:
+        with transaction.atomic():
+            func(*args)
+            raise _RolledBack
+    except _RolledBack:
+        pass
+
+
+def _value(address):
+    return dict(address.as_dict(), raw='%s %s' % (address.street_number, address.route))
+
+
+class ToPython:
+    timeout = 3600
+
+    def setup(self):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address, to_python
+        self.to_python = to_python
+        sample = Address.objects.with_components().filter(locality__isnull=False).order_by('-pk').first()
+        self.existing = _value(sample)
+        self.new = dict(self.existing, street_number='999999')
+        self.raw = Address.objects.filter(locality=None).order_by('-pk').values_list('raw', flat=True)[0]
+
+    def time_existing(self):
+        self.to_python(self.existing)
+
+    def time_new(self):
+        rolled_back(self.to_python, self.new)
+
+    def time_raw(self):
+        self.to_python(self.raw)
+
+
+class BulkToPython:
+    timeout = 3600
+    params = [100, 1000]
+    param_names = ['values']
+
+    def setup(self, values=100):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address, bulk_to_python
+        self.bulk_to_python = bulk_to_python
+        samples = Address.objects.with_components().filter(locality__isnull=False).order_by('-pk')[:values]
+        # Half the values match existing addresses, half are new.
+        self.values = [
+            dict(_value(address), street_number=address.street_number + ('x' if i % 2 else ''))
+            for i, address in enumerate(samples)
+        ]
+
+    def time_bulk_to_python(self, values=100):
+        rolled_back(self.bulk_to_python, self.values)
+
+
+class Rendering:
+    timeout = 3600
+
+    def setup(self):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address
+        from dj_address.widgets import AddressWidget
+        self.addresses = list(Address.objects.with_components().filter(locality__isnull=False)[:100])
+        self.pk = self.addresses[0].pk
+        self.widget = AddressWidget()
+
+    def time_str(self):
+        for address in self.addresses:
+            str(address)
+
+    def time_as_dict(self):
+        for address in self.addresses:
+            address.as_dict()
+
+    def time_widget_render(self):
+        for address in self.addresses:
+            self.widget.render('address', address)
+
+    def time_widget_render_pk(self):
+        self.widget.render('address', self.pk)
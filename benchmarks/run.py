@@ -0,0 +1,155 @@
+"""Run the benchmarks without asv.
+
+    python -m benchmarks.run [--dataset NAME ...] [--repeat N] [--without-indexes]
+                             [--filter TEXT] [--json PATH]
+
+Each benchmark is timed `--repeat` times, and run once more to count the queries it makes.
+`--dataset` can be given more than once, or as `all`; each dataset is run in its own process,
+as Django is configured for one database per process. `--json` saves the results for
+`python -m benchmarks.compare`.
+
+`--without-indexes` drops the indexes each benchmark lists in `indexes` while it runs, for
+comparison, and restores them afterwards.
+"""
+import argparse
+import inspect
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from . import DATASETS, dataset, geocoding, lookups, resolution, setup_django, spatial
+
+
+MODULES = [lookups, spatial, resolution, geocoding]
+
+
+def benchmarks():
+    for module in MODULES:
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            names = [name for name in dir(cls) if name.startswith('time_')]
+            if names:
+                yield cls, names
+
+
+def drop_indexes(bench):
+    from django.apps import apps
+    from django.db import connection
+
+    dropped = []
+    with connection.schema_editor() as editor:
+        for label, name in getattr(bench, 'indexes', []):
+            model = apps.get_model(label)
+            index = next(index for index in model._meta.indexes if index.name == name)
+            editor.remove_index(model, index)
+            dropped.append((model, index))
+    return dropped
+
+
+def restore_indexes(dropped):
+    from django.db import connection
+
+    with connection.schema_editor() as editor:
+        for model, index in dropped:
+            editor.add_index(model, index)
+
+
+def count_queries(func):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries)
+
+
+def run(options):
+    """Run the benchmarks against the current dataset, printing and returning the results."""
+    setup_django()
+    results = []
+    for cls, names in benchmarks():
+        for params in getattr(cls, 'params', [None]):
+            bench_args = () if params is None else (params,)
+            label = cls.__name__ if params is None else '%s(%s)' % (cls.__name__, params)
+            names_to_run = [name for name in names if options.filter in '%s.%s' % (label, name)]
+            if not names_to_run:
+                continue
+            bench = cls()
+            bench.setup(*bench_args)
+            dropped = drop_indexes(bench) if options.without_indexes else []
+            try:
+                for name in names_to_run:
+                    method = getattr(bench, name)
+                    times = timeit.repeat(lambda: method(*bench_args), number=1, repeat=options.repeat)
+                    result = {
+                        'dataset': dataset(),
+                        'benchmark': '%s.%s' % (label, name),
+                        'median_ms': statistics.median(times) * 1000,
+                        'min_ms': min(times) * 1000,
+                        'queries': count_queries(lambda: method(*bench_args)),
+                    }
+                    print('%-5s %-50s median %8.3f ms   min %8.3f ms   %4d queries' % (
+                        result['dataset'], result['benchmark'], result['median_ms'], result['min_ms'],
+                        result['queries'],
+                    ))
+                    sys.stdout.flush()
+                    results.append(result)
+            finally:
+                restore_indexes(dropped)
+            if hasattr(bench, 'teardown'):
+                bench.teardown(*bench_args)
+    return results
+
+
+def run_datasets(names, argv):
+    """Run each dataset in a child process, collecting their results."""
+    results = []
+    for name in names:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            env = dict(os.environ, DJ_ADDRESS_BENCH_DATASET=name)
+            subprocess.run([sys.executable, '-m', 'benchmarks.run', '--json', path] + argv, env=env, check=True)
+            with open(path) as f:
+                results.extend(json.load(f)['results'])
+        finally:
+            os.remove(path)
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dataset', action='append', choices=list(DATASETS) + ['all'])
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--without-indexes', action='store_true')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose names contain this.')
+    parser.add_argument('--json', help='Save the results to this file.')
+    options = parser.parse_args(argv)
+
+    names = options.dataset or []
+    if 'all' in names:
+        names = list(DATASETS)
+    if len(names) > 1:
+        # Pass on everything but the datasets and output file.
+        child_argv = ['--repeat', str(options.repeat), '--filter', options.filter]
+        if options.without_indexes:
+            child_argv.append('--without-indexes')
+        results = run_datasets(names, child_argv)
+    else:
+        if names:
+            os.environ['DJ_ADDRESS_BENCH_DATASET'] = names[0]
+        results = run(options)
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'without_indexes': options.without_indexes, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
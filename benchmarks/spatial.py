@@ -0,0 +1,44 @@
+"""Time spatial queries against the table built by `lookups.populate`."""
+from . import migrate, setup_django
+from .lookups import populate
+
+
+class AddressNear:
+    timeout = 3600
+    indexes = [('dj_address.Address', 'dj_address_lat_lng_idx')]
+    params = [1, 10]
+    param_names = ['radius_km']
+
+    def setup(self, radius_km=1):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address
+        self.Address = Address
+
+    def time_near(self, radius_km=1):
+        list(self.Address.objects.near(-37.8, 144.9, radius_km)[:100])
+
+    def time_within_bbox(self, radius_km=1):
+        delta = radius_km / 111.0
+        self.Address.objects.within_bbox(-37.8 - delta, 144.9 - delta, -37.8 + delta, 144.9 + delta).count()
+
+
+class AddressGeohash:
+    timeout = 3600
+    params = [4, 6]
+    param_names = ['precision']
+
+    def setup(self, precision=4):
+        setup_django()
+        migrate()
+        populate()
+        from dj_address.models import Address
+        self.Address = Address
+        self.prefix = Address.objects.exclude(geohash='').values_list('geohash', flat=True)[0][:precision]
+
+    def time_in_geohash(self, precision=4):
+        self.Address.objects.in_geohash(self.prefix).count()
+
+    def time_count_by_geohash(self, precision=4):
+        list(self.Address.objects.count_by_geohash(precision))
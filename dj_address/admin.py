@@ -23,14 +23,24 @@ class CountryAdmin(admin.ModelAdmin):
 @admin.register(State)
 class StateAdmin(admin.ModelAdmin):
     search_fields = ('name', 'code')
+    list_select_related = ('country',)
 
 
 @admin.register(Locality)
 class LocalityAdmin(admin.ModelAdmin):
     search_fields = ('name', 'postal_code')
+    list_select_related = ('state__country',)
 
 
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
     search_fields = ('name',)
-    list_filter = (UnidentifiedListFilter,)
+    list_filter = (UnidentifiedListFilter, 'needs_geocode')
+    list_select_related = ('locality__state__country',)
+
+
+@admin.register(GeocodeJob)
+class GeocodeJobAdmin(admin.ModelAdmin):
+    list_display = ('address', 'created', 'claimed_at', 'attempts', 'last_error')
+    list_select_related = ('address',)
+    raw_id_fields = ('address',)
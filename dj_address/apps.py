@@ -5,3 +5,6 @@ class AddressConfig(AppConfig):
     name = 'dj_address'
     label = 'dj_address'
     verbose_name = 'Django Address'
+
+    def ready(self):
+        from . import signals  # noqa: F401
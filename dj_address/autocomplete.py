@@ -0,0 +1,279 @@
+"""Searching stored addresses and localities by prefix, for the autocomplete view.
+
+Where the database can index the search it does it:
+
+- on SQLite, with an FTS5 table over `Address.formatted` kept up to date by triggers;
+- on PostgreSQL, with trigram indexes on `Address.formatted` and `Locality.name`, which
+  `icontains` lookups use.
+
+Both are created by migration 0009 when the database supports them (and the SQLite triggers
+again by 0013, after 0010 rebuilt the table). Otherwise, or with
+`DJ_ADDRESS_AUTOCOMPLETE_BACKEND = 'memory'`, searches use an in-process prefix index of the
+localities and addresses, rebuilt every `DJ_ADDRESS_AUTOCOMPLETE_INDEX_TTL` seconds.
+
+Every process holds its own copy of that index, at roughly 1.3KB per address, so it only takes
+the newest `DJ_ADDRESS_AUTOCOMPLETE_INDEX_MAX_ITEMS` (100,000 by default, around 130MB). Larger
+tables need one of the database indexes to be searched in full.
+"""
+import bisect
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+
+from .models import Address, Locality
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['search', 'reset_autocomplete_index']
+
+
+FTS_TABLE = 'dj_address_address_fts'
+TRIGRAM_INDEX = 'dj_address_formatted_trgm'
+
+
+def normalize_words(text):
+    return re.findall(r'\w+', text.casefold()) if text else []
+
+
+class PrefixIndex:
+    """An in-memory index of words to the items containing them.
+
+    Rather than a trie of nodes, which costs a dict per character, it's a sorted list of
+    `(word, item)` pairs: the words starting with a prefix are a contiguous run found by
+    bisection, which is as fast to search and a fraction of the size.
+    """
+
+    def __init__(self, items):
+        """`items` is an iterable of `(item, text)` pairs."""
+        self.items = []
+        self.words = []
+        entries = []
+        for item, text in items:
+            words = set(normalize_words(text))
+            if not words:
+                continue
+            i = len(self.items)
+            self.items.append(item)
+            self.words.append(words)
+            entries.extend((word, i) for word in words)
+        entries.sort()
+        self.keys = [word for word, _ in entries]
+        self.values = [i for _, i in entries]
+
+    def __len__(self):
+        return len(self.items)
+
+    def _starting_with(self, prefix):
+        start = bisect.bisect_left(self.keys, prefix)
+        for pos in range(start, len(self.keys)):
+            if not self.keys[pos].startswith(prefix):
+                return
+            yield self.values[pos]
+
+    def search(self, query, limit=10):
+        """Return up to `limit` items with a word starting with each word of `query`."""
+        words = normalize_words(query)
+        if not words:
+            return []
+        # Scan the longest word's matches, the fewest, and check the others against them.
+        longest = max(words, key=len)
+        others = [w for w in words if w is not longest]
+        results = []
+        seen = set()
+        for i in self._starting_with(longest):
+            if i in seen:
+                continue
+            seen.add(i)
+            if all(any(word.startswith(other) for word in self.words[i]) for other in others):
+                results.append(self.items[i])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+class MemoryIndex:
+    """A `PrefixIndex` of the localities and newest addresses, rebuilt when it's older than
+    `ttl`. While one thread rebuilds it the others carry on searching the old one."""
+
+    def __init__(self):
+        self._index = None
+        self._built = 0
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_INDEX_TTL', 300)
+
+    @property
+    def max_items(self):
+        return getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_INDEX_MAX_ITEMS', 100000)
+
+    def _build(self):
+        max_items = self.max_items
+        localities = list(Locality.objects.exclude(name='').order_by('-pk').values_list(
+            'pk', 'name', 'postal_code')[:max_items])
+        address_limit = max_items - len(localities)
+        addresses = Address.objects.exclude(formatted='').order_by('-pk').values_list('pk', 'formatted')
+        if address_limit <= 0 or addresses[address_limit:address_limit + 1].exists():
+            logger.warning(
+                'The autocomplete memory index only holds the newest %d addresses and localities.', max_items)
+
+        def items():
+            for pk, formatted in addresses[:max(address_limit, 0)].iterator(chunk_size=2000):
+                yield ('address', pk), formatted
+            for pk, name, postal_code in localities:
+                yield ('locality', pk), '%s %s' % (name, postal_code)
+
+        return PrefixIndex(items())
+
+    def get(self):
+        index = self._index
+        if index is not None and time.monotonic() - self._built <= self.ttl:
+            return index
+        if index is None:
+            # Nothing to search yet: wait for the first build.
+            with self._building:
+                if self._index is None:
+                    self._rebuild()
+                return self._index
+        if self._building.acquire(blocking=False):
+            try:
+                self._rebuild()
+            finally:
+                self._building.release()
+        return self._index
+
+    def _rebuild(self):
+        index = self._build()
+        with self._lock:
+            self._index = index
+            self._built = time.monotonic()
+
+    def search(self, query, limit):
+        matches = self.get().search(query, limit)
+        address_pks = [pk for kind, pk in matches if kind == 'address']
+        locality_pks = [pk for kind, pk in matches if kind == 'locality']
+        return _fetch(Address.objects.with_components(), address_pks), _fetch(
+            Locality.objects.select_related('state__country'), locality_pks)
+
+    def reset(self):
+        with self._lock:
+            self._index = None
+
+
+memory_index = MemoryIndex()
+
+
+def reset_autocomplete_index():
+    memory_index.reset()
+    _database_support.clear()
+
+
+def _fetch(queryset, pks):
+    """Fetch rows by pk, in the order given."""
+    found = queryset.in_bulk(pks)
+    return [found[pk] for pk in pks if pk in found]
+
+
+# Whether each database has its autocomplete indexes, by alias.
+_database_support = {}
+
+
+def _supports_database_search(connection):
+    if connection.alias not in _database_support:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                # Migrations that rebuild the address table drop the triggers keeping the index
+                # in step, leaving it stale, so check they're all still there.
+                cursor.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+                    [FTS_TABLE + '_%'],
+                )
+                supported = cursor.fetchone()[0] == 3
+            elif connection.vendor == 'postgresql':
+                cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [TRIGRAM_INDEX])
+                supported = cursor.fetchone() is not None
+            else:
+                supported = False
+        _database_support[connection.alias] = supported
+    return _database_support[connection.alias]
+
+
+def _fts_query(words):
+    # Each word as a quoted prefix term; FTS5 ANDs them.
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+
+
+def _search_database(connection, words, limit):
+    if connection.vendor == 'sqlite' and _supports_database_search(connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT rowid FROM %s WHERE %s MATCH %%s ORDER BY rank LIMIT %%s' % (FTS_TABLE, FTS_TABLE),
+                [_fts_query(words), limit],
+            )
+            pks = [row[0] for row in cursor.fetchall()]
+        addresses = _fetch(Address.objects.with_components(), pks)
+    else:
+        # Indexed by the trigram index on PostgreSQL; a table scan anywhere else.
+        filters = Q()
+        for word in words:
+            filters &= Q(formatted__icontains=word)
+        addresses = list(Address.objects.with_components().filter(filters).order_by('formatted')[:limit])
+
+    filters = Q()
+    for word in words:
+        filters &= Q(name__istartswith=word) | Q(name__icontains=' ' + word) | Q(postal_code__startswith=word)
+    localities = list(Locality.objects.select_related('state__country').filter(filters).order_by('name')[:limit])
+    return addresses, localities
+
+
+def _backend(connection):
+    backend = getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_BACKEND', None)
+    if backend is None:
+        return 'database' if _supports_database_search(connection) else 'memory'
+    return backend
+
+
+def _locality_result(locality):
+    state = locality.state
+    return {
+        'type': 'locality',
+        'id': locality.pk,
+        'label': str(locality),
+        'locality': locality.name,
+        'postal_code': locality.postal_code,
+        'state': state.name,
+        'state_code': state.code,
+        'country': state.country.name,
+        'country_code': state.country.code,
+    }
+
+
+def _address_result(address):
+    result = address.as_dict()
+    result.update(type='address', id=address.pk, label=str(address))
+    return result
+
+
+def search(query, limit=10):
+    """Return up to `limit` stored addresses, then localities, matching `query`, as dicts of the
+    components the address widget's fields take plus `type`, `id` and `label`."""
+    words = normalize_words(query)
+    if not words:
+        return []
+    connection = connections[router.db_for_read(Address)]
+    if _backend(connection) == 'database':
+        addresses, localities = _search_database(connection, words, limit)
+    else:
+        addresses, localities = memory_index.search(query, limit)
+    results = [_address_result(address) for address in addresses]
+    results.extend(_locality_result(locality) for locality in localities)
+    return results[:limit]
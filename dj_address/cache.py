@@ -0,0 +1,227 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import metrics
+
+
+__all__ = ['LRUCache', 'hierarchy_cache', 'geocode_cache']
+
+
+class LRUCache:
+    """A small thread-safe least-recently-used cache with hit/miss counters.
+
+    A `maxsize` of 0 disables the cache: nothing is stored and every lookup is a miss. Entries
+    expire after `ttl` seconds if one is given, either for the whole cache or per entry.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class HierarchyCache(LRUCache):
+    """Caches resolved `Country`, `State` and `Locality` rows for `_to_python`.
+
+    Keys are tuples starting with the model's label, followed by the values used to look the
+    row up, e.g. `('locality', name, postal_code, state_id)`. Rows are only added once the
+    surrounding transaction commits, so a rolled back insert never leaves a dangling pk behind.
+    """
+
+    _MISSING = object()
+
+    def get(self, key, default=None):
+        value = super().get(key, self._MISSING)
+        metrics.record_cache_access(self, 'hierarchy', 'miss' if value is self._MISSING else 'hit')
+        return default if value is self._MISSING else value
+
+    def add_on_commit(self, key, obj):
+        if self.maxsize > 0:
+            transaction.on_commit(lambda: self.set(key, obj))
+
+
+hierarchy_cache = HierarchyCache(maxsize=getattr(settings, 'DJ_ADDRESS_HIERARCHY_CACHE_SIZE', 1024))
+
+
+class GeocodeCache:
+    """Caches `GeocodeRaw.geocode` results by normalized raw value, first in process and then in
+    a Django cache shared between processes.
+
+    Failures that are a property of the input rather than of the request (too many results, or
+    only a partial or approximate match) are cached too, for `negative_timeout` seconds, so the
+    same bad input doesn't keep using up quota.
+    """
+    NEGATIVE_CODES = ('too_many_results', 'partial', 'approximate')
+    _MISSING = object()
+
+    def __init__(self, maxsize=1024):
+        self.local = LRUCache(maxsize=maxsize)
+        self.shared_hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'DJ_ADDRESS_GEOCODE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    @property
+    def negative_timeout(self):
+        return getattr(settings, 'DJ_ADDRESS_GEOCODE_NEGATIVE_CACHE_TIMEOUT', 60 * 60)
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'DJ_ADDRESS_GEOCODE_CACHE_ALIAS', 'default')
+        return caches[alias] if alias else None
+
+    def key(self, raw):
+        # The subpremise settings change what a lookup returns, so they're part of the key.
+        normalized = ' '.join(raw.split()).casefold()
+        flags = [
+            getattr(settings, name, None) for name in (
+                'DJ_ADDRESS_IGNORE_MISSING_SUBPREMISE',
+                'DJ_ADDRESS_SUBPREMISE_GEOCODE_RETRY_WITH_REPLACE',
+                'DJ_ADDRESS_SUBPREMISE_REPLACE_ONLY',
+            )
+        ]
+        digest = hashlib.sha1(('%s|%s' % (normalized, flags)).encode('utf-8')).hexdigest()
+        return 'dj_address:geocode:%s' % digest
+
+    def get(self, raw):
+        """Return the cached value for `raw`, or None. Raises the cached error for inputs that
+        are known to fail."""
+        key = self.key(raw)
+        entry = self.local.get(key, self._MISSING)
+        if entry is self._MISSING:
+            shared = self.shared
+            entry = shared.get(key, self._MISSING) if shared is not None else self._MISSING
+            if entry is self._MISSING:
+                with self._lock:
+                    self.misses += 1
+                metrics.record_cache_access(self, 'geocode', 'miss')
+                return None
+            with self._lock:
+                self.shared_hits += 1
+            metrics.record_cache_access(self, 'geocode', 'shared_hit')
+            self.local.set(key, entry, ttl=self._timeout_for(entry))
+        else:
+            metrics.record_cache_access(self, 'geocode', 'local_hit')
+        kind, payload = entry
+        if kind == 'error':
+            with self._lock:
+                self.negative_hits += 1
+            message, code = payload
+            raise ValidationError(message, code=code, params={'raw': raw})
+        value = dict(payload)
+        value['raw'] = raw
+        return value
+
+    def set(self, raw, value):
+        self._store(raw, ('value', value))
+
+    def set_error(self, raw, error):
+        if error.code in self.NEGATIVE_CODES and self.negative_timeout:
+            self._store(raw, ('error', (error.message, error.code)))
+
+    def _timeout_for(self, entry):
+        return self.negative_timeout if entry[0] == 'error' else self.timeout
+
+    def _store(self, raw, entry):
+        key = self.key(raw)
+        timeout = self._timeout_for(entry)
+        self.local.set(key, entry, ttl=timeout)
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, entry, timeout)
+
+    def clear(self):
+        """Clear the in-process tier. Shared entries are left to expire."""
+        self.local.clear()
+
+    def reset_stats(self):
+        self.local.reset_stats()
+        with self._lock:
+            self.shared_hits = self.misses = self.negative_hits = 0
+
+    def stats(self):
+        local_hits = self.local.hits
+        lookups = local_hits + self.shared_hits + self.misses
+        return {
+            'local_hits': local_hits,
+            'shared_hits': self.shared_hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'size': len(self.local),
+            'maxsize': self.local.maxsize,
+            'hit_rate': (local_hits + self.shared_hits) / lookups if lookups else 0.0,
+        }
+
+
+geocode_cache = GeocodeCache(maxsize=getattr(settings, 'DJ_ADDRESS_GEOCODE_CACHE_SIZE', 1024))
@@ -0,0 +1,272 @@
+"""Finding and merging duplicate addresses and localities.
+
+Comparing every address with every other is quadratic, so candidates are found by blocking:
+each address is filed under a few keys (its postal code and street number, its normalized route
+and street number, its geohash, or its normalized raw value) and only addresses sharing a key are
+compared. That keeps the work roughly linear in the number of addresses, as long as blocks stay
+small; blocks larger than `max_block_size` are skipped rather than compared pairwise.
+
+Merging repoints every foreign key to the duplicates (found through model introspection, so
+`AddressField`s on any model are included) at the surviving row, then deletes the duplicates.
+"""
+import logging
+import re
+from collections import defaultdict, namedtuple
+
+from django.db import models, transaction
+
+from . import geohash
+from .models import Address, Locality
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ['find_duplicate_addresses', 'find_duplicate_localities', 'merge']
+
+
+# Fine enough (about 5m across) that only the same building shares a cell.
+GEOHASH_PRECISION = 9
+
+ROUTE_ABBREVIATIONS = {
+    'avenue': 'ave',
+    'boulevard': 'blvd',
+    'circle': 'cir',
+    'court': 'ct',
+    'crescent': 'cres',
+    'drive': 'dr',
+    'east': 'e',
+    'highway': 'hwy',
+    'lane': 'ln',
+    'north': 'n',
+    'parkway': 'pkwy',
+    'place': 'pl',
+    'road': 'rd',
+    'south': 's',
+    'street': 'st',
+    'terrace': 'tce',
+    'west': 'w',
+}
+
+
+def normalize(value):
+    """Casefold, drop punctuation and collapse whitespace."""
+    return ' '.join(re.findall(r'\w+', value.casefold())) if value else ''
+
+
+def normalize_route(route):
+    return ' '.join(ROUTE_ABBREVIATIONS.get(word, word) for word in normalize(route).split())
+
+
+Candidate = namedtuple('Candidate', [
+    'pk', 'street_number', 'route', 'subpremise', 'locality_id', 'locality', 'postal_code',
+    'state_id', 'raw', 'geohash', 'rank',
+])
+
+
+def _address_candidates(queryset):
+    rows = queryset.order_by('pk').values_list(
+        'pk', 'street_number', 'route', 'subpremise', 'locality_id', 'locality__name',
+        'locality__postal_code', 'locality__state_id', 'raw', 'latitude', 'longitude', 'formatted',
+    ).iterator(chunk_size=2000)
+    for (pk, street_number, route, subpremise, locality_id, locality, postal_code, state_id, raw,
+         latitude, longitude, formatted) in rows:
+        has_coordinates = latitude is not None and longitude is not None
+        yield Candidate(
+            pk=pk,
+            street_number=normalize(street_number),
+            route=normalize_route(route),
+            subpremise=normalize(subpremise),
+            locality_id=locality_id,
+            locality=normalize(locality),
+            postal_code=normalize(postal_code),
+            state_id=state_id,
+            raw=normalize(raw),
+            geohash=geohash.encode(latitude, longitude, GEOHASH_PRECISION) if has_coordinates else None,
+            # The most complete address survives a merge, then the oldest.
+            rank=(locality_id is None, not has_coordinates, not formatted, pk),
+        )
+
+
+def _has_components(c):
+    return bool(c.street_number or c.route or c.subpremise or c.locality_id)
+
+
+def _blocking_keys(c):
+    if not _has_components(c):
+        yield ('raw', c.raw)
+        return
+    if c.postal_code and c.street_number:
+        yield ('postal_code', c.postal_code, c.street_number)
+    if c.route:
+        yield ('route', c.state_id, c.route, c.street_number)
+    if c.geohash and c.street_number:
+        yield ('geohash', c.geohash)
+
+
+def is_duplicate(a, b):
+    """Whether two address candidates describe the same place."""
+    if _has_components(a) != _has_components(b):
+        return False
+    if not _has_components(a):
+        return a.raw == b.raw
+    if a.subpremise != b.subpremise or a.street_number != b.street_number:
+        return False
+    if a.geohash is not None and a.geohash == b.geohash and a.street_number:
+        # Same building and number, whatever the street is called.
+        return True
+    if a.route != b.route:
+        return False
+    if a.locality_id == b.locality_id:
+        return True
+    return a.state_id == b.state_id and (
+        a.locality == b.locality or bool(a.postal_code) and a.postal_code == b.postal_code)
+
+
+class _DisjointSet:
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        while parent != x:
+            # Path splitting keeps the trees shallow.
+            self.parent[x] = self.parent[parent]
+            x, parent = parent, self.parent[parent]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[b] = a
+
+    def groups(self):
+        groups = defaultdict(list)
+        for x in self.parent:
+            groups[self.find(x)].append(x)
+        return [members for members in groups.values() if len(members) > 1]
+
+
+def _find_duplicates(candidates, blocking_keys, compare, max_block_size):
+    candidates = {c.pk: c for c in candidates}
+    blocks = defaultdict(list)
+    for c in candidates.values():
+        for key in blocking_keys(c):
+            blocks[key].append(c.pk)
+    sets = _DisjointSet()
+    for key, pks in blocks.items():
+        if len(pks) < 2:
+            continue
+        if len(pks) > max_block_size:
+            logger.warning('Skipping %d candidates sharing %r, more than max_block_size.', len(pks), key)
+            continue
+        for i, pk in enumerate(pks):
+            for other in pks[i + 1:]:
+                if sets.find(pk) != sets.find(other) and compare(candidates[pk], candidates[other]):
+                    sets.union(pk, other)
+    groups = []
+    for members in sets.groups():
+        members.sort(key=lambda pk: candidates[pk].rank)
+        groups.append(members)
+    groups.sort()
+    return groups
+
+
+def find_duplicate_addresses(queryset=None, max_block_size=1000):
+    """Return groups of duplicate addresses as lists of pks, the one to keep first."""
+    queryset = Address.objects.all() if queryset is None else queryset
+    return _find_duplicates(_address_candidates(queryset), _blocking_keys, is_duplicate, max_block_size)
+
+
+LocalityCandidate = namedtuple('LocalityCandidate', ['pk', 'state_id', 'name', 'postal_code', 'rank'])
+
+
+def find_duplicate_localities(queryset=None, max_block_size=1000):
+    """Return groups of localities in the same state whose names and postal codes only differ
+    in case, punctuation or spacing, as lists of pks, the one to keep first."""
+    queryset = Locality.objects.all() if queryset is None else queryset
+    candidates = (
+        LocalityCandidate(pk, state_id, normalize(name), normalize(postal_code), pk)
+        for pk, state_id, name, postal_code in queryset.order_by('pk').values_list(
+            'pk', 'state_id', 'name', 'postal_code').iterator(chunk_size=2000)
+    )
+    return _find_duplicates(
+        candidates,
+        lambda c: [(c.state_id, c.name, c.postal_code)] if c.name else [],
+        lambda a, b: True,
+        max_block_size,
+    )
+
+
+def _relations(model):
+    """The foreign keys pointing at `model`, including those of many-to-many through tables."""
+    return [
+        f for f in model._meta.get_fields(include_hidden=True)
+        if f.auto_created and not f.concrete and (f.one_to_many or f.one_to_one)
+    ]
+
+
+def _batches(groups, batch_size):
+    """Split `groups` into batches of about `batch_size` rows to delete, keeping groups whole."""
+    batch, size = [], 0
+    for group in groups:
+        if batch and size + len(group) - 1 > batch_size:
+            yield batch
+            batch, size = [], 0
+        batch.append(group)
+        size += len(group) - 1
+    if batch:
+        yield batch
+
+
+def merge(model, groups, batch_size=300, dry_run=False):
+    """Merge each group of `model` pks into its first pk, repointing every foreign key to the
+    others before deleting them. Groups are merged in batches of about `batch_size` deleted rows,
+    each in one transaction with one UPDATE per foreign key and one DELETE.
+
+    Returns a dict of the number of groups merged, rows deleted, and references repointed for each
+    foreign key (as `app_label.model.field`). With `dry_run` nothing is changed, and the counts
+    are those that would be.
+    """
+    stats = {'groups': 0, 'deleted': 0, 'references': defaultdict(int)}
+    relations = _relations(model)
+    for batch in _batches(groups, batch_size):
+        survivors = {loser: group[0] for group in batch for loser in group[1:]}
+        with transaction.atomic():
+            for rel in relations:
+                field = rel.field
+                label = '%s.%s' % (field.model._meta.label_lower, field.name)
+                referencing = field.model._base_manager.filter(**{'%s__in' % field.name: list(survivors)})
+                if dry_run:
+                    stats['references'][label] += referencing.count()
+                    continue
+                repoint = models.Case(
+                    *[models.When(**{field.attname: loser, 'then': models.Value(survivor)})
+                      for loser, survivor in survivors.items()],
+                    output_field=field.target_field,
+                )
+                stats['references'][label] += referencing.update(**{field.attname: repoint})
+            if not dry_run:
+                model._base_manager.filter(pk__in=list(survivors)).delete()
+                if model is Locality:
+                    _refresh_fingerprints(Address.objects.filter(locality__in={s for s in survivors.values()}))
+        stats['groups'] += len(batch)
+        stats['deleted'] += len(survivors)
+    stats['references'] = dict(stats['references'])
+    return stats
+
+
+def _refresh_fingerprints(queryset):
+    # Address fingerprints include the locality, so they change when localities are merged.
+    # Addresses that only differed in locality now share one, which must stay unique: the one
+    # already holding it keeps it, and the rest are left without, as duplicates to be merged.
+    addresses = list(queryset.only('street_number', 'route', 'subpremise', 'locality_id', 'raw', 'fingerprint'))
+    current = {address.pk: address.fingerprint for address in addresses}
+    taken = set()
+    for address in sorted(addresses, key=lambda a: (a.set_fingerprint() != current[a.pk], a.pk)):
+        if address.fingerprint in taken:
+            address.fingerprint = ''
+        taken.add(address.fingerprint)
+    changed = [address for address in addresses if address.fingerprint != current[address.pk]]
+    Address.objects.bulk_update(changed, ['fingerprint'], batch_size=500)
@@ -1,19 +1,18 @@
 import logging
-import time
 
-import requests
 from django import forms
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
 
-from .models import Address, to_python
+from .geocoders import GeocodeRaw, get_geocoder
+from .models import Address, GeocodeJob, to_python
 from .widgets import AddressWidget
 
 
 logger = logging.getLogger(__name__)
 
 
-__all__ = ['AddressWidget', 'AddressField']
+__all__ = ['AddressWidget', 'AddressField', 'prefetch_addresses']
 
 
 if not settings.GOOGLE_API_KEY:
@@ -45,8 +44,15 @@ def ensure_float(value, field):
 class AddressField(forms.ModelChoiceField):
     widget = AddressWidget
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, geocoder=None, deadline_ms=None, enqueue=None, **kwargs):
         kwargs['queryset'] = Address.objects.none()
+        # A geocoder backend instance; None uses the one configured by DJ_ADDRESS_GEOCODER.
+        self.geocoder = geocoder
+        # The most time to spend geocoding a value; None uses DJ_ADDRESS_GEOCODE_DEADLINE_MS.
+        self.deadline_ms = deadline_ms
+        # Whether to save raw values as they are and queue them for the `geocode_worker` command,
+        # rather than geocode them here; None uses DJ_ADDRESS_GEOCODE_ENQUEUE.
+        self.enqueue = enqueue
         super().__init__(*args, **kwargs)
 
     def try_geocode(self, value):
@@ -62,195 +68,78 @@ class AddressField(forms.ModelChoiceField):
                 return False
         return True
 
+    def prepare_value(self, value):
+        # Give the widget the Address itself rather than its pk, so it needn't fetch it again.
+        if isinstance(value, Address):
+            return value
+        return super().prepare_value(value)
+
     def to_python(self, value):
         # Treat `None`s and empty strings as empty.
         if value is None or value == '':
             return None
+        deferred = False
         if self.try_geocode(value):
-            value = GeocodeRaw(value['raw']).geocode()
+            raw = value['raw']
+            enqueue = self.enqueue
+            if enqueue is None:
+                enqueue = getattr(settings, 'DJ_ADDRESS_GEOCODE_ENQUEUE', False)
+            if enqueue and GeocodeRaw(raw).can_geocode():
+                address = to_python(raw)
+                if not address.has_components():
+                    GeocodeJob.objects.enqueue(address)
+                return address
+            deadline_ms = self.deadline_ms
+            if deadline_ms is None:
+                deadline_ms = getattr(settings, 'DJ_ADDRESS_GEOCODE_DEADLINE_MS', None)
+            value = (self.geocoder or get_geocoder()).geocode(raw, deadline_ms=deadline_ms)
+            # A raw value that could have been geocoded but came back as it was wasn't geocoded
+            # this time: it ran out of time, was rate limited or Google didn't answer.
+            deferred = isinstance(value, str) and GeocodeRaw(raw).can_geocode()
         ensure_correct_datatypes(value)
-        return to_python(value)
-
-
-class GeocodeRaw:
-
-    def __init__(self, raw):
-        self.geocode_api = 'https://maps.googleapis.com/maps/api/geocode/json'
-        # We need some minimum components to use a raw address with the Geocode API or it could try
-        # to use the wrong region as the viewport and give a bogus result, but not say it's a guess.
-        self.min_components_for_geocode = len('address street city state/country'.split())
-        self.raw = raw
-
-    def can_geocode(self):
-        return len(self.raw.split()) >= self.min_components_for_geocode
-
-    def verify_one_result(self, results):
-        if len(results) > 1:
-            # TODO: offer these as suggestions?
-            raise forms.ValidationError(
-                'Too many results for %(raw)s',
-                code='too_many_results',
-                params={'raw': self.raw}
-            )
-
-    def verify_not_partial(self, result):
-        if 'partial_match' in result:
-            raise forms.ValidationError(
-                'Only a partial match could be found for %(raw)s',
-                code='partial',
-                params={'raw': self.raw}
-            )
-
-    def verify_not_approximate(self, result):
-        if 'geometry' in result and 'location_type' in result['geometry']:
-            loc_type = result['geometry']['location_type']
-            if loc_type != 'ROOFTOP':
-                raise forms.ValidationError(
-                    'Only an approximate match could be found for %(raw)s',
-                    code='approximate',
-                    params={'raw': self.raw}
-                )
-
-    def get_address_components_dict(self, address_components):
-        ac = {}
-        ac_map = {
-            'administrative_area_level_1': 'state_code',
-            'country': 'country_code',
-        }
-        for component in address_components:
-            try:
-                component_types = component['types']
-                if 'political' in component_types:
-                    component_types.remove('political')
-                component_type = ac_map.get(component['types'][0], component['types'][0])
-                if component_type.endswith('_code'):
-                    ac[component_type.replace('_code', '')] = component['long_name']
-                ac[component_type] = component['short_name']
-            except (KeyError, IndexError):
-                # Could be there are no types, or the type isn't one we know how to deal with.
-                pass
-        return ac
-
-    def flatten(self, result):
-        address_components = self.get_address_components_dict(result['address_components'])
-        value = {
-            'country': address_components.get('country'),
-            'country_code': address_components.get('country_code'),
-            'locality': address_components.get('locality'),
-            'postal_code': address_components.get('postal_code'),
-            'route': address_components.get('route'),
-            'subpremise': address_components.get('subpremise'),
-            'street_number': address_components.get('street_number'),
-            'state': address_components.get('state'),
-            'state_code': address_components.get('state_code'),
-            'formatted': result.get('formatted_address'),
-            'latitude': result.get('geometry').get('location')['lat'],
-            'longitude': result.get('geometry').get('location')['lng'],
-        }
-        # Fix issue with sublocalities (e.g. NYC boroughs)
-        if not value.get('locality') and 'sublocality' in address_components:
-            value['locality'] = address_components.get('sublocality')
-        return value
-
-    def process_result(self, api_result):
-        # Most requests will succeed, as Google will try to find matches, so we have to check
-        # the data to see if it is what we really wanted.
-        results = api_result.json()['results']
-        self.verify_one_result(results)
-        result = results[0]
-        # A partial match could indicate the address includes a subpremise. Also, the correct
-        # address could be found but the wrong subpremise (e.g. by not having commas in 'raw'.
-        potential_error = None
-        try:
-            self.verify_not_partial(result)
-        except forms.ValidationError as e:
-            potential_error = e
-        self.verify_not_approximate(result)
-        value = self.flatten(result)
-        if value['subpremise'] and value['subpremise'] in self.raw:
-            potential_error = None
-        value['raw'] = self.raw
-        return value, potential_error
-
-    def get_raw_subpremise(self, raw):
-        """Try to find the subpremise, accounting for a possible space between the '#' and the
-        value. We're not going to try to get APT, STE, etc. here, just '#'.
-        """
-        hash_index = -1
-        components = raw.split()
-        for i, v in enumerate(components):
-            if v.startswith('#'):
-                v = v.replace('#', '').strip()
-                if v:
-                    return v
-                hash_index = i
-                break
-        if hash_index > 2:
-            return components[hash_index + 1]
-        return ''
-
-    def usable_data(self, value):
-        return all(
-            [
-                self.raw.startswith(value['street_number']),
-                value.get('latitude'),
-                value.get('longitude'),
-            ]
-        )
-
-    def generate_formatted(self, value):
-        try:
-            return ('{street_number} {route} #{subpremise}, {locality}, '
-                    '{state_code} {postal_code}, {country_code}').format(**value)
-        except KeyError:
-            # If we didn't have any of those already, it was a bad search anyway.
-            return ''
-
-    def geocode(self):
-        value = self.raw
-        potential_errors = []
-        if not self.can_geocode():
-            return value
-        tries = {'raw': self.raw, 'formatted': ''}
-        for t in tries:
-            data = {'address': tries[t].replace(' ', '+'), 'key': settings.GOOGLE_API_KEY}
-            r = requests.get(self.geocode_api, params=data, headers={'Cache-Control': 'no-cache'})
-            if r.status_code == requests.codes.ok:
-                value, potential_error = self.process_result(r)
-                if potential_error:
-                    potential_errors.append(potential_error)
-                    raw_subpremise = self.get_raw_subpremise(value['raw']).strip(',')
-                    if not raw_subpremise:
-                        # If the user wasn't trying to use a subpremise, all the following
-                        # strategies are meaningless.
-                        raise potential_error
-                    returned_subpremise = value.get('subpremise')
-                    if not returned_subpremise and settings.DJ_ADDRESS_IGNORE_MISSING_SUBPREMISE:
-                        if self.usable_data(value):
-                            value['subpremise'] = raw_subpremise
-                            value['formatted'] = self.generate_formatted(value)
-                            potential_errors = []
-                            break
-                    if returned_subpremise:
-                        re_formatted = value['formatted'].replace(
-                            f'#{returned_subpremise}',
-                            f'#{raw_subpremise}'
-                        )
-                        if settings.DJ_ADDRESS_SUBPREMISE_GEOCODE_RETRY_WITH_REPLACE:
-                            # Try again using the formatted address, and the subpremise from the
-                            # raw data; don't freak out the Google servers by submitting requests
-                            # one right after the other.
-                            tries['formatted'] = re_formatted
-                            time.sleep(0.75)
-                        elif settings.DJ_ADDRESS_SUBPREMISE_REPLACE_ONLY:
-                            if self.usable_data(value):
-                                value['subpremise'] = raw_subpremise
-                                value['formatted'] = re_formatted
-                                potential_errors = []
-                                break
-                else:
-                    break
-        if potential_errors:
-            # Raise the original error.
-            raise potential_errors[0]
-        return value
+        address = to_python(value)
+        if deferred and not address.has_components():
+            # Queue it to be geocoded later.
+            GeocodeJob.objects.enqueue(address)
+        return address
+
+
+def prefetch_addresses(form_list):
+    """Replace the address pks in the initial data of `form_list` (or a formset) with Address
+    instances and their components, fetched in one query, so rendering them needs no more.
+
+    A model form's address is taken from its instance instead when that has already been loaded,
+    with `select_related` say.
+    """
+    pending = []
+    pks = set()
+    for form in form_list:
+        for name, field in form.fields.items():
+            if not isinstance(field, AddressField):
+                continue
+            value = form.initial.get(name)
+            if value in (None, '') or isinstance(value, (Address, dict)):
+                continue
+            instance = getattr(form, 'instance', None)
+            model_field = _model_field(instance, name)
+            if model_field is not None and model_field.is_cached(instance):
+                form.initial[name] = model_field.get_cached_value(instance)
+                continue
+            pending.append((form, name, value))
+            pks.add(value)
+    if pks:
+        addresses = Address.objects.with_components().in_bulk(pks)
+        for form, name, pk in pending:
+            if pk in addresses:
+                form.initial[name] = addresses[pk]
+    return form_list
+
+
+def _model_field(instance, name):
+    if instance is None:
+        return None
+    try:
+        field = instance._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    return field if field.is_relation and field.many_to_one else None
@@ -0,0 +1,577 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .cache import geocode_cache
+from .ratelimit import CombinedRateLimiter, DailyQuota, TokenBucket
+from .sessions import get_session, get_timeout
+from .singleflight import CacheSingleFlight, SingleFlight
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'BaseGeocoder', 'GoogleGeocoder', 'LocalHTTPGeocoder', 'ReplayGeocoder', 'GeocodeRaw',
+    'AsyncGeocoder', 'get_geocoder', 'GeocodeUnavailable', 'GeocodeThrottled', 'GeocodeQuotaExceeded',
+    'GeocodeDeadlineExceeded',
+]
+
+
+GOOGLE_GEOCODE_URL = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+
+class GeocodeUnavailable(Exception):
+    """A request to a geocoding API wasn't made. `GeocodeRaw.geocode` returns the raw value
+    instead, so it's stored without being geocoded."""
+
+
+class GeocodeThrottled(GeocodeUnavailable):
+    """The rate limiter had no token for the request in time."""
+
+
+class GeocodeQuotaExceeded(GeocodeUnavailable):
+    """The day's quota of requests has been used up."""
+
+
+class GeocodeDeadlineExceeded(GeocodeUnavailable):
+    """Geocoding couldn't finish within its time budget."""
+
+
+class BaseGeocoder:
+    """A geocoder backend, selected with the `DJ_ADDRESS_GEOCODER` setting."""
+
+    # Backends that make requests should acquire a token from this before each one, if it's set,
+    # waiting at most `rate_limit_timeout` seconds (None waits as long as it takes).
+    rate_limiter = None
+    rate_limit_timeout = None
+    # And count each one against this `DailyQuota`, if it's set.
+    daily_quota = None
+
+    def check_limits(self, timeout=None):
+        """Wait for the rate limiter, for no more than `timeout` seconds if it's given, and count
+        a request against the quota, raising a `GeocodeUnavailable` if the request shouldn't be
+        made."""
+        if self.rate_limiter is not None:
+            if timeout is not None and (self.rate_limit_timeout is None or timeout < self.rate_limit_timeout):
+                if not self.rate_limiter.acquire(timeout=timeout):
+                    raise GeocodeDeadlineExceeded('No geocoding rate limit token within %.3fs.' % timeout)
+            elif not self.rate_limiter.acquire(timeout=self.rate_limit_timeout):
+                raise GeocodeThrottled('No geocoding rate limit token within %ss.' % self.rate_limit_timeout)
+        if self.daily_quota is not None and not self.daily_quota.try_consume():
+            raise GeocodeQuotaExceeded('The daily geocoding quota of %d requests is used up.' % self.daily_quota.limit)
+
+    def geocode(self, raw, deadline_ms=None):
+        """Return a dict of address components for `raw`, in the form accepted by `to_python`,
+        or `raw` itself if it couldn't be geocoded. Raise a ValidationError if the only result
+        isn't good enough to use. Give up on geocoding after `deadline_ms` milliseconds, if
+        it's set."""
+        raise NotImplementedError
+
+
+class GoogleGeocoder(BaseGeocoder):
+    """Geocodes with the Google Geocoding API, or anything that speaks its protocol at `url`."""
+
+    def __init__(self, url=None, api_key=None, rate_limiter=None):
+        self.url = url or GOOGLE_GEOCODE_URL
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+
+    def fetch(self, address, timeout=None):
+        """Make a single request to the API for `address`, returning the response. With a
+        `timeout` in seconds it's a single attempt, that raises `GeocodeDeadlineExceeded` if it
+        doesn't finish in time; otherwise failures are retried as the session's configured to."""
+        self.check_limits(timeout)
+        data = {'address': address.replace(' ', '+'), 'key': self.api_key or settings.GOOGLE_API_KEY}
+        start = time.perf_counter() if metrics.enabled(metrics.geocode_requested) else None
+        try:
+            response = get_session(retries=timeout is None).get(
+                self.url,
+                params=data,
+                headers={'Cache-Control': 'no-cache'},
+                timeout=get_timeout(limit=timeout),
+            )
+        except requests.Timeout as e:
+            if timeout is None:
+                raise
+            raise GeocodeDeadlineExceeded('The geocoding request took over %.3fs.' % timeout) from e
+        if start is not None:
+            metrics.record_geocode_request(self, response, time.perf_counter() - start)
+        return response
+
+    def geocode(self, raw, deadline_ms=None):
+        return GeocodeRaw(raw, backend=self, deadline_ms=deadline_ms).geocode()
+
+
+class LocalHTTPGeocoder(GoogleGeocoder):
+    """Talks Google's protocol to a stand-in server, e.g. `dj_address.testing.StubGeocodeServer`
+    or a mock service in a load-testing environment, at `DJ_ADDRESS_GEOCODER_URL`."""
+
+    def __init__(self, url=None, **kwargs):
+        url = url or getattr(settings, 'DJ_ADDRESS_GEOCODER_URL', None)
+        if not url:
+            raise ImproperlyConfigured('LocalHTTPGeocoder needs DJ_ADDRESS_GEOCODER_URL to be set.')
+        super().__init__(url=url, **kwargs)
+
+
+class RecordedResponse:
+    """Just enough of `requests.Response` for `GeocodeRaw.process_result`."""
+
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+
+class ReplayGeocoder(GoogleGeocoder):
+    """Answers from Geocoding API responses recorded in a JSON file, so the whole form path can
+    run without a network. The file maps each requested address to the API's JSON response.
+
+    With `record=True`, addresses missing from the file are fetched from the API and the
+    responses added to the file; otherwise they get an empty `ZERO_RESULTS` response, which
+    `geocode` reports as a ValidationError.
+    """
+
+    def __init__(self, path=None, record=False, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path or getattr(settings, 'DJ_ADDRESS_GEOCODER_REPLAY_FILE', None)
+        if not self.path:
+            raise ImproperlyConfigured('ReplayGeocoder needs DJ_ADDRESS_GEOCODER_REPLAY_FILE to be set.')
+        self.record = record
+        self._lock = threading.Lock()
+        self.responses = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.responses = {self.key(address): payload for address, payload in json.load(f).items()}
+
+    @staticmethod
+    def key(address):
+        return ' '.join(address.split())
+
+    def fetch(self, address, timeout=None):
+        key = self.key(address)
+        payload = self.responses.get(key)
+        if payload is not None:
+            return RecordedResponse(payload)
+        if not self.record:
+            return RecordedResponse({'results': [], 'status': 'ZERO_RESULTS'})
+        response = super().fetch(address, timeout=timeout)
+        if response.status_code == requests.codes.ok:
+            with self._lock:
+                self.responses[key] = response.json()
+                self._save()
+        return response
+
+    def _save(self):
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.responses, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def get_geocoder():
+    """Return the geocoder backend named by `DJ_ADDRESS_GEOCODER`, built with the keyword
+    arguments in `DJ_ADDRESS_GEOCODER_OPTIONS`. It's built once and shared."""
+    global _geocoder
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                path = getattr(settings, 'DJ_ADDRESS_GEOCODER', 'dj_address.geocoders.GoogleGeocoder')
+                options = getattr(settings, 'DJ_ADDRESS_GEOCODER_OPTIONS', {})
+                geocoder = import_string(path)(**options)
+                _configure_limits(geocoder)
+                _geocoder = geocoder
+    return _geocoder
+
+
+def _configure_limits(geocoder):
+    """Give `geocoder` the rate limiter and daily quota set up by the `DJ_ADDRESS_GEOCODER_RATE_*`
+    and `DJ_ADDRESS_GEOCODER_DAILY_QUOTA` settings, unless it has its own."""
+    limiter = getattr(settings, 'DJ_ADDRESS_GEOCODER_RATE_LIMITER', None)
+    if limiter and geocoder.rate_limiter is None:
+        options = getattr(settings, 'DJ_ADDRESS_GEOCODER_RATE_LIMITER_OPTIONS', {})
+        geocoder.rate_limiter = import_string(limiter)(**options)
+        geocoder.rate_limit_timeout = getattr(settings, 'DJ_ADDRESS_GEOCODER_RATE_LIMIT_TIMEOUT', None)
+    quota = getattr(settings, 'DJ_ADDRESS_GEOCODER_DAILY_QUOTA', None)
+    if quota and geocoder.daily_quota is None:
+        alias = getattr(settings, 'DJ_ADDRESS_GEOCODER_QUOTA_CACHE_ALIAS', 'default')
+        geocoder.daily_quota = DailyQuota(quota, alias=alias)
+
+
+def reset_geocoder():
+    global _geocoder
+    with _geocoder_lock:
+        _geocoder = None
+
+
+# Geocodes in flight in this process, by cache key.
+_in_flight = SingleFlight()
+
+
+class GeocodeRaw:
+    """Geocodes a raw address with the Google Geocoding API, checking the result is a single,
+    exact match and working around the API's inconsistencies with subpremises. Requests are made
+    through `backend`, a `GoogleGeocoder` by default."""
+
+    def __init__(self, raw, backend=None, deadline_ms=None):
+        self.backend = backend if backend is not None else GoogleGeocoder()
+        # The time budget for `geocode`, after which the raw value is returned instead.
+        self.deadline_ms = deadline_ms
+        self.deadline = None
+        self.last_fetch_duration = 0
+        # We need some minimum components to use a raw address with the Geocode API or it could try
+        # to use the wrong region as the viewport and give a bogus result, but not say it's a guess.
+        self.min_components_for_geocode = len('address street city state/country'.split())
+        self.raw = raw
+
+    def can_geocode(self):
+        return len(self.raw.split()) >= self.min_components_for_geocode
+
+    def verify_any_results(self, results):
+        if not results:
+            raise forms.ValidationError(
+                'No results for %(raw)s',
+                code='no_results',
+                params={'raw': self.raw}
+            )
+
+    def verify_one_result(self, results):
+        if len(results) > 1:
+            # TODO: offer these as suggestions?
+            raise forms.ValidationError(
+                'Too many results for %(raw)s',
+                code='too_many_results',
+                params={'raw': self.raw}
+            )
+
+    def verify_not_partial(self, result):
+        if 'partial_match' in result:
+            raise forms.ValidationError(
+                'Only a partial match could be found for %(raw)s',
+                code='partial',
+                params={'raw': self.raw}
+            )
+
+    def verify_not_approximate(self, result):
+        if 'geometry' in result and 'location_type' in result['geometry']:
+            loc_type = result['geometry']['location_type']
+            if loc_type != 'ROOFTOP':
+                raise forms.ValidationError(
+                    'Only an approximate match could be found for %(raw)s',
+                    code='approximate',
+                    params={'raw': self.raw}
+                )
+
+    def get_address_components_dict(self, address_components):
+        ac = {}
+        ac_map = {
+            'administrative_area_level_1': 'state_code',
+            'country': 'country_code',
+        }
+        for component in address_components:
+            try:
+                component_types = component['types']
+                if 'political' in component_types:
+                    component_types.remove('political')
+                component_type = ac_map.get(component['types'][0], component['types'][0])
+                if component_type.endswith('_code'):
+                    ac[component_type.replace('_code', '')] = component['long_name']
+                ac[component_type] = component['short_name']
+            except (KeyError, IndexError):
+                # Could be there are no types, or the type isn't one we know how to deal with.
+                pass
+        return ac
+
+    def flatten(self, result):
+        address_components = self.get_address_components_dict(result['address_components'])
+        value = {
+            'country': address_components.get('country'),
+            'country_code': address_components.get('country_code'),
+            'locality': address_components.get('locality'),
+            'postal_code': address_components.get('postal_code'),
+            'route': address_components.get('route'),
+            'subpremise': address_components.get('subpremise'),
+            'street_number': address_components.get('street_number'),
+            'state': address_components.get('state'),
+            'state_code': address_components.get('state_code'),
+            'formatted': result.get('formatted_address'),
+            'latitude': result.get('geometry').get('location')['lat'],
+            'longitude': result.get('geometry').get('location')['lng'],
+        }
+        # Fix issue with sublocalities (e.g. NYC boroughs)
+        if not value.get('locality') and 'sublocality' in address_components:
+            value['locality'] = address_components.get('sublocality')
+        return value
+
+    def process_result(self, api_result):
+        # Most requests will succeed, as Google will try to find matches, so we have to check
+        # the data to see if it is what we really wanted.
+        results = api_result.json()['results']
+        self.verify_any_results(results)
+        self.verify_one_result(results)
+        result = results[0]
+        # A partial match could indicate the address includes a subpremise. Also, the correct
+        # address could be found but the wrong subpremise (e.g. by not having commas in 'raw'.
+        potential_error = None
+        try:
+            self.verify_not_partial(result)
+        except forms.ValidationError as e:
+            potential_error = e
+        self.verify_not_approximate(result)
+        value = self.flatten(result)
+        if value['subpremise'] and value['subpremise'] in self.raw:
+            potential_error = None
+        value['raw'] = self.raw
+        return value, potential_error
+
+    def get_raw_subpremise(self, raw):
+        """Try to find the subpremise, accounting for a possible space between the '#' and the
+        value. We're not going to try to get APT, STE, etc. here, just '#'.
+        """
+        hash_index = -1
+        components = raw.split()
+        for i, v in enumerate(components):
+            if v.startswith('#'):
+                v = v.replace('#', '').strip()
+                if v:
+                    return v
+                hash_index = i
+                break
+        if hash_index > 2:
+            return components[hash_index + 1]
+        return ''
+
+    def usable_data(self, value):
+        return all(
+            [
+                self.raw.startswith(value['street_number']),
+                value.get('latitude'),
+                value.get('longitude'),
+            ]
+        )
+
+    def generate_formatted(self, value):
+        try:
+            return ('{street_number} {route} #{subpremise}, {locality}, '
+                    '{state_code} {postal_code}, {country_code}').format(**value)
+        except KeyError:
+            # If we didn't have any of those already, it was a bad search anyway.
+            return ''
+
+    def geocode(self):
+        """Geocode the raw value, using a cached result for the same input if there is one."""
+        if not self.can_geocode():
+            return self.raw
+        if self.deadline_ms:
+            self.deadline = time.monotonic() + self.deadline_ms / 1000
+        value = geocode_cache.get(self.raw)
+        if value is not None:
+            return value
+        if not getattr(settings, 'DJ_ADDRESS_GEOCODE_COALESCE', True):
+            return self._geocode_and_cache()
+        # Concurrent geocodes of the same input wait on one request, and share its outcome.
+        try:
+            value, shared = _in_flight.do(
+                geocode_cache.key(self.raw), self._geocode_across_processes, timeout=self.time_left())
+        except (TimeoutError, GeocodeDeadlineExceeded) as e:
+            logger.warning('Not geocoding %r: %s', self.raw, e)
+            return self.raw
+        return self._for_raw(value) if shared else value
+
+    def _geocode_across_processes(self):
+        alias = getattr(settings, 'DJ_ADDRESS_GEOCODE_COALESCE_ALIAS', None)
+        if not alias:
+            return self._geocode_and_cache()
+        flight = CacheSingleFlight(alias, lock_timeout=getattr(settings, 'DJ_ADDRESS_GEOCODE_COALESCE_TIMEOUT', 30))
+        value, shared = flight.do(geocode_cache.key(self.raw), self._geocode_and_cache, timeout=self.time_left())
+        return self._for_raw(value) if shared else value
+
+    def time_left(self):
+        """The seconds left of the time budget, or None if there isn't one. Raises
+        `GeocodeDeadlineExceeded` once it's used up."""
+        if self.deadline is None:
+            return None
+        left = self.deadline - time.monotonic()
+        if left <= 0:
+            raise GeocodeDeadlineExceeded('Out of time after %sms.' % self.deadline_ms)
+        return left
+
+    def fetch(self, address):
+        """Fetch `address` with the backend, within the time left if there's a budget."""
+        timeout = self.time_left()
+        start = time.monotonic()
+        response = self.backend.fetch(address) if timeout is None else self.backend.fetch(address, timeout=timeout)
+        self.last_fetch_duration = time.monotonic() - start
+        return response
+
+    def _for_raw(self, value):
+        """Another input's outcome, as if it had been geocoded for this one: the inputs only
+        differ in case and whitespace."""
+        if isinstance(value, dict):
+            return dict(value, raw=self.raw)
+        return self.raw
+
+    def _geocode_and_cache(self):
+        try:
+            value = self._geocode()
+        except forms.ValidationError as e:
+            geocode_cache.set_error(self.raw, e)
+            raise
+        except GeocodeUnavailable as e:
+            # Store the raw value rather than make the user wait, or fail their form.
+            logger.warning('Not geocoding %r: %s', self.raw, e)
+            return self.raw
+        # A string means Google couldn't be asked, or didn't answer; try again next time.
+        if isinstance(value, dict):
+            geocode_cache.set(self.raw, value)
+        return value
+
+    def _geocode(self):
+        value = self.raw
+        potential_errors = []
+        if not self.can_geocode():
+            return value
+        tries = {'raw': self.raw, 'formatted': ''}
+        for t in tries:
+            r = self.fetch(tries[t])
+            if r.status_code == requests.codes.ok:
+                try:
+                    value, potential_error = self.process_result(r)
+                except forms.ValidationError:
+                    if potential_errors:
+                        # The retry was no better; what was wrong with the first answer stands.
+                        break
+                    raise
+                if potential_error:
+                    potential_errors.append(potential_error)
+                    raw_subpremise = self.get_raw_subpremise(value['raw']).strip(',')
+                    if not raw_subpremise:
+                        # If the user wasn't trying to use a subpremise, all the following
+                        # strategies are meaningless.
+                        raise potential_error
+                    returned_subpremise = value.get('subpremise')
+                    if not returned_subpremise and settings.DJ_ADDRESS_IGNORE_MISSING_SUBPREMISE:
+                        if self.usable_data(value):
+                            metrics.record_subpremise_retry(self, 'ignore_missing')
+                            value['subpremise'] = raw_subpremise
+                            value['formatted'] = self.generate_formatted(value)
+                            potential_errors = []
+                            break
+                    if returned_subpremise:
+                        re_formatted = value['formatted'].replace(
+                            f'#{returned_subpremise}',
+                            f'#{raw_subpremise}'
+                        )
+                        if settings.DJ_ADDRESS_SUBPREMISE_GEOCODE_RETRY_WITH_REPLACE:
+                            retry_delay = getattr(settings, 'DJ_ADDRESS_SUBPREMISE_RETRY_DELAY', 0)
+                            left = self.time_left()
+                            if left is not None and left < retry_delay + self.last_fetch_duration:
+                                # Expecting the retry to take as long as the first request,
+                                # it would run out of time.
+                                raise GeocodeDeadlineExceeded(
+                                    'Only %.3fs left, not enough to retry with the subpremise.' % left)
+                            metrics.record_subpremise_retry(self, 'retry_with_replace')
+                            # Try again using the formatted address, and the subpremise from the
+                            # raw data. Rate limiting is handled by the session's backoff, but a
+                            # pause between the two requests can still be configured.
+                            tries['formatted'] = re_formatted
+                            if retry_delay:
+                                time.sleep(retry_delay)
+                        elif settings.DJ_ADDRESS_SUBPREMISE_REPLACE_ONLY:
+                            if self.usable_data(value):
+                                metrics.record_subpremise_retry(self, 'replace_only')
+                                value['subpremise'] = raw_subpremise
+                                value['formatted'] = re_formatted
+                                potential_errors = []
+                                break
+                else:
+                    break
+        if potential_errors:
+            # Raise the original error.
+            raise potential_errors[0]
+        return value
+
+
+class AsyncGeocoder:
+    """Geocodes many raw values concurrently with a geocoder backend (the configured one by
+    default), so results get the same checks and subpremise retries as the form field.
+
+    At most `concurrency` values are geocoded at once, and if `qps` is given the requests made
+    (including subpremise retries) are limited to that many per second by a token bucket, on top
+    of the geocoder's own rate limiter (such as `DJ_ADDRESS_GEOCODER_RATE_LIMITER`), if it has one.
+    Requests run on a thread pool using the shared HTTP session.
+    """
+
+    def __init__(self, geocoder=None, concurrency=10, qps=None, burst=None):
+        self.geocoder = geocoder if geocoder is not None else get_geocoder()
+        if qps:
+            self.geocoder = copy.copy(self.geocoder)
+            limiter = TokenBucket(qps, burst)
+            if self.geocoder.rate_limiter is not None:
+                # A limit shared with other processes still applies; `qps` can only lower it.
+                limiter = CombinedRateLimiter(limiter, self.geocoder.rate_limiter)
+            self.geocoder.rate_limiter = limiter
+        self.concurrency = concurrency
+
+    def _geocode(self, raw):
+        return self.geocoder.geocode(raw)
+
+    async def geocode(self, raw, executor=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self._geocode, raw)
+
+    async def geocode_many(self, raws, errors=ValidationError):
+        """Yield `(raw, value, error)` tuples in the order they complete. `value` is what
+        the geocoder returned, or None if it raised the exception in `error`, one of `errors`
+        (other exceptions are raised).
+
+        `raws` is consumed lazily, so only `concurrency` values are held at any time.
+        """
+        raws = iter(raws)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            async def run(raw):
+                try:
+                    return raw, await self.geocode(raw, executor), None
+                except errors as e:
+                    return raw, None, e
+
+            def fill():
+                while len(pending) < self.concurrency:
+                    try:
+                        raw = next(raws)
+                    except StopIteration:
+                        return
+                    pending.add(asyncio.ensure_future(run(raw)))
+
+            fill()
+            try:
+                while pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        pending.discard(task)
+                    fill()
+                    for task in done:
+                        yield task.result()
+            finally:
+                for task in pending:
+                    task.cancel()
@@ -0,0 +1,75 @@
+"""Geohash encoding (https://en.wikipedia.org/wiki/Geohash).
+
+A geohash names a latitude/longitude cell, each extra character dividing it into 32. Nearby
+points usually share a prefix, which is what makes them useful as database keys; points either
+side of a cell boundary don't, however close they are.
+"""
+
+__all__ = ['encode', 'bbox', 'next_prefix']
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DECODE = {c: i for i, c in enumerate(BASE32)}
+
+
+def encode(latitude, longitude, precision=9):
+    """Return the geohash of the cell of `precision` characters containing the point."""
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError('Invalid coordinates: %r, %r' % (latitude, longitude))
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude.
+        if even:
+            rng, coordinate = lng_range, longitude
+        else:
+            rng, coordinate = lat_range, latitude
+        mid = (rng[0] + rng[1]) / 2
+        if coordinate >= mid:
+            value = value * 2 + 1
+            rng[0] = mid
+        else:
+            value = value * 2
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def bbox(geohash):
+    """Return the `(min_latitude, min_longitude, max_latitude, max_longitude)` of a cell."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for char in geohash.lower():
+        try:
+            value = DECODE[char]
+        except KeyError:
+            raise ValueError('Invalid geohash: %r' % geohash)
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if value >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def next_prefix(prefix):
+    """Return the smallest geohash after every one starting with `prefix`, or None if there is
+    none, so that `prefix <= geohash < next_prefix(prefix)` finds the cell's geohashes."""
+    if any(char not in DECODE for char in prefix):
+        raise ValueError('Invalid geohash: %r' % prefix)
+    prefix = prefix.rstrip(BASE32[-1])
+    if not prefix:
+        return None
+    return prefix[:-1] + BASE32[DECODE[prefix[-1]] + 1]
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dj_address.models import Address
+
+
+class BackfillCommand(BaseCommand):
+    """Base class for commands filling in a computed `Address` column, in chunks.
+
+    Subclasses set `field`, the `fields` it's computed from, `missing` (a filter for the rows
+    that need it) and `compute(address)`, or `compute_chunk(chunk)` to work on a whole chunk.
+    """
+    field = None
+    fields = ()
+    missing = {}
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of addresses to update per transaction (default: 1000).',
+        )
+        parser.add_argument(
+            '--all', action='store_true', dest='recompute',
+            help='Recompute every %s, not only missing ones.' % self.field,
+        )
+
+    def compute(self, address):
+        raise NotImplementedError
+
+    def compute_chunk(self, chunk):
+        """Compute `field` for each address in `chunk`, returning those to update."""
+        for address in chunk:
+            self.compute(address)
+        return chunk
+
+    def handle(self, *args, chunk_size, recompute, **options):
+        queryset = Address.objects.all() if recompute else Address.objects.filter(**self.missing)
+        queryset = queryset.only(*self.fields, self.field)
+        # Walk the table by pk rather than by offset, so each chunk is a cheap range scan and
+        # rows updated by earlier chunks don't shift later ones.
+        last_pk = 0
+        updated = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+            if not chunk:
+                break
+            changed = self.compute_chunk(chunk)
+            with transaction.atomic():
+                Address.objects.bulk_update(changed, [self.field])
+            last_pk = chunk[-1].pk
+            updated += len(changed)
+            if options['verbosity'] > 1:
+                self.stdout.write('Updated %d addresses (up to pk %s)' % (updated, last_pk))
+        self.stdout.write(self.style.SUCCESS('Updated %d addresses.' % updated))
+        self.report()
+
+    def report(self):
+        pass
@@ -0,0 +1,37 @@
+from dj_address.management.backfill import BackfillCommand
+from dj_address.models import Address
+
+
+class Command(BackfillCommand):
+    help = 'Compute the lookup fingerprint of addresses saved before it was added.'
+    field = 'fingerprint'
+    fields = ('street_number', 'route', 'subpremise', 'locality_id', 'raw')
+    missing = {'fingerprint': ''}
+
+    def handle(self, *args, **options):
+        self.duplicates = 0
+        super().handle(*args, **options)
+
+    def compute_chunk(self, chunk):
+        # Fingerprints are unique: an address whose fingerprint another row already holds, or one
+        # earlier in the chunk, is a duplicate and is left without one, for
+        # merge_duplicate_addresses. Rows keeping the fingerprint they have go first.
+        current = {address.pk: address.fingerprint for address in chunk}
+        chunk = sorted(chunk, key=lambda a: (a.set_fingerprint() != current[a.pk], a.pk))
+        taken = set(Address.objects.filter(
+            fingerprint__in={address.fingerprint for address in chunk},
+        ).exclude(pk__in=current).values_list('fingerprint', flat=True))
+        for address in chunk:
+            if address.fingerprint in taken:
+                address.fingerprint = ''
+                self.duplicates += 1
+            else:
+                taken.add(address.fingerprint)
+        return [address for address in chunk if address.fingerprint != current[address.pk]]
+
+    def report(self):
+        if self.duplicates:
+            self.stdout.write(self.style.WARNING(
+                'Left %d duplicate addresses without a fingerprint; '
+                'merge them with merge_duplicate_addresses.' % self.duplicates
+            ))
@@ -0,0 +1,11 @@
+from dj_address.management.backfill import BackfillCommand
+
+
+class Command(BackfillCommand):
+    help = 'Compute the geohash of addresses with coordinates saved before it was added.'
+    field = 'geohash'
+    fields = ('latitude', 'longitude')
+    missing = {'geohash': '', 'latitude__isnull': False, 'longitude__isnull': False}
+
+    def compute(self, address):
+        address.set_geohash()
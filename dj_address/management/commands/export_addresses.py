@@ -0,0 +1,222 @@
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from dj_address.models import Address, Country
+
+
+# Output columns, named as in `Address.as_dict`, and the lookups they're read from. Reading
+# them with `values_list` joins the hierarchy into each chunk's query.
+COLUMNS = (
+    ('id', 'id'),
+    ('street_number', 'street_number'),
+    ('route', 'route'),
+    ('subpremise', 'subpremise'),
+    ('raw', 'raw'),
+    ('formatted', 'formatted'),
+    ('latitude', 'latitude'),
+    ('longitude', 'longitude'),
+    ('locality', 'locality__name'),
+    ('postal_code', 'locality__postal_code'),
+    ('state', 'locality__state__name'),
+    ('state_code', 'locality__state__code'),
+    ('country', 'locality__state__country__name'),
+    ('country_code', 'locality__state__country__code'),
+)
+FIELD_NAMES = [name for name, _ in COLUMNS]
+FLOAT_COLUMNS = ('latitude', 'longitude')
+
+
+class JSONLWriter:
+    binary = False
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, rows):
+        self.stream.writelines(json.dumps(dict(zip(FIELD_NAMES, row))) + '\n' for row in rows)
+
+    def close(self):
+        pass
+
+
+class CSVWriter:
+    binary = False
+
+    def __init__(self, stream):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(FIELD_NAMES)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Writes each chunk as a Parquet row group. Needs pyarrow."""
+    binary = True
+
+    def __init__(self, stream):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise CommandError('Parquet output requires pyarrow (pip install django-address[parquet]).')
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            (name, pyarrow.int64() if name == 'id' else
+             pyarrow.float64() if name in FLOAT_COLUMNS else pyarrow.string())
+            for name in FIELD_NAMES
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(stream, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema,
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'jsonl': JSONLWriter, 'csv': CSVWriter, 'parquet': ParquetWriter}
+
+
+def export(queryset, path, fmt, chunk_size):
+    """Write the addresses in `queryset` to `path` (or stdout for '-'), returning the number
+    written. Rows are read in chunks and written as they arrive, so memory use doesn't grow with
+    the table."""
+    writer_class = WRITERS[fmt]
+    rows = queryset.order_by('pk').values_list(*[lookup for _, lookup in COLUMNS]).iterator(chunk_size=chunk_size)
+    if path == '-':
+        stream = sys.stdout.buffer if writer_class.binary else sys.stdout
+        close = False
+    else:
+        stream = open(path, 'wb') if writer_class.binary else open(path, 'w', encoding='utf-8', newline='')
+        close = True
+    count = 0
+    try:
+        writer = writer_class(stream)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                writer.write(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            writer.write(chunk)
+            count += len(chunk)
+        writer.close()
+    finally:
+        if close:
+            stream.close()
+    return count
+
+
+def _country_addresses(country_id):
+    if country_id is None:
+        return Address.objects.filter(locality=None)
+    return Address.objects.filter(locality__state__country=country_id)
+
+
+def _export_country(task):
+    country_id, path, fmt, chunk_size = task
+    return path, export(_country_addresses(country_id), path, fmt, chunk_size)
+
+
+def _export_country_worker(task):
+    try:
+        return _export_country(task)
+    finally:
+        connections.close_all()
+
+
+def _file_names(countries):
+    """Name each country's file after its code, falling back to its name, and to its pk where
+    codes are shared (see `Country.code`)."""
+    names = {}
+    for country in countries:
+        name = re.sub(r'[^\w.-]+', '_', country.code or country.name)
+        if not name or name in names.values() or name == 'unidentified':
+            name = '%s-%d' % (name or 'country', country.pk)
+        names[country.pk] = name
+    return names
+
+
+class Command(BaseCommand):
+    help = 'Export addresses, with their locality, state and country, to JSON lines, CSV or Parquet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help='The file to write, or - for standard output. A directory with --split-by-country.',
+        )
+        parser.add_argument(
+            '--format', choices=sorted(WRITERS),
+            help='The output format. Defaults to the file extension, or jsonl.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of rows fetched per query and written at a time (default: 2000).',
+        )
+        parser.add_argument(
+            '--split-by-country', action='store_true',
+            help='Write a file per country, plus unidentified.<format> for addresses without one.',
+        )
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Number of worker processes exporting countries in parallel with --split-by-country.',
+        )
+
+    def handle(self, *args, output, chunk_size, **options):
+        fmt = options['format']
+        if fmt is None:
+            ext = os.path.splitext(output)[1].lstrip('.').lower()
+            fmt = ext if ext in WRITERS else 'jsonl'
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+        self.verbosity = options['verbosity']
+        start = time.monotonic()
+        if options['split_by_country']:
+            if output == '-':
+                raise CommandError('--split-by-country needs an output directory.')
+            count = self.export_by_country(output, fmt, chunk_size, options['processes'])
+        else:
+            count = export(Address.objects.all(), output, fmt, chunk_size)
+        elapsed = time.monotonic() - start
+        # Keep the summary out of the data when that's going to stdout.
+        stream = self.stderr if output == '-' else self.stdout
+        stream.write('Exported %d addresses in %.1fs.' % (count, elapsed))
+
+    def export_by_country(self, directory, fmt, chunk_size, processes):
+        os.makedirs(directory, exist_ok=True)
+        tasks = [
+            (pk, os.path.join(directory, '%s.%s' % (name, fmt)), fmt, chunk_size)
+            for pk, name in _file_names(Country.objects.order_by('pk')).items()
+        ]
+        tasks.append((None, os.path.join(directory, 'unidentified.%s' % fmt), fmt, chunk_size))
+        if processes > 1:
+            # Forked workers mustn't share the parent's database connections.
+            connections.close_all()
+            with multiprocessing.Pool(processes) as pool:
+                results = list(pool.imap_unordered(_export_country_worker, tasks))
+        else:
+            results = [_export_country(task) for task in tasks]
+        total = 0
+        for path, count in sorted(results):
+            if self.verbosity > 1:
+                self.stdout.write('%s: %d addresses' % (path, count))
+            total += count
+        return total
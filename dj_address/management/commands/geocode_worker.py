@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from dj_address.dedupe import merge
+from dj_address.geocoders import AsyncGeocoder
+from dj_address.models import Address, GeocodeJob, resolve_in_place
+
+
+class Command(BaseCommand):
+    help = (
+        'Geocode the addresses queued by AddressField(enqueue=True), claiming jobs in batches so '
+        'several workers can share the queue, and update each address in place.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of jobs claimed at a time (default: 100).',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=10,
+            help='Number of concurrent geocoding requests (default: 10).',
+        )
+        parser.add_argument(
+            '--qps', type=float,
+            help='Limit geocoding requests to this many per second, within any shared rate limit.',
+        )
+        parser.add_argument(
+            '--lease', type=int, default=300,
+            help='Seconds before a job claimed by a worker that never finished it can be claimed '
+                 'again (default: 300).',
+        )
+        parser.add_argument(
+            '--max-attempts', type=int, default=5,
+            help='Drop a job after this many attempts that got no answer or raised an error, '
+                 'leaving the address flagged needs_geocode (default: 5).',
+        )
+        parser.add_argument(
+            '--flagged', action='store_true',
+            help='First queue the addresses flagged needs_geocode that have no job.',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the queue is empty, rather than waiting for more jobs.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=5,
+            help='Seconds to wait before checking an empty queue again (default: 5).',
+        )
+
+    def handle(self, *args, batch_size, lease, once, **options):
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        self.geocoder = AsyncGeocoder(concurrency=options['workers'], qps=options['qps'])
+        self.max_attempts = options['max_attempts']
+        self.verbosity = options['verbosity']
+        self.stats = {'geocoded': 0, 'merged': 0, 'failed': 0, 'retried': 0, 'dropped': 0}
+        if options['flagged']:
+            flagged = Address.objects.filter(needs_geocode=True, geocode_job=None)
+            queued = GeocodeJob.objects.bulk_create([GeocodeJob(address=address) for address in flagged.iterator()])
+            self.stdout.write('Queued %d flagged addresses.' % len(queued))
+
+        try:
+            while True:
+                jobs = GeocodeJob.objects.claim(batch_size, lease=lease)
+                if jobs:
+                    self.run_batch(jobs)
+                    continue
+                if once:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            'Geocoded %(geocoded)d addresses, merging %(merged)d into existing ones; %(failed)d could not be '
+            'geocoded, %(retried)d will be retried and %(dropped)d were dropped.' % self.stats))
+
+    def run_batch(self, jobs):
+        raws = {job.address.raw for job in jobs}
+
+        async def geocode():
+            # Any error is kept to its own job, so the rest of the batch still gets done.
+            return {
+                raw: (value, error)
+                async for raw, value, error in self.geocoder.geocode_many(raws, errors=Exception)
+            }
+
+        results = asyncio.run(geocode())
+        for job in jobs:
+            value, error = results[job.address.raw]
+            try:
+                if isinstance(error, ValidationError):
+                    self.fail(job, '; '.join(error.messages))
+                elif error is not None:
+                    self.retry(job, error)
+                elif isinstance(value, dict):
+                    self.update(job, value)
+                else:
+                    self.retry(job)
+            except Exception as e:
+                self.retry(job, e)
+        if self.verbosity > 1:
+            totals = ', '.join('%s %d' % item for item in self.stats.items())
+            self.stdout.write('%d jobs done, in all: %s' % (len(jobs), totals))
+
+    def update(self, job, value):
+        """Update the job's address, or merge it into the stored address matching the result."""
+        address = job.address
+        with transaction.atomic():
+            found = resolve_in_place(address, value)
+            job.delete()
+            if found.pk != address.pk:
+                merge(Address, [[found.pk, address.pk]])
+                self.stats['merged'] += 1
+        self.stats['geocoded'] += 1
+
+    def fail(self, job, message):
+        """The result wasn't good enough to use, and won't be next time: keep the raw value."""
+        if self.verbosity > 1:
+            self.stderr.write('Could not geocode %r: %s' % (job.address.raw, message))
+        with transaction.atomic():
+            Address.objects.filter(pk=job.address_id).update(needs_geocode=False)
+            job.delete()
+        self.stats['failed'] += 1
+
+    def retry(self, job, error=None):
+        """There was no answer (rate limited or out of quota, say), or `error` was raised; try
+        again after the lease, unless the job has had `max_attempts` already."""
+        if error is not None:
+            message = '%s: %s' % (type(error).__name__, error)
+            if self.verbosity > 1:
+                self.stderr.write('Error geocoding %r: %s' % (job.address.raw, message))
+        else:
+            message = 'No answer.'
+        if job.attempts >= self.max_attempts:
+            job.delete()
+            self.stats['dropped'] += 1
+            return
+        job.release('%s (attempt %d)' % (message, job.attempts))
+        self.stats['retried'] += 1
@@ -0,0 +1,242 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from dj_address.geocoders import AsyncGeocoder
+from dj_address.models import bulk_to_python
+
+
+FLOAT_FIELDS = ('latitude', 'longitude')
+
+# What a single bad record can raise while being resolved: an over-long country or state code,
+# a value that isn't an address, or one the database won't store.
+RECORD_ERRORS = (ValueError, ValidationError, DatabaseError)
+
+
+def read_csv(stream):
+    """Yield a `(line number, dict)` pair per row, the dict keyed by the header row."""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, {key: value for key, value in row.items() if key is not None}
+
+
+def read_jsonl(stream):
+    """Yield a `(line number, value)` pair for each non-blank line, the value an object of
+    address components or a raw string."""
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            raise CommandError('Invalid JSON on line %d: %s' % (number, e))
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def clean_record(record):
+    """Make a record look like a submitted form value: lat/long as floats, or None."""
+    if isinstance(record, dict):
+        for field in FLOAT_FIELDS:
+            if field in record:
+                value = record[field]
+                if value in ('', None):
+                    record[field] = None
+                else:
+                    try:
+                        record[field] = float(value)
+                    except (TypeError, ValueError):
+                        raise ValueError('Invalid value for %s: %r' % (field, value))
+    return record
+
+
+def needs_geocode(record):
+    """Whether the form field would geocode `record`: a raw string, or a dict with nothing but
+    a raw value."""
+    if isinstance(record, str):
+        return bool(record)
+    if isinstance(record, dict):
+        return bool(record.get('raw')) and not any(v for k, v in record.items() if k != 'raw')
+    return False
+
+
+class Command(BaseCommand):
+    help = (
+        'Import addresses from a CSV or JSON lines file, resolving them the same way as values '
+        'assigned to an AddressField.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The file to import, or - for standard input.')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='The input format. Defaults to the file extension.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of records resolved per transaction (default: 1000).',
+        )
+        parser.add_argument(
+            '--geocode', action='store_true',
+            help='Geocode records that only have a raw value, as the form field does.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=10,
+            help='Number of concurrent geocoding requests (default: 10).',
+        )
+        parser.add_argument(
+            '--qps', type=float,
+            help='Limit geocoding requests to this many per second, within any shared rate limit.',
+        )
+        parser.add_argument(
+            '--stop-on-error', action='store_true',
+            help='Stop at a record that can\'t be imported, instead of skipping it.',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='A file recording how many records have been imported or skipped. If it exists, '
+                 'the import resumes after that many records.',
+        )
+
+    def handle(self, *args, path, batch_size, checkpoint, **options):
+        fmt = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if fmt not in READERS:
+            raise CommandError('Unknown input format %r, use --format.' % fmt)
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        self.geocoder = AsyncGeocoder(
+            concurrency=options['workers'], qps=options['qps']) if options['geocode'] else None
+        self.verbosity = options['verbosity']
+        self.stop_on_error = options['stop_on_error']
+        self.geocoded = self.geocode_failures = self.skipped = 0
+
+        done = self.read_checkpoint(checkpoint)
+        if path == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        else:
+            stream = open(path, encoding='utf-8', newline='')
+        with stream:
+            records = READERS[fmt](stream)
+            if done:
+                self.stdout.write('Resuming after %d records.' % done)
+                for _ in islice(records, done):
+                    pass
+            imported = 0
+            start = time.monotonic()
+            while True:
+                batch = list(islice(records, batch_size))
+                if not batch:
+                    break
+                imported += self.import_batch(batch)
+                # Skipped records count as done, so resuming doesn't stop at them again.
+                done += len(batch)
+                self.write_checkpoint(checkpoint, done)
+                if self.verbosity > 0:
+                    self.report(imported, start)
+
+        elapsed = time.monotonic() - start
+        summary = 'Imported %d records in %.1fs (%.0f/s).' % (
+            imported, elapsed, imported / elapsed if elapsed else 0)
+        if self.geocoder is not None:
+            summary += ' Geocoded %d, %d could not be geocoded.' % (self.geocoded, self.geocode_failures)
+        if self.skipped:
+            summary += ' Skipped %d invalid records.' % self.skipped
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def import_batch(self, batch):
+        """Import a batch of `(line number, record)` pairs, returning how many were imported."""
+        lines, records = [], []
+        for line, record in batch:
+            try:
+                records.append(clean_record(record))
+            except ValueError as e:
+                self.skip(line, e)
+                continue
+            lines.append(line)
+        if self.geocoder is not None:
+            self.geocode_batch(records)
+        try:
+            bulk_to_python(records)
+        except RECORD_ERRORS:
+            # One bad record rolls back the whole batch: import the rest one at a time.
+            imported = 0
+            for line, record in zip(lines, records):
+                try:
+                    bulk_to_python([record])
+                except RECORD_ERRORS as e:
+                    self.skip(line, e)
+                else:
+                    imported += 1
+            return imported
+        return len(records)
+
+    def skip(self, line, error):
+        self.skipped += 1
+        message = '; '.join(error.messages) if isinstance(error, ValidationError) else str(error)
+        if self.stop_on_error:
+            raise CommandError('Could not import the record on line %d: %s' % (line, message))
+        if self.verbosity > 0:
+            self.stderr.write('Skipped the record on line %d: %s' % (line, message))
+
+    def geocode_batch(self, batch):
+        """Replace raw-only records with their geocoded components. Records that can't be
+        geocoded keep their raw value, as they would when submitted through the form."""
+        raws = {record if isinstance(record, str) else record['raw'] for record in batch if needs_geocode(record)}
+        if not raws:
+            return
+
+        async def geocode():
+            results = {}
+            async for raw, value, error in self.geocoder.geocode_many(raws):
+                # The geocoder hands back the raw value itself when it couldn't ask (too few
+                # words to geocode, rate limited or out of time).
+                if isinstance(value, dict):
+                    results[raw] = value
+                    self.geocoded += 1
+                else:
+                    self.geocode_failures += 1
+                    if error is not None and self.verbosity > 1:
+                        self.stderr.write('Could not geocode %r: %s' % (raw, '; '.join(error.messages)))
+            return results
+
+        results = asyncio.run(geocode())
+        for i, record in enumerate(batch):
+            if needs_geocode(record):
+                value = results.get(record if isinstance(record, str) else record['raw'])
+                if value is not None:
+                    batch[i] = clean_record(dict(value))
+
+    def report(self, imported, start):
+        elapsed = time.monotonic() - start
+        self.stdout.write('%d records imported (%.0f/s)' % (imported, imported / elapsed if elapsed else 0))
+
+    @staticmethod
+    def read_checkpoint(path):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            try:
+                return int(f.read().strip() or 0)
+            except ValueError:
+                raise CommandError('Invalid checkpoint file %s.' % path)
+
+    @staticmethod
+    def write_checkpoint(path, done):
+        # Written after each batch commits, and replaced atomically, so a crash at worst
+        # re-imports the batch in flight, which resolves to the same rows again.
+        if not path:
+            return
+        tmp = '%s.tmp' % path
+        with open(tmp, 'w') as f:
+            f.write('%d\n' % done)
+        os.replace(tmp, path)
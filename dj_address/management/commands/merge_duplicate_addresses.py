@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from dj_address.dedupe import find_duplicate_addresses, find_duplicate_localities, merge
+from dj_address.models import Address, Locality
+
+
+class Command(BaseCommand):
+    help = (
+        'Merge duplicate addresses, repointing every foreign key to them at the address kept, '
+        'and optionally duplicate localities first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report what would be merged without changing anything.',
+        )
+        parser.add_argument(
+            '--localities', action='store_true',
+            help='Merge localities differing only in case, punctuation or spacing first.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=300,
+            help='Number of rows deleted per transaction (default: 300).',
+        )
+        parser.add_argument(
+            '--max-block-size', type=int, default=1000,
+            help='Skip comparing candidates that share a blocking key with more than this many others '
+                 '(default: 1000).',
+        )
+
+    def handle(self, *args, dry_run, batch_size, max_block_size, **options):
+        self.verbosity = options['verbosity']
+        if options['localities']:
+            groups = find_duplicate_localities(max_block_size=max_block_size)
+            self.report(Locality, groups, merge(Locality, groups, batch_size, dry_run), dry_run)
+        groups = find_duplicate_addresses(max_block_size=max_block_size)
+        self.report(Address, groups, merge(Address, groups, batch_size, dry_run), dry_run)
+
+    def report(self, model, groups, stats, dry_run):
+        name = model._meta.verbose_name_plural.lower()
+        if self.verbosity > 1:
+            for group in groups:
+                self.stdout.write('  keep %s, merge %s' % (group[0], ', '.join(str(pk) for pk in group[1:])))
+        self.stdout.write('%s %d duplicate %s in %d groups.' % (
+            'Would merge' if dry_run else 'Merged', stats['deleted'], name, stats['groups']))
+        for label, count in sorted(stats['references'].items()):
+            if count:
+                self.stdout.write('  %s: %d references %s' % (label, count, 'to repoint' if dry_run else 'repointed'))
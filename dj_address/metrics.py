@@ -0,0 +1,191 @@
+"""Instrumentation: where the time goes in resolving and geocoding addresses.
+
+Each event is sent as a Django signal and, if `DJ_ADDRESS_METRICS_SINK` names one, recorded in a
+metrics sink built with the keyword arguments in `DJ_ADDRESS_METRICS_SINK_OPTIONS`:
+
+- `address_resolved` (sender `Address`) for each `to_python` call, with `value_type`,
+  `duration` in seconds and the number of `queries` made; metrics `to_python` and
+  `to_python.queries`.
+- `geocode_requested` (sender the geocoder's class) for each request to a geocoding API, with
+  the `status` code, `duration` in seconds and the number of `retries` the session made;
+  metrics `geocode.request` and `geocode.request.retries`.
+- `subpremise_retried` (sender `GeocodeRaw`) for each subpremise workaround taken, with its
+  `branch`; metric `geocode.subpremise`.
+- `cache_accessed` (sender the cache's class) for each lookup in the hierarchy and geocode
+  caches, with the `cache` name and `result`; metrics `cache.hierarchy` and `cache.geocode`.
+
+With no sink and no receivers connected to a signal, its event costs a couple of attribute
+lookups; nothing is timed and queries aren't counted.
+"""
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+
+__all__ = [
+    'address_resolved', 'geocode_requested', 'subpremise_retried', 'cache_accessed',
+    'MemorySink', 'StatsdSink', 'get_sink', 'reset_sink',
+]
+
+
+address_resolved = Signal()
+geocode_requested = Signal()
+subpremise_retried = Signal()
+cache_accessed = Signal()
+
+
+class MemorySink:
+    """Keeps metrics in memory, for tests or for inspecting them from a shell."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def timing(self, name, ms, tags=None):
+        with self._lock:
+            self.timings[name].append((ms, dict(tags or {})))
+
+    def incr(self, name, value=1, tags=None):
+        with self._lock:
+            self.counters[name, tuple(sorted((tags or {}).items()))] += value
+
+    def count(self, name, **tags):
+        """The total of the counter `name`, across all tags or only those matching `tags`."""
+        return sum(
+            value for (counter, counter_tags), value in self.counters.items()
+            if counter == name and tags.items() <= dict(counter_tags).items()
+        )
+
+    def times(self, name, **tags):
+        """The timings recorded for `name`, in ms, across all tags or only those matching `tags`."""
+        return [ms for ms, timing_tags in self.timings[name] if tags.items() <= timing_tags.items()]
+
+    def clear(self):
+        with self._lock:
+            self.timings = defaultdict(list)
+            self.counters = defaultdict(int)
+
+
+class StatsdSink:
+    """Sends metrics to a statsd server over UDP, prefixed with `prefix`.
+
+    Tags are sent in the DogStatsD format if `dogstatsd` is set; plain statsd has no tags, so
+    their values are appended to the metric's name instead, e.g. `geocode.request.200`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='dj_address', dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind, tags):
+        if self.prefix:
+            name = '%s.%s' % (self.prefix, name)
+        if tags and not self.dogstatsd:
+            name = '.'.join([name] + [str(tag) for _, tag in sorted(tags.items())])
+        line = '%s:%s|%s' % (name, value, kind)
+        if tags and self.dogstatsd:
+            line += '|#' + ','.join('%s:%s' % item for item in sorted(tags.items()))
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except OSError:
+            # Metrics are best effort; never let them break a request.
+            pass
+
+    def timing(self, name, ms, tags=None):
+        self._send(name, '%.3f' % ms, 'ms', tags)
+
+    def incr(self, name, value=1, tags=None):
+        self._send(name, value, 'c', tags)
+
+
+_UNSET = object()
+_sink = _UNSET
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """Return the sink named by `DJ_ADDRESS_METRICS_SINK`, or None. It's built once and shared."""
+    global _sink
+    if _sink is _UNSET:
+        with _sink_lock:
+            if _sink is _UNSET:
+                path = getattr(settings, 'DJ_ADDRESS_METRICS_SINK', None)
+                options = getattr(settings, 'DJ_ADDRESS_METRICS_SINK_OPTIONS', {})
+                _sink = import_string(path)(**options) if path else None
+    return _sink
+
+
+def reset_sink():
+    global _sink
+    with _sink_lock:
+        _sink = _UNSET
+
+
+def enabled(signal):
+    """Whether there's anything to record `signal`'s events."""
+    return bool(signal.receivers) or get_sink() is not None
+
+
+def _count_queries(counter):
+    def wrapper(execute, sql, params, many, context):
+        counter[0] += 1
+        return execute(sql, params, many, context)
+    return wrapper
+
+
+@contextmanager
+def resolving(value, using):
+    """Time the `to_python` call in the block, counting its queries on the connection `using`."""
+    from django.db import connections
+    from .models import Address
+
+    counter = [0]
+    start = time.perf_counter()
+    with connections[using].execute_wrapper(_count_queries(counter)):
+        yield
+    duration = time.perf_counter() - start
+    value_type = type(value).__name__
+    sink = get_sink()
+    if sink is not None:
+        sink.timing('to_python', duration * 1000, {'value_type': value_type})
+        sink.incr('to_python.queries', counter[0], {'value_type': value_type})
+    address_resolved.send(sender=Address, value_type=value_type, duration=duration, queries=counter[0])
+
+
+def record_geocode_request(geocoder, response, duration):
+    status = response.status_code
+    # urllib3 keeps the Retry object behind the response, its history the attempts retried.
+    retry = getattr(getattr(response, 'raw', None), 'retries', None)
+    retries = len(retry.history) if retry is not None else 0
+    sink = get_sink()
+    if sink is not None:
+        sink.timing('geocode.request', duration * 1000, {'status': status})
+        if retries:
+            sink.incr('geocode.request.retries', retries, {'status': status})
+    geocode_requested.send(sender=type(geocoder), status=status, duration=duration, retries=retries)
+
+
+def record_subpremise_retry(geocode_raw, branch):
+    if not enabled(subpremise_retried):
+        return
+    sink = get_sink()
+    if sink is not None:
+        sink.incr('geocode.subpremise', tags={'branch': branch})
+    subpremise_retried.send(sender=type(geocode_raw), raw=geocode_raw.raw, branch=branch)
+
+
+def record_cache_access(cache, name, result):
+    if not enabled(cache_accessed):
+        return
+    sink = get_sink()
+    if sink is not None:
+        sink.incr('cache.%s' % name, tags={'result': result})
+    cache_accessed.send(sender=type(cache), cache=name, result=result)
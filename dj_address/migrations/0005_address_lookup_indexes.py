@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0003_auto_20190222_2348'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['locality', 'route', 'street_number', 'subpremise'], name='dj_address_components_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['raw'], name='dj_address_raw_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(('locality', None)), fields=['raw'], name='dj_address_unidentified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='locality',
+            index=models.Index(fields=['postal_code'], name='dj_address_postal_code_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0006_address_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['latitude', 'longitude'], name='dj_address_lat_lng_idx'),
+        ),
+    ]
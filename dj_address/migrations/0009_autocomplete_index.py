@@ -0,0 +1,91 @@
+from django.db import migrations
+from django.db.utils import DatabaseError
+
+
+# Keep the FTS5 index in step with the address table. Migrations that rebuild the table on
+# SQLite drop these triggers, so they have to be created again afterwards; see 0013.
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER dj_address_address_fts_insert AFTER INSERT ON dj_address_address BEGIN "
+    "INSERT INTO dj_address_address_fts(rowid, formatted) VALUES (new.id, new.formatted); END",
+    "CREATE TRIGGER dj_address_address_fts_delete AFTER DELETE ON dj_address_address BEGIN "
+    "INSERT INTO dj_address_address_fts(dj_address_address_fts, rowid, formatted) "
+    "VALUES ('delete', old.id, old.formatted); END",
+    "CREATE TRIGGER dj_address_address_fts_update AFTER UPDATE OF formatted ON dj_address_address BEGIN "
+    "INSERT INTO dj_address_address_fts(dj_address_address_fts, rowid, formatted) "
+    "VALUES ('delete', old.id, old.formatted); "
+    "INSERT INTO dj_address_address_fts(rowid, formatted) VALUES (new.id, new.formatted); END",
+]
+
+# An FTS5 index of Address.formatted, its rowids the address pks, kept in step by triggers.
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE dj_address_address_fts USING fts5("
+    "formatted, content='dj_address_address', content_rowid='id')",
+    *SQLITE_TRIGGERS,
+    "INSERT INTO dj_address_address_fts(dj_address_address_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    'DROP TRIGGER IF EXISTS dj_address_address_fts_insert',
+    'DROP TRIGGER IF EXISTS dj_address_address_fts_delete',
+    'DROP TRIGGER IF EXISTS dj_address_address_fts_update',
+    'DROP TABLE IF EXISTS dj_address_address_fts',
+]
+
+POSTGRESQL_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX dj_address_formatted_trgm ON dj_address_address USING gin (formatted gin_trgm_ops)',
+    'CREATE INDEX dj_address_locality_name_trgm ON dj_address_locality USING gin (name gin_trgm_ops)',
+]
+
+POSTGRESQL_REVERSE = [
+    'DROP INDEX IF EXISTS dj_address_formatted_trgm',
+    'DROP INDEX IF EXISTS dj_address_locality_name_trgm',
+]
+
+
+def _execute(schema_editor, statements):
+    """Run `statements` in a savepoint, skipping them if the database can't: SQLite built without
+    FTS5, or PostgreSQL without the pg_trgm extension or the rights to create it. Autocomplete
+    falls back to its in-memory index then."""
+    connection = schema_editor.connection
+    try:
+        with connection.cursor() as cursor:
+            sid = connection.savepoint() if connection.in_atomic_block else None
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+            except DatabaseError:
+                if sid:
+                    connection.savepoint_rollback(sid)
+                raise
+            if sid:
+                connection.savepoint_commit(sid)
+    except DatabaseError:
+        pass
+
+
+def forward(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _execute(schema_editor, SQLITE_FORWARD)
+    elif vendor == 'postgresql':
+        _execute(schema_editor, POSTGRESQL_FORWARD)
+
+
+def reverse(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _execute(schema_editor, SQLITE_REVERSE)
+    elif vendor == 'postgresql':
+        _execute(schema_editor, POSTGRESQL_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0008_address_geohash'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, reverse),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-16 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0009_autocomplete_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='needs_geocode',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(('needs_geocode', True)), fields=['needs_geocode'], name='dj_address_needs_geocode_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-16 21:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0010_address_needs_geocode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('claimed_by', models.CharField(blank=True, db_index=True, max_length=32)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('address', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='geocode_job', to='dj_address.address')),
+            ],
+            options={
+                'ordering': ('pk',),
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+def exempt_duplicates(apps, schema_editor):
+    """Blank the fingerprints of all but the first of any duplicate addresses, so the constraint
+    can be added. They're still found by their components, and by `find_duplicate_addresses`."""
+    Address = apps.get_model('dj_address', 'Address')
+    addresses = Address.objects.using(schema_editor.connection.alias)
+    duplicates = addresses.exclude(fingerprint='').values('fingerprint').annotate(
+        count=models.Count('pk'), first=models.Min('pk')).filter(count__gt=1)
+    for row in duplicates.iterator():
+        addresses.filter(fingerprint=row['fingerprint']).exclude(pk=row['first']).update(fingerprint='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0011_geocodejob'),
+    ]
+
+    operations = [
+        migrations.RunPython(exempt_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(condition=models.Q(('fingerprint', ''), _negated=True),
+                                               fields=('fingerprint',), name='dj_address_unique_fingerprint'),
+        ),
+    ]
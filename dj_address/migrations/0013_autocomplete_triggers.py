@@ -0,0 +1,35 @@
+from importlib import import_module
+
+from django.db import migrations
+
+
+autocomplete_index = import_module('dj_address.migrations.0009_autocomplete_index')
+
+
+def recreate_triggers(apps, schema_editor):
+    """Adding `needs_geocode` in 0010 rebuilt the address table on SQLite, dropping the triggers
+    that keep the FTS5 index up to date. Create them again, and catch the index up with the rows
+    saved without them."""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dj_address_address_fts'")
+        if cursor.fetchone() is None:
+            # Not created by 0009: this SQLite hasn't got FTS5.
+            return
+    autocomplete_index._execute(schema_editor, [
+        *[s for s in autocomplete_index.SQLITE_REVERSE if s.startswith('DROP TRIGGER')],
+        *autocomplete_index.SQLITE_TRIGGERS,
+        "INSERT INTO dj_address_address_fts(dj_address_address_fts) VALUES ('rebuild')",
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0012_address_unique_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_triggers, migrations.RunPython.noop),
+    ]
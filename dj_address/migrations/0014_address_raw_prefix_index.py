@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:22
+
+import dj_address.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0013_autocomplete_triggers'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='address',
+            name='dj_address_components_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='address',
+            name='dj_address_raw_idx',
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(dj_address.models.RawPrefix('raw'), name='dj_address_raw_prefix_idx'),
+        ),
+    ]
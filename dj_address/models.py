@@ -1,131 +1,533 @@
+import datetime
+import hashlib
 import logging
+import math
+import uuid
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import signals
+from django.db.models.functions import ASin, Cos, Least, Radians, Sin, Sqrt, Substr
+from django.utils import timezone
 
 from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
 
+from . import geohash as _geohash
+from . import metrics
+from .cache import hierarchy_cache
+
 
 logger = logging.getLogger(__name__)
 
 
-__all__ = ['Country', 'State', 'Locality', 'Address', 'AddressField']
+__all__ = [
+    'Country', 'State', 'Locality', 'Address', 'AddressField', 'BulkAddressMixin', 'BulkAddressQuerySet',
+    'GeocodeJob', 'resolve_pending_addresses', 'resolve_in_place',
+]
 
 
 class InconsistentDictError(Exception):
     pass
 
 
-def _to_python(value):
-    raw = value.get('raw', '')
-    country = value.get('country', '')
-    country_code = value.get('country_code', '')
-    state = value.get('state', '')
-    state_code = value.get('state_code', '')
-    locality = value.get('locality', '')
-    sublocality = value.get('sublocality', '')
-    postal_code = value.get('postal_code', '')
-    street_number = value.get('street_number', '')
-    route = value.get('route', '')
-    subpremise = value.get('subpremise', '')
-    formatted = value.get('formatted', '')
-    latitude = value.get('latitude', None)
-    longitude = value.get('longitude', None)
-
-    if not raw:
+def _code_for_create(model, code, name):
+    """Return the code to store on a new `Country` or `State`. Google sometimes hands back the
+    full name as the code, in which case it's dropped rather than truncated."""
+    if len(code) > model._meta.get_field('code').max_length:
+        if code != name:
+            raise ValueError('Invalid %s code (too long): %s' % (model._meta.model_name, code))
+        return ''
+    return code
+
+
+# Backends whose upsert syntax (`INSERT ... ON CONFLICT ... RETURNING`) `_upsert` speaks.
+UPSERT_VENDORS = ('postgresql', 'sqlite')
+
+
+def _fingerprint_fallback():
+    # Rows saved before fingerprints were added have an empty one until they're backfilled.
+    return getattr(settings, 'DJ_ADDRESS_FINGERPRINT_FALLBACK', True)
+
+
+# Rows without a fingerprint yet are found by raw value through an index on this many leading
+# characters, which tells nearly all addresses apart at a fraction of the size of the full column.
+RAW_PREFIX_LENGTH = 20
+
+
+class RawPrefix(models.Func):
+    """The first `RAW_PREFIX_LENGTH` characters of a value, as `dj_address_raw_prefix_idx`
+    indexes them. Unlike `Substr` the bounds are written into the SQL rather than passed as
+    parameters, which query planners can't match against an index expression."""
+    function = 'SUBSTR'
+    template = '%%(function)s(%%(expressions)s, 1, %d)' % RAW_PREFIX_LENGTH
+    output_field = models.CharField()
+
+
+def _normalize(value):
+    return ' '.join(str(value).split()).casefold() if value else ''
+
+
+def _fingerprint(street_number, route, subpremise, locality_id, raw):
+    """Hash an address's components, ignoring case and whitespace, or its raw value if it has no
+    components. The two are prefixed differently so a raw value never matches a decomposed
+    address."""
+    if street_number or route or subpremise or locality_id:
+        parts = ['c', _normalize(street_number), _normalize(route), _normalize(subpremise), str(locality_id)]
+    else:
+        parts = ['r', _normalize(raw)]
+    return hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def _upsert(connection, model, lookup, defaults):
+    """Insert a row, or fetch the one already matching `lookup`, without racing concurrent
+    writers.
+
+    The insert is `ON CONFLICT DO NOTHING`, so finding an existing row doesn't write to (and lock)
+    it; when the insert returns nothing the row is fetched instead. `lookup` must match a unique
+    constraint on `model`.
+
+    The row is inserted without calling `save()`, but `pre_save` and `post_save` are sent as
+    `objects.create()` would send them, the latter only if the row was inserted.
+    """
+    meta = model._meta
+    qn = connection.ops.quote_name
+    values = dict(lookup, **defaults)
+    obj = model(**values)
+    signals.pre_save.send(sender=model, instance=obj, raw=False, using=connection.alias, update_fields=None)
+    fields = [meta.get_field(name) for name in values]
+    params = [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields]
+    returning = meta.concrete_fields
+    sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT DO NOTHING RETURNING %s' % (
+        qn(meta.db_table),
+        ', '.join(qn(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+        ', '.join(qn(field.column) for field in returning),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    if row is not None:
+        stored = model.from_db(connection.alias, [field.attname for field in returning], row)
+        for field in returning:
+            setattr(obj, field.attname, getattr(stored, field.attname))
+        obj._state.adding = False
+        obj._state.db = connection.alias
+        signals.post_save.send(sender=model, instance=obj, created=True, raw=False, using=connection.alias,
+                               update_fields=None)
+        return obj
+    obj = model._default_manager.using(connection.alias).get(**lookup)
+    # Keep hold of any parents we were given so they don't have to be fetched again.
+    for field in fields:
+        value = values[field.name]
+        if field.is_relation and isinstance(value, models.Model) and value.pk == getattr(obj, field.attname):
+            setattr(obj, field.name, value)
+    return obj
+
+
+def _get_or_create(model, lookup, defaults):
+    """Fetch the row matching `lookup`, creating it from `defaults` if it doesn't exist, without
+    racing concurrent writers. Where the database supports it this is a single upsert; elsewhere
+    it's Django's `get_or_create`, which fetches the winner's row after an IntegrityError."""
+    connection = connections[router.db_for_write(model)]
+    if connection.vendor in UPSERT_VENDORS and connection.features.can_return_rows_from_bulk_insert:
+        return _upsert(connection, model, lookup, defaults)
+    return model.objects.get_or_create(defaults=defaults, **lookup)[0]
+
+
+def _find(model, lookup):
+    try:
+        return model.objects.get(**lookup)
+    except model.DoesNotExist:
+        return None
+
+
+def _get_hierarchy_obj(model, lookup, defaults=None, code=None):
+    """Find or create the `Country`, `State` or `Locality` matching `lookup`. Rows are never
+    created without a name; an over-long `code` is only an error if the row has to be created."""
+    if not lookup['name']:
+        return _find(model, lookup)
+    defaults = dict(defaults or {})
+    if code is not None:
+        try:
+            defaults['code'] = _code_for_create(model, code, lookup['name'])
+        except ValueError:
+            obj = _find(model, lookup)
+            if obj is None:
+                raise
+            return obj
+    return _get_or_create(model, lookup, defaults)
+
+
+def _get_country(country, country_code):
+    key = ('country', country)
+    country_obj = hierarchy_cache.get(key)
+    if country_obj is None:
+        country_obj = _get_hierarchy_obj(Country, {'name': country}, code=country_code)
+        if country_obj is not None:
+            hierarchy_cache.add_on_commit(key, country_obj)
+    return country_obj
+
+
+def _get_state(state, state_code, country_obj):
+    key = ('state', state, country_obj.pk if country_obj else None)
+    state_obj = hierarchy_cache.get(key)
+    if state_obj is None:
+        state_obj = _get_hierarchy_obj(State, {'name': state, 'country': country_obj}, code=state_code)
+        if state_obj is not None:
+            hierarchy_cache.add_on_commit(key, state_obj)
+    return state_obj
+
+
+def _get_locality(locality, postal_code, state_obj):
+    key = ('locality', locality, postal_code, state_obj.pk if state_obj else None)
+    locality_obj = hierarchy_cache.get(key)
+    if locality_obj is None:
+        locality_obj = _get_hierarchy_obj(
+            Locality, {'name': locality, 'postal_code': postal_code, 'state': state_obj})
+        if locality_obj is not None:
+            hierarchy_cache.add_on_commit(key, locality_obj)
+    return locality_obj
+
+
+def _clean_components(value):
+    """Pull the address components out of `value`, applying the fallbacks shared by the single
+    and bulk resolution paths. Returns None if there is no raw value."""
+    components = {
+        'raw': value.get('raw', ''),
+        'country': value.get('country', ''),
+        'country_code': value.get('country_code', ''),
+        'state': value.get('state', ''),
+        'state_code': value.get('state_code', ''),
+        'locality': value.get('locality', ''),
+        'postal_code': value.get('postal_code', ''),
+        'street_number': value.get('street_number', ''),
+        'route': value.get('route', ''),
+        'subpremise': value.get('subpremise', ''),
+        'formatted': value.get('formatted', ''),
+        'latitude': value.get('latitude', None),
+        'longitude': value.get('longitude', None),
+    }
+    if not components['raw']:
         return None
 
     # Fix issue with NYC boroughs (https://code.google.com/p/gmaps-api-issues/issues/detail?id=635)
-    if not locality and sublocality:
-        locality = sublocality
+    sublocality = value.get('sublocality', '')
+    if not components['locality'] and sublocality:
+        components['locality'] = sublocality
 
     # If we have an inconsistent set of value bail out now.
+    country, state, locality = components['country'], components['state'], components['locality']
     if (country or state or locality) and not (country and state and locality):
         raise InconsistentDictError
+    return components
 
-    # Handle the country.
-    try:
-        country_obj = Country.objects.get(name=country)
-    except Country.DoesNotExist:
-        if country:
-            if len(country_code) > Country._meta.get_field('code').max_length:
-                if country_code != country:
-                    raise ValueError('Invalid country code (too long): %s' % country_code)
-                country_code = ''
-            country_obj = Country.objects.create(name=country, code=country_code)
-        else:
-            country_obj = None
 
-    # Handle the state.
-    try:
-        state_obj = State.objects.get(name=state, country=country_obj)
-    except State.DoesNotExist:
-        if state:
-            if len(state_code) > State._meta.get_field('code').max_length:
-                if state_code != state:
-                    raise ValueError('Invalid state code (too long): %s' % state_code)
-                state_code = ''
-            state_obj = State.objects.create(name=state, code=state_code, country=country_obj)
-        else:
-            state_obj = None
+def _has_address_components(c):
+    return bool(c['street_number'] or c['route'] or c['locality'] or c['subpremise'])
 
-    # Handle the locality.
-    try:
-        locality_obj = Locality.objects.get(name=locality, postal_code=postal_code, state=state_obj)
-    except Locality.DoesNotExist:
-        if locality:
-            locality_obj = Locality.objects.create(name=locality, postal_code=postal_code, state=state_obj)
-        else:
-            locality_obj = None
+
+def _new_address(c, locality_obj):
+    address_obj = Address(
+        street_number=c['street_number'],
+        route=c['route'],
+        subpremise=c['subpremise'],
+        raw=c['raw'],
+        locality=locality_obj,
+        formatted=c['formatted'],
+        latitude=c['latitude'],
+        longitude=c['longitude'],
+    )
+    # If "formatted" is empty try to construct it from other values.
+    if not address_obj.formatted:
+        address_obj.formatted = str(address_obj)
+    return address_obj
+
+
+def _find_legacy(queryset, address_obj):
+    """Return the first row in `queryset` without a fingerprint yet that matches `address_obj`
+    exactly."""
+    queryset = queryset.filter(fingerprint='').order_by('pk')
+    if address_obj.has_components():
+        return queryset.filter(**{
+            f: getattr(address_obj, f) for f in ('street_number', 'route', 'subpremise', 'locality')
+        }).first()
+    return _fetch_raw(queryset, [address_obj.raw]).get(address_obj.raw)
+
+
+def _find_or_save(address_obj):
+    """Return the stored address with the same fingerprint as `address_obj`, saving
+    `address_obj` if there isn't one."""
+    fingerprint = address_obj.set_fingerprint()
+    found = Address.objects.filter(fingerprint=fingerprint).order_by('pk').first()
+    if found is None and _fingerprint_fallback():
+        found = _find_legacy(Address.objects.all(), address_obj)
+    if found is not None:
+        return found
+    # Fingerprints are unique, so a concurrent writer saving the same address can't duplicate it.
+    address_obj.set_geohash()
+    defaults = {
+        field.name: getattr(address_obj, field.name)
+        for field in Address._meta.concrete_fields if not field.primary_key and field.name != 'fingerprint'
+    }
+    return _get_or_create(Address, {'fingerprint': fingerprint}, defaults)
+
+
+def _to_python(value):
+    c = _clean_components(value)
+    if c is None:
+        return None
+
+    country_obj = _get_country(c['country'], c['country_code'])
+    state_obj = _get_state(c['state'], c['state_code'], country_obj)
+    locality_obj = _get_locality(c['locality'], c['postal_code'], state_obj)
 
     # Handle the address.
+    return _find_or_save(_new_address(c, locality_obj))
+
+
+def resolve_in_place(address_obj, value):
+    """Fill in the stored `address_obj` from `value`, a dict of address components, by the same
+    rules as `to_python`, keeping its pk so everything referring to it sees the change.
+
+    If another stored address already has those components, it's returned instead and
+    `address_obj` is left as it was, for the caller to merge. The raw value is kept either way.
+    """
     try:
-        if not (street_number or route or locality or subpremise):
-            address_obj = Address.objects.get(raw=raw)
-        else:
-            address_obj = Address.objects.get(
-                street_number=street_number,
-                route=route,
-                subpremise=subpremise,
-                locality=locality_obj
-            )
-    except Address.DoesNotExist:
-        address_obj = Address(
-            street_number=street_number,
-            route=route,
-            subpremise=subpremise,
-            raw=raw,
-            locality=locality_obj,
-            formatted=formatted,
-            latitude=latitude,
-            longitude=longitude,
-        )
-        # If "formatted" is empty try to construct it from other values.
-        if not address_obj.formatted:
-            address_obj.formatted = str(address_obj)
-        address_obj.save()
+        c = _clean_components(dict(value, raw=address_obj.raw))
+    except InconsistentDictError:
+        c = None
+    if c is None:
+        # Nothing better than the raw value; that's what `to_python` would store too.
+        Address.objects.filter(pk=address_obj.pk).update(needs_geocode=False)
+        address_obj.needs_geocode = False
+        return address_obj
+
+    country_obj = _get_country(c['country'], c['country_code'])
+    state_obj = _get_state(c['state'], c['state_code'], country_obj)
+    locality_obj = _get_locality(c['locality'], c['postal_code'], state_obj)
+    new_obj = _new_address(c, locality_obj)
+    others = Address.objects.exclude(pk=address_obj.pk).order_by('pk')
+    found = others.filter(fingerprint=new_obj.set_fingerprint()).first()
+    if found is None and _fingerprint_fallback():
+        found = _find_legacy(others, new_obj)
+    if found is not None:
+        return found
+    for field in ('street_number', 'route', 'subpremise', 'locality', 'formatted', 'latitude', 'longitude'):
+        setattr(address_obj, field, getattr(new_obj, field))
+    address_obj.needs_geocode = False
+    address_obj.save()
     return address_obj
 
 
 def to_python(value):
     """Convert a dictionary to an address."""
+    if not metrics.enabled(metrics.address_resolved):
+        return _resolve(value)
+    with metrics.resolving(value, router.db_for_write(Address)):
+        return _resolve(value)
+
+
+def _resolve(value):
     # If value is None, or of type Address or int, it should be returned as-is.
     # Int because it is likely a model primary key. Strings are raw values, and
     # dicts are assumed to contain address components. Anything else is invalid.
     if value is None or isinstance(value, Address) or isinstance(value, int):
         return value
     elif isinstance(value, (str, bytes)):
-        obj = Address(raw=value)
-        obj.save()
-        return obj
+        return _find_or_save(Address(raw=value))
     elif isinstance(value, dict):
         try:
             return _to_python(value)
         except InconsistentDictError:
-            return Address.objects.create(raw=value['raw'])
+            return _find_or_save(Address(raw=value['raw']))
     raise ValidationError('Invalid dj_address value.')
 
 
+# Keep the number of parameters in each `__in` query well under SQLite's limit.
+BULK_QUERY_CHUNK_SIZE = 500
+
+
+def _chunks(items, size=BULK_QUERY_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _bulk_fetch(queryset, keys, key_fields):
+    """Return a `{key: obj}` dict of the rows in `queryset` whose `key_fields` values match one
+    of `keys`. Matching is finished in Python so `None`s line up with NULL columns."""
+    found = {}
+    for chunk in _chunks(keys):
+        filters = models.Q()
+        for i, field in enumerate(key_fields):
+            values = {key[i] for key in chunk}
+            q = models.Q(**{'%s__in' % field: [v for v in values if v is not None]})
+            if None in values:
+                q |= models.Q(**{'%s__isnull' % field: True})
+            filters &= q
+        wanted = set(chunk)
+        for obj in queryset.filter(filters).order_by('pk'):
+            key = tuple(getattr(obj, field) for field in key_fields)
+            if key in wanted:
+                found.setdefault(key, obj)
+    return found
+
+
+def _fetch_raw(queryset, raws):
+    """Return a `{raw: obj}` dict of the first rows in `queryset` (by pk) with one of `raws`.
+
+    Only the indexed prefix is compared in SQL and the rest in Python: SQLite substitutes the value
+    of an exact `raw` comparison into the prefix expression, which then no longer matches the index.
+    """
+    found = {}
+    wanted = set(raws)
+    queryset = queryset.alias(raw_prefix=RawPrefix('raw')).order_by('pk')
+    for chunk in _chunks(sorted({raw[:RAW_PREFIX_LENGTH] for raw in wanted})):
+        for obj in queryset.filter(raw_prefix__in=chunk):
+            if obj.raw in wanted:
+                found.setdefault(obj.raw, obj)
+    return found
+
+
+def _bulk_get_or_create(model, keys, key_fields, new_obj):
+    """Fetch the rows of `model` for `keys`, inserting those missing with `new_obj(key)` (which
+    may return None for keys that shouldn't be created). Conflicting inserts from concurrent
+    writers are ignored and picked up by the second fetch."""
+    found = _bulk_fetch(model.objects.all(), keys, key_fields)
+    missing = [obj for obj in (new_obj(key) for key in keys if key not in found) if obj is not None]
+    if missing:
+        model.objects.bulk_create(missing, batch_size=BULK_QUERY_CHUNK_SIZE, ignore_conflicts=True)
+        found.update(_bulk_fetch(model.objects.all(), [k for k in keys if k not in found], key_fields))
+    return found
+
+
+def _bulk_fetch_legacy(address_objs):
+    """Find the rows without a fingerprint yet that match `address_objs`, returning a
+    `{fingerprint: obj}` dict keyed on the fingerprints of `address_objs`."""
+    found = {}
+    legacy = Address.objects.filter(fingerprint='')
+    component_fields = ('street_number', 'route', 'subpremise', 'locality_id')
+    with_components = {
+        tuple(getattr(obj, f) for f in component_fields): obj.fingerprint
+        for obj in address_objs if obj.has_components()
+    }
+    if with_components:
+        for key, obj in _bulk_fetch(legacy, list(with_components), component_fields).items():
+            found[with_components[key]] = obj
+    raw_only = {obj.raw: obj.fingerprint for obj in address_objs if not obj.has_components()}
+    if raw_only:
+        for key, obj in _fetch_raw(legacy, raw_only).items():
+            found[raw_only[key]] = obj
+    return found
+
+
+def bulk_to_python(values):
+    """Convert many values to addresses using the same rules as `to_python`, but resolving each
+    level of the hierarchy with a few set-based queries instead of one query per value.
+
+    Returns a list in the same order as `values`. The whole batch is resolved in a single
+    transaction, so an invalid value (e.g. an over-long country code) rolls back everything.
+    """
+    values = list(values)
+    results = [None] * len(values)
+    raw_only = []
+    components = []
+    for i, value in enumerate(values):
+        if value is None or isinstance(value, Address) or isinstance(value, int):
+            results[i] = value
+        elif isinstance(value, (str, bytes)):
+            raw_only.append((i, value))
+        elif isinstance(value, dict):
+            try:
+                c = _clean_components(value)
+            except InconsistentDictError:
+                raw_only.append((i, value['raw']))
+                continue
+            if c is not None:
+                components.append((i, c))
+        else:
+            raise ValidationError('Invalid dj_address value.')
+
+    with transaction.atomic(using=router.db_for_write(Address)):
+        # The first value seen for a new country or state decides its code, as it would when
+        # resolving the values one at a time.
+        country_codes, state_codes = {}, {}
+        for _, c in components:
+            country_codes.setdefault(c['country'], c['country_code'])
+        countries = _bulk_get_or_create(
+            Country, [(name,) for name in country_codes], ('name',),
+            lambda key: Country(name=key[0], code=_code_for_create(
+                Country, country_codes[key[0]], key[0])) if key[0] else None,
+        )
+
+        def country_id(c):
+            country_obj = countries.get((c['country'],))
+            return country_obj.pk if country_obj else None
+
+        for _, c in components:
+            state_codes.setdefault((c['state'], country_id(c)), c['state_code'])
+        states = _bulk_get_or_create(
+            State, list(state_codes), ('name', 'country_id'),
+            lambda key: State(name=key[0], country_id=key[1], code=_code_for_create(
+                State, state_codes[key], key[0])) if key[0] else None,
+        )
+
+        def state_id(c):
+            state_obj = states.get((c['state'], country_id(c)))
+            return state_obj.pk if state_obj else None
+
+        locality_keys = {(c['locality'], c['postal_code'], state_id(c)) for _, c in components}
+        localities = _bulk_get_or_create(
+            Locality, list(locality_keys), ('name', 'postal_code', 'state_id'),
+            lambda key: Locality(name=key[0], postal_code=key[1], state_id=key[2]) if key[0] else None,
+        )
+
+        # Hook up the parents we already hold so formatting new addresses needs no queries.
+        countries_by_pk = {obj.pk: obj for obj in countries.values()}
+        states_by_pk = {obj.pk: obj for obj in states.values()}
+        for state_obj in states.values():
+            if state_obj.country_id in countries_by_pk:
+                state_obj.country = countries_by_pk[state_obj.country_id]
+        for obj in localities.values():
+            if obj.state_id in states_by_pk:
+                obj.state = states_by_pk[obj.state_id]
+
+        def get_locality(c):
+            return localities.get((c['locality'], c['postal_code'], state_id(c)))
+
+        # Addresses are matched on their fingerprints, the first value seen for each deciding
+        # what a new row contains.
+        candidates = {}
+        fingerprints = {}
+        for i, c in components:
+            address_obj = _new_address(c, get_locality(c))
+            fingerprints[i] = candidates.setdefault(address_obj.set_fingerprint(), address_obj).fingerprint
+        for i, raw in raw_only:
+            address_obj = Address(raw=raw)
+            fingerprints[i] = candidates.setdefault(address_obj.set_fingerprint(), address_obj).fingerprint
+        addresses = _bulk_fetch(Address.objects.all(), [(fp,) for fp in candidates], ('fingerprint',))
+        missing = [fp for fp in candidates if (fp,) not in addresses]
+        if missing and _fingerprint_fallback():
+            for fp, address_obj in _bulk_fetch_legacy([candidates[fp] for fp in missing]).items():
+                addresses[(fp,)] = address_obj
+            missing = [fp for fp in missing if (fp,) not in addresses]
+        if missing:
+            for fp in missing:
+                candidates[fp].set_geohash()
+            Address.objects.bulk_create(
+                [candidates[fp] for fp in missing], batch_size=BULK_QUERY_CHUNK_SIZE, ignore_conflicts=True)
+            addresses.update(_bulk_fetch(Address.objects.all(), [(fp,) for fp in missing], ('fingerprint',)))
+
+        localities_by_pk = {obj.pk: obj for obj in localities.values()}
+        for address_obj in addresses.values():
+            if address_obj.locality_id in localities_by_pk:
+                address_obj.locality = localities_by_pk[address_obj.locality_id]
+        for i, fp in fingerprints.items():
+            results[i] = addresses[(fp,)]
+    return results
+
+
 class Country(models.Model):
     name = models.CharField(max_length=40, unique=True, blank=True)
     code = models.CharField(max_length=2, blank=True)  # not unique as there are duplicates (IT)
@@ -170,6 +572,9 @@ class Locality(models.Model):
         verbose_name_plural = 'Localities'
         unique_together = ('name', 'postal_code', 'state')
         ordering = ('state', 'name')
+        indexes = [
+            models.Index(fields=['postal_code'], name='dj_address_postal_code_idx'),
+        ]
 
     def __str__(self):
         txt = '%s' % self.name
@@ -185,6 +590,92 @@ class Locality(models.Model):
         return txt
 
 
+# The relations walked by `Address.__str__` and `Address.as_dict`.
+ADDRESS_COMPONENTS = 'locality__state__country'
+
+# The mean radius of the Earth, in km.
+EARTH_RADIUS_KM = 6371.0088
+
+# The length of `Address.geohash`, a cell a few cm across.
+GEOHASH_PRECISION = 12
+
+
+def _bounding_box(latitude, longitude, radius_km):
+    """Return `(min_lat, min_lng, max_lat, max_lng)` enclosing every point within `radius_km`
+    of the given one. Longitudes wrap, so `min_lng` may be greater than `max_lng`."""
+    delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat, max_lat = latitude - delta_lat, latitude + delta_lat
+    if min_lat <= -90 or max_lat >= 90:
+        # The circle contains a pole, so every longitude is in range.
+        return max(min_lat, -90.0), -180.0, min(max_lat, 90.0), 180.0
+    delta_lng = math.degrees(math.asin(math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(latitude))))
+    min_lng, max_lng = longitude - delta_lng, longitude + delta_lng
+    if min_lng < -180:
+        min_lng += 360
+    if max_lng > 180:
+        max_lng -= 360
+    return min_lat, min_lng, max_lat, max_lng
+
+
+def _haversine_km(latitude, longitude):
+    """An expression for the great-circle distance, in km, from each address to the point."""
+    lat = Radians('latitude')
+    d_lat = (lat - math.radians(latitude)) / 2
+    d_lng = (Radians('longitude') - math.radians(longitude)) / 2
+    a = Sin(d_lat) * Sin(d_lat) + math.cos(math.radians(latitude)) * Cos(lat) * Sin(d_lng) * Sin(d_lng)
+    # Rounding can push `a` just past 1 for antipodal points, outside ASin's domain.
+    return 2 * EARTH_RADIUS_KM * ASin(Sqrt(Least(a, models.Value(1.0))))
+
+
+class AddressQuerySet(models.QuerySet):
+
+    def with_components(self):
+        """Fetch each address's locality, state and country in the same query, so formatting a
+        list of addresses doesn't cost three more queries per address."""
+        return self.select_related(ADDRESS_COMPONENTS)
+
+    def bulk_resolve(self, values):
+        """Convert an iterable of address values (dicts, raw strings, addresses or pks) to
+        addresses in one go. See `bulk_to_python`."""
+        return bulk_to_python(values)
+
+    def within_bbox(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        """Filter to addresses inside the box. A `min_longitude` greater than `max_longitude`
+        means the box crosses the antimeridian."""
+        qs = self.filter(latitude__gte=min_latitude, latitude__lte=max_latitude)
+        if min_longitude <= max_longitude:
+            return qs.filter(longitude__gte=min_longitude, longitude__lte=max_longitude)
+        return qs.filter(models.Q(longitude__gte=min_longitude) | models.Q(longitude__lte=max_longitude))
+
+    def near(self, latitude, longitude, radius_km):
+        """Filter to addresses within `radius_km` of the point, nearest first, annotated with
+        their `distance` in km.
+
+        The exact distance is only computed for addresses inside the circle's bounding box,
+        which the index on `latitude` and `longitude` finds.
+        """
+        qs = self.within_bbox(*_bounding_box(latitude, longitude, radius_km))
+        return qs.annotate(distance=_haversine_km(latitude, longitude)).filter(
+            distance__lte=radius_km).order_by('distance')
+
+    def in_geohash(self, prefix):
+        """Filter to addresses in the geohash cell `prefix`.
+
+        This is a range on `geohash` rather than `startswith`, as SQLite can't use an index for
+        LIKE, and neither can PostgreSQL outside the C locale.
+        """
+        prefix = prefix.lower()
+        qs = self.exclude(geohash='').filter(geohash__gte=prefix)
+        upper = _geohash.next_prefix(prefix)
+        return qs.filter(geohash__lt=upper) if upper else qs
+
+    def count_by_geohash(self, precision):
+        """Count addresses by geohash cell of `precision` characters, as `{'cell', 'count'}`
+        dicts ordered by cell. Addresses without coordinates aren't counted."""
+        return self.exclude(geohash='').values(cell=Substr('geohash', 1, precision)).annotate(
+            count=models.Count('pk')).order_by('cell')
+
+
 class Address(models.Model):
     """An address. If for any reason we are unable to find a matching decomposed
      address we will store the raw address string in `raw`. """
@@ -202,11 +693,35 @@ class Address(models.Model):
     formatted = models.CharField(max_length=200, blank=True)
     latitude = models.FloatField(blank=True, null=True)
     longitude = models.FloatField(blank=True, null=True)
+    # A hash of the normalized components, or raw value, that addresses are looked up by.
+    fingerprint = models.CharField(max_length=40, blank=True, db_index=True, editable=False)
+    # The geohash of `latitude` and `longitude`, for grouping and filtering by area.
+    geohash = models.CharField(max_length=GEOHASH_PRECISION, blank=True, db_index=True, editable=False)
+    # Set on raw-only addresses that weren't geocoded when they were saved, but should be later.
+    needs_geocode = models.BooleanField(default=False)
+
+    objects = AddressQuerySet.as_manager()
 
     class Meta:
         verbose_name_plural = 'Addresses'
         ordering = ('locality', 'route', 'street_number', 'subpremise')
         # unique_together = ('locality', 'route', 'street_number')
+        constraints = [
+            # One row per address, so concurrent writers can't create duplicates. Rows without a
+            # fingerprint yet, and duplicates saved before the constraint, are left out.
+            models.UniqueConstraint(fields=['fingerprint'], condition=~models.Q(fingerprint=''),
+                                    name='dj_address_unique_fingerprint'),
+        ]
+        indexes = [
+            # Finds raw-only rows without a fingerprint yet; see `_fetch_raw`.
+            models.Index(RawPrefix('raw'), name='dj_address_raw_prefix_idx'),
+            # Backs the admin's "unidentified" filter. Backends without partial indexes skip it.
+            models.Index(fields=['raw'], condition=models.Q(locality=None), name='dj_address_unidentified_idx'),
+            models.Index(fields=['latitude', 'longitude'], name='dj_address_lat_lng_idx'),
+            # Finds the few addresses left to geocode later.
+            models.Index(fields=['needs_geocode'], condition=models.Q(needs_geocode=True),
+                         name='dj_address_needs_geocode_idx'),
+        ]
 
     def __str__(self):
         if self.formatted != '':
@@ -231,10 +746,44 @@ class Address(models.Model):
             txt = f'{self.raw}'
         return txt
 
+    def save(self, *args, **kwargs):
+        self.set_fingerprint()
+        others = Address.objects.using(kwargs.get('using') or router.db_for_write(Address, instance=self))
+        if others.filter(fingerprint=self.fingerprint).exclude(pk=self.pk).exists():
+            # Edited into (or saved as) a copy of another row: like duplicates left by merging
+            # localities, it's kept without a fingerprint for `merge_duplicate_addresses`.
+            self.fingerprint = ''
+        self.set_geohash()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'fingerprint', 'geohash'}
+        super().save(*args, **kwargs)
+
     def clean(self):
         if not self.raw:
             raise ValidationError('Addresses may not have a blank `raw` field.')
 
+    def has_components(self):
+        return bool(self.street_number or self.route or self.subpremise or self.locality_id)
+
+    def set_fingerprint(self):
+        """Update and return `fingerprint`. Needed before `bulk_create`, which skips `save`."""
+        self.fingerprint = _fingerprint(
+            self.street_number, self.route, self.subpremise, self.locality_id, self.raw)
+        return self.fingerprint
+
+    def set_geohash(self):
+        """Update and return `geohash`, which is blank without valid coordinates."""
+        if self.latitude is None or self.longitude is None:
+            self.geohash = ''
+        else:
+            try:
+                self.geohash = _geohash.encode(self.latitude, self.longitude, GEOHASH_PRECISION)
+            except ValueError:
+                # Out of range: the coordinates are still stored as given, as they always were.
+                self.geohash = ''
+        return self.geohash
+
     def as_dict(self):
         ad = dict(
             street_number=self.street_number,
@@ -257,32 +806,182 @@ class Address(models.Model):
         return ad
 
 
+class GeocodeJobQuerySet(models.QuerySet):
+
+    def enqueue(self, address):
+        """Queue `address` to be geocoded by the `geocode_worker` command, unless it already is,
+        flagging it `needs_geocode`."""
+        if not address.needs_geocode:
+            Address.objects.filter(pk=address.pk).update(needs_geocode=True)
+            address.needs_geocode = True
+        return self.get_or_create(address=address)[0]
+
+    def claim(self, limit, lease=300):
+        """Claim up to `limit` jobs for one worker: those nobody has claimed, or whose claim is
+        more than `lease` seconds old (its worker having died, presumably). Returns them with
+        their addresses."""
+        using = router.db_for_write(self.model)
+        token = uuid.uuid4().hex
+        now = timezone.now()
+        available = models.Q(claimed_at=None) | models.Q(claimed_at__lt=now - datetime.timedelta(seconds=lease))
+        candidates = self.using(using).filter(available).order_by('pk')
+        with transaction.atomic(using=using):
+            if connections[using].features.has_select_for_update_skip_locked:
+                # Workers skip the rows others are claiming rather than wait for them.
+                pks = list(candidates.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+                claimed = self.using(using).filter(pk__in=pks)
+            else:
+                # Without row locks (SQLite), checking the rows are still available in the UPDATE
+                # stops two workers claiming the same ones; writes are serialized.
+                pks = list(candidates.values_list('pk', flat=True)[:limit])
+                claimed = self.using(using).filter(available, pk__in=pks)
+            claimed.update(claimed_at=now, claimed_by=token, attempts=models.F('attempts') + 1)
+        return list(self.using(using).filter(claimed_by=token).select_related('address'))
+
+
+class GeocodeJob(models.Model):
+    """An address saved with just its raw value, waiting to be geocoded by a worker."""
+    address = models.OneToOneField(Address, on_delete=models.CASCADE, related_name='geocode_job')
+    created = models.DateTimeField(auto_now_add=True)
+    # When a worker last claimed the job. Unless it's finished, it can be claimed again once the
+    # claim is older than the worker's lease.
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # The claim of the worker holding the job, if one is.
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = GeocodeJobQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('pk',)
+
+    def __str__(self):
+        return self.address.raw
+
+    def release(self, error):
+        """Give the job back, to be retried once its claim has expired."""
+        self.claimed_by = ''
+        self.last_error = error
+        self.save(update_fields=['claimed_by', 'last_error'])
+
+
 class AddressDescriptor(ForwardManyToOneDescriptor):
 
+    def get_queryset(self, **hints):
+        queryset = super().get_queryset(**hints)
+        if self.field.with_components:
+            queryset = queryset.select_related(ADDRESS_COMPONENTS)
+        return queryset
+
+    def __get__(self, inst, cls=None):
+        if inst is not None and self.field.pending_attname in inst.__dict__:
+            self.field.resolve_pending(inst)
+        return super().__get__(inst, cls)
+
     def __set__(self, inst, value):
+        inst.__dict__.pop(self.field.pending_attname, None)
+        if self.field.lazy and isinstance(value, (str, bytes, dict)):
+            # Resolved when the instance is saved; see AddressField.pre_save.
+            super(AddressDescriptor, self).__set__(inst, None)
+            inst.__dict__[self.field.pending_attname] = value
+            return
         super(AddressDescriptor, self).__set__(inst, to_python(value))
 
 
 class AddressField(models.ForeignKey):
-    """A field for addresses in other models."""
+    """A field for addresses in other models.
+
+    With `with_components=True`, fetching the address also fetches its locality, state and
+    country, so `str(obj.address)` needs no further queries. Combined with
+    `prefetch_related('address')`, a list of N objects renders in two queries.
+
+    With `lazy=True`, assigning a dict or raw string doesn't look up or create the address
+    straight away: the value is kept pending until the object is saved (or the address is read),
+    so objects that are never saved cost no queries and leave no addresses behind.
+    """
     description = 'An dj_address'
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, with_components=False, lazy=False, **kwargs):
         kwargs['to'] = 'dj_address.Address'
         kwargs['on_delete'] = models.PROTECT
+        self.with_components = with_components
+        self.lazy = lazy
         super(AddressField, self).__init__(*args, **kwargs)
 
+    @property
+    def pending_attname(self):
+        return '_%s_pending' % self.name
+
+    def has_pending(self, model_instance):
+        return self.pending_attname in model_instance.__dict__
+
+    def resolve_pending(self, model_instance):
+        """Look up or create the address pending on `model_instance`, and assign it."""
+        value = model_instance.__dict__.pop(self.pending_attname)
+        setattr(model_instance, self.name, to_python(value))
+
+    def pre_save(self, model_instance, add):
+        if self.has_pending(model_instance):
+            self.resolve_pending(model_instance)
+        return super().pre_save(model_instance, add)
+
+    def clean(self, value, model_instance):
+        # A pending value isn't an address yet, or known to be valid, until it's saved.
+        if model_instance is not None and self.has_pending(model_instance):
+            return value
+        return super().clean(value, model_instance)
+
     def contribute_to_class(self, cls, name, private_only=False, **kwargs):
         super().contribute_to_class(cls, name, private_only=private_only, **kwargs)
         setattr(cls, self.name, AddressDescriptor(self))
 
-    # def deconstruct(self):
-    #     name, path, args, kwargs = super(AddressField, self).deconstruct()
-    #     del kwargs['to']
-    #     return name, path, args, kwargs
+    def deconstruct(self):
+        name, path, args, kwargs = super(AddressField, self).deconstruct()
+        if self.with_components:
+            kwargs['with_components'] = True
+        if self.lazy:
+            kwargs['lazy'] = True
+        return name, path, args, kwargs
 
     def formfield(self, **kwargs):
         from .forms import AddressField as AddressFormField
         defaults = dict(form_class=AddressFormField)
         defaults.update(kwargs)
         return super(AddressField, self).formfield(**defaults)
+
+
+def resolve_pending_addresses(objs, fields=None):
+    """Resolve the pending values of the lazy `AddressField`s on `objs` (limited to the `fields`
+    named, if given) with `bulk_to_python`, one batch per field, and assign the addresses."""
+    objs = list(objs)
+    if not objs:
+        return objs
+    for field in objs[0]._meta.concrete_fields:
+        if not isinstance(field, AddressField) or fields is not None and field.name not in fields:
+            continue
+        pending = [obj for obj in objs if field.has_pending(obj)]
+        if not pending:
+            continue
+        values = [obj.__dict__.pop(field.pending_attname) for obj in pending]
+        for obj, address in zip(pending, bulk_to_python(values)):
+            setattr(obj, field.name, address)
+    return objs
+
+
+class BulkAddressMixin:
+    """A QuerySet mixin for models with lazy `AddressField`s whose `bulk_create` and `bulk_update`
+    resolve all the objects' pending addresses together, in a few set-based queries, rather than
+    one object at a time."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = resolve_pending_addresses(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = resolve_pending_addresses(objs, fields)
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+
+class BulkAddressQuerySet(BulkAddressMixin, models.QuerySet):
+    pass
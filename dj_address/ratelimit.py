@@ -0,0 +1,189 @@
+"""Limiting how fast, and how much, geocoding APIs are called.
+
+`TokenBucket` limits the threads of one process. Limits shared by every process use
+`FileTokenBucket` (processes on one host, through a locked file) or `CacheRateLimiter` (any
+number of hosts, through a Django cache), and a `DailyQuota` caps the requests made in a day.
+`CombinedRateLimiter` applies several limits at once.
+"""
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from django.core.cache import caches
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+__all__ = ['TokenBucket', 'FileTokenBucket', 'CacheRateLimiter', 'CombinedRateLimiter', 'DailyQuota']
+
+
+class TokenBucket:
+    """A thread-safe token bucket allowing `rate` acquisitions per second on average, with bursts
+    of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """Take `tokens` if they're available and return 0, otherwise return how many seconds to
+        wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        return self._reserve(tokens) == 0
+
+    def acquire(self, tokens=1, timeout=None):
+        """Block until `tokens` are available. Returns False if that would take longer than
+        `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._reserve(tokens)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class FileTokenBucket(TokenBucket):
+    """A token bucket shared by every process on the host, kept in the file at `path` and
+    updated under an exclusive lock. Needs `fcntl`, so isn't available on Windows."""
+
+    def __init__(self, rate, capacity=None, path=None):
+        if fcntl is None:
+            raise RuntimeError('FileTokenBucket needs fcntl, which this platform lacks.')
+        super().__init__(rate, capacity)
+        self.path = path or os.path.join(tempfile.gettempdir(), 'dj_address_geocode.bucket')
+
+    def _reserve(self, tokens):
+        # Wall-clock time, as monotonic clocks aren't comparable between processes.
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                state = f.read().split()
+                now = time.time()
+                if len(state) == 2:
+                    available, updated = float(state[0]), float(state[1])
+                    available = min(self.capacity, available + max(0.0, now - updated) * self.rate)
+                else:
+                    available = self.capacity
+                if available >= tokens:
+                    available -= tokens
+                    wait = 0
+                else:
+                    wait = (tokens - available) / self.rate
+                f.seek(0)
+                f.truncate()
+                f.write('%r %r' % (available, now))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+class CacheRateLimiter(TokenBucket):
+    """Allows `rate` acquisitions in each second across every process sharing the Django cache
+    `alias`, counted with the cache's atomic `incr`. With Memcached or Redis that covers every
+    host; with the local-memory cache it only limits one process.
+
+    Unlike a token bucket these are fixed one-second windows, so up to twice `rate` can get
+    through around the turn of a second.
+    """
+
+    def __init__(self, rate, alias='default', key='dj_address:geocode:rate'):
+        super().__init__(rate)
+        self.alias = alias
+        self.key = key
+
+    def _reserve(self, tokens):
+        cache = caches[self.alias]
+        now = time.time()
+        window = int(now)
+        key = '%s:%d' % (self.key, window)
+        cache.add(key, 0, timeout=5)
+        try:
+            count = cache.incr(key, tokens)
+        except ValueError:
+            # Evicted between add() and incr().
+            cache.set(key, tokens, timeout=5)
+            count = tokens
+        if count <= self.rate:
+            return 0
+        return window + 1 - now
+
+
+class CombinedRateLimiter:
+    """Grants a token only once every one of `limiters` has, in turn: a process's own
+    `TokenBucket` on top of a limit shared by every process, say. A token taken from one limiter
+    is spent even if a later one runs out of time."""
+
+    def __init__(self, *limiters):
+        self.limiters = limiters
+
+    def try_acquire(self, tokens=1):
+        return all(limiter.try_acquire(tokens) for limiter in self.limiters)
+
+    def acquire(self, tokens=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for limiter in self.limiters:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not limiter.acquire(tokens, timeout=remaining):
+                return False
+        return True
+
+
+class DailyQuota:
+    """Counts the requests made each day (in UTC) in the Django cache `alias`, refusing more
+    than `limit`. Use a cache shared by every process for the limit to be a total."""
+
+    def __init__(self, limit, alias='default', key='dj_address:geocode:quota'):
+        self.limit = limit
+        self.alias = alias
+        self.key = key
+
+    def _key(self):
+        return '%s:%s' % (self.key, datetime.datetime.now(datetime.timezone.utc).date().isoformat())
+
+    def used(self):
+        return caches[self.alias].get(self._key(), 0)
+
+    def remaining(self):
+        return max(0, self.limit - self.used())
+
+    def try_consume(self, requests=1):
+        """Count `requests` against today's quota, returning False, and counting nothing, if
+        that would exceed it."""
+        cache = caches[self.alias]
+        key = self._key()
+        cache.add(key, 0, timeout=2 * 24 * 60 * 60)
+        try:
+            used = cache.incr(key, requests)
+        except ValueError:
+            cache.set(key, requests, timeout=2 * 24 * 60 * 60)
+            used = requests
+        if used > self.limit:
+            try:
+                cache.decr(key, requests)
+            except ValueError:
+                pass
+            return False
+        return True
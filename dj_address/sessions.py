@@ -0,0 +1,75 @@
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+__all__ = ['get_session', 'get_timeout', 'reset_session']
+
+
+# Responses worth retrying after a pause: rate limiting and transient server errors.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+
+def _build_session(retries=True):
+    retry = Retry(
+        # False rather than 0, so a timeout is raised as itself rather than as a MaxRetryError.
+        total=getattr(settings, 'DJ_ADDRESS_GEOCODE_RETRIES', 3) if retries else False,
+        backoff_factor=getattr(settings, 'DJ_ADDRESS_GEOCODE_BACKOFF_FACTOR', 0.5),
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=('GET',),
+        respect_retry_after_header=True,
+        # Hand the last response back instead of raising, so callers see the status code.
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=getattr(settings, 'DJ_ADDRESS_GEOCODE_POOL_SIZE', 10),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+def get_session(retries=True):
+    """Return the session shared by all geocoding requests in this process, so connections (and
+    their TLS handshakes) are reused. It's only used for simple GETs, which are safe to make from
+    several threads at once.
+
+    With `retries=False` it's a second shared session that makes a single attempt, for requests
+    that have to finish within a deadline.
+    """
+    session = _sessions.get(retries)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(retries)
+            if session is None:
+                session = _sessions[retries] = _build_session(retries)
+    return session
+
+
+def reset_session():
+    """Close the shared sessions; the next call to `get_session` builds a new one from the
+    current settings."""
+    with _session_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_timeout(limit=None):
+    """The `(connect, read)` timeout in seconds for geocoding requests, neither more than `limit`
+    if it's given."""
+    connect = getattr(settings, 'DJ_ADDRESS_GEOCODE_CONNECT_TIMEOUT', 3.05)
+    read = getattr(settings, 'DJ_ADDRESS_GEOCODE_READ_TIMEOUT', 10)
+    if limit is not None:
+        connect, read = min(connect, limit), min(read, limit)
+    return (connect, read)
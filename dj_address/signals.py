@@ -0,0 +1,38 @@
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import hierarchy_cache
+from .geocoders import reset_geocoder
+from .metrics import reset_sink
+from .models import Country, Locality, State
+from .sessions import reset_session
+
+
+@receiver(post_save, sender=Country)
+@receiver(post_save, sender=State)
+@receiver(post_save, sender=Locality)
+def invalidate_hierarchy_cache_on_save(sender, instance, created, **kwargs):
+    # A brand new row can't make any cached entry stale; anything else might have changed the
+    # values it was cached under, or those of its cached parents, so start again.
+    if not created:
+        hierarchy_cache.clear()
+
+
+@receiver(post_delete, sender=Country)
+@receiver(post_delete, sender=State)
+@receiver(post_delete, sender=Locality)
+def invalidate_hierarchy_cache_on_delete(sender, instance, **kwargs):
+    hierarchy_cache.clear()
+
+
+@receiver(setting_changed)
+def reset_geocoding_on_setting_change(setting, **kwargs):
+    # Mostly for tests using override_settings: the backend, session and metrics sink are built
+    # from settings once, so rebuild them when those change.
+    if setting.startswith('DJ_ADDRESS_GEOCODER'):
+        reset_geocoder()
+    elif setting.startswith('DJ_ADDRESS_METRICS_'):
+        reset_sink()
+    elif setting.startswith('DJ_ADDRESS_GEOCODE_'):
+        reset_session()
@@ -0,0 +1,120 @@
+"""Coalescing of identical calls that are in flight at the same time.
+
+`SingleFlight.do(key, func)` calls `func` once for all the threads asking for the same `key` at
+once: the first caller runs it, and the others wait and share its result or its exception.
+`CacheSingleFlight` does the same across processes sharing a Django cache, with a lock taken by
+the cache's atomic `add` and the outcome left in the cache for the waiting processes to pick up.
+"""
+import copy
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+
+
+__all__ = ['SingleFlight', 'CacheSingleFlight']
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one call per key at a time within a process. Calls waiting on another thread's get
+    its result, or a copy of the exception it raised."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, timeout=None):
+        """Return `func()`, or the result of the call already running for `key`, and whether it
+        was shared rather than made by this caller. Raises `TimeoutError` if the call running
+        doesn't finish within `timeout` seconds."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError('Waited %.3fs for the call in flight.' % timeout)
+            if call.error is not None:
+                # Each waiter raises its own copy, so their tracebacks don't pile up on one.
+                raise copy.copy(call.error)
+            return call.result, True
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class CacheSingleFlight:
+    """Runs one call per key at a time across the processes sharing the Django cache `alias`.
+
+    The caller that takes the key's lock runs `func` and leaves its result, or the
+    `ValidationError` it raised, in the cache for `result_timeout` seconds. The others poll for
+    that every `interval` seconds; if the lock is released without an outcome (`func` raised
+    something else) or isn't released within `lock_timeout` seconds, they call `func` themselves.
+    Results must be picklable.
+    """
+
+    def __init__(self, alias='default', lock_timeout=30, result_timeout=10, interval=0.05):
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+        self.result_timeout = result_timeout
+        self.interval = interval
+
+    def do(self, key, func, timeout=None):
+        """Return `func()`, or the result of the call another process made for `key`, and
+        whether it was shared. Raises `TimeoutError` if there's no outcome within `timeout`
+        seconds."""
+        cache = caches[self.alias]
+        lock_key, result_key = '%s:lock' % key, '%s:result' % key
+        start = time.monotonic()
+        waited = False
+        while not cache.add(lock_key, 1, timeout=self.lock_timeout):
+            waited = True
+            outcome = cache.get(result_key)
+            if outcome is not None:
+                return self._unpack(outcome)
+            elapsed = time.monotonic() - start
+            if timeout is not None and elapsed >= timeout:
+                raise TimeoutError('Waited %.3fs for the call in flight.' % timeout)
+            if elapsed >= self.lock_timeout:
+                return func(), False
+            time.sleep(self.interval)
+        try:
+            # Having waited, the lock may have been released just as the outcome was left.
+            outcome = cache.get(result_key) if waited else None
+            if outcome is not None:
+                return self._unpack(outcome)
+            # Otherwise anything there is left from an earlier call.
+            cache.delete(result_key)
+            try:
+                result = func()
+            except ValidationError as e:
+                cache.set(result_key, ('error', e), self.result_timeout)
+                raise
+            cache.set(result_key, ('value', result), self.result_timeout)
+            return result, False
+        finally:
+            cache.delete(lock_key)
+
+    @staticmethod
+    def _unpack(outcome):
+        kind, payload = outcome
+        if kind == 'error':
+            raise payload
+        return payload, True
@@ -1,32 +1,96 @@
 $(function () {
+	var cmp_names = [
+		'country',
+		'country_code',
+		'locality',
+		'postal_code',
+		'route',
+		'subpremise',
+		'street_number',
+		'state',
+		'state_code',
+		'formatted',
+		'latitude',
+		'longitude',
+	];
+
 	$('input.address').each(function () {
 		var self = $(this);
 		var cmps = $('#' + self.attr('name') + '_components');
 		var fmtd = $('input[name="' + self.attr('name') + '_formatted"]');
-		self.geocomplete({
-			details: cmps,
-			detailsAttribute: 'data-geo'
-		}).change(function () {
-			if (self.val() != fmtd.val()) {
-				var cmp_names = [
-					'country',
-					'country_code',
-					'locality',
-					'postal_code',
-					'route',
-					'subpremise',
-					'street_number',
-					'state',
-					'state_code',
-					'formatted',
-					'latitude',
-					'longitude',
-				];
+		var url = self.data('autocomplete-url');
 
+		function component(name) {
+			return $('input[name="' + self.attr('name') + '_' + name + '"]');
+		}
+
+		function geocomplete() {
+			if (!self.data('geocomplete-started')) {
+				self.data('geocomplete-started', true);
+				self.geocomplete({
+					details: cmps,
+					detailsAttribute: 'data-geo'
+				});
+			}
+		}
+
+		self.change(function () {
+			if (self.val() != fmtd.val()) {
 				for (var ii = 0; ii < cmp_names.length; ++ii) {
-					$('input[name="' + self.attr('name') + '_' + cmp_names[ii] + '"]').val('');
+					component(cmp_names[ii]).val('');
 				}
 			}
 		});
+
+		if (!url) {
+			geocomplete();
+			return;
+		}
+
+		// Search stored addresses first, and only start Google's autocomplete when that finds
+		// nothing: a longer query won't find anything either.
+		var list = $('<ul class="address-autocomplete"></ul>').hide().insertAfter(self);
+		var timer = null;
+		var request = null;
+
+		function choose(result) {
+			var label = result.formatted || result.label;
+			for (var ii = 0; ii < cmp_names.length; ++ii) {
+				var value = result[cmp_names[ii]];
+				component(cmp_names[ii]).val(value === null || value === undefined ? '' : value);
+			}
+			fmtd.val(label);
+			self.val(label);
+			list.hide().empty();
+		}
+
+		function show(results) {
+			list.empty();
+			$.each(results, function (ii, result) {
+				$('<li></li>').text(result.label).on('mousedown', function (event) {
+					event.preventDefault();
+					choose(result);
+				}).appendTo(list);
+			});
+			list.toggle(results.length > 0);
+		}
+
+		self.on('input', function () {
+			var query = self.val();
+			clearTimeout(timer);
+			timer = setTimeout(function () {
+				if (request) {
+					request.abort();
+				}
+				request = $.getJSON(url, {q: query}, function (data) {
+					show(data.results);
+					if (!data.results.length && query.length >= 3) {
+						geocomplete();
+					}
+				});
+			}, 150);
+		}).on('blur', function () {
+			list.hide();
+		});
 	});
 });
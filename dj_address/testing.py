@@ -0,0 +1,88 @@
+"""Helpers for exercising the geocoding code without a network connection."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+__all__ = ['StubGeocodeServer']
+
+
+class StubGeocodeServer:
+    """A local HTTP server that answers like the Google Geocoding API.
+
+    `responses` maps the `address` query parameter to the JSON payload to return; anything else
+    gets a `ZERO_RESULTS` payload. Status codes to send before answering normally can be queued
+    in `statuses`, e.g. `[503, 429]` to exercise retries. Use it as a context manager:
+
+        with StubGeocodeServer({'1 Main St': payload}) as server:
+            GoogleGeocoder(url=server.url).geocode(raw)
+    """
+
+    def __init__(self, responses=None, statuses=None, delay=0):
+        self.responses = dict(responses or {})
+        self.statuses = list(statuses or [])
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s/maps/api/geocode/json' % (host, port)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Otherwise the headers and body, written separately, wait on a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                with stub._lock:
+                    stub.requests.append(params)
+                    status = stub.statuses.pop(0) if stub.statuses else 200
+                if stub.delay:
+                    threading.Event().wait(stub.delay)
+                if status == 200:
+                    address = params.get('address', '').replace('+', ' ')
+                    payload = stub.responses.get(address, {'results': [], 'status': 'ZERO_RESULTS'})
+                else:
+                    payload = {'results': [], 'status': 'UNKNOWN_ERROR'}
+                body = json.dumps(payload).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped waiting, e.g. on a deadline.
+                    self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,112 @@
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from dj_address.autocomplete import (
+    FTS_TABLE, PrefixIndex, _supports_database_search, memory_index, reset_autocomplete_index, search,
+)
+from dj_address.models import Address, Country, Locality, State
+from dj_address.widgets import AddressWidget
+
+
+class PrefixIndexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.index = PrefixIndex([
+            (1, '1 Somewhere Street, Northcote VIC 3070'),
+            (2, '12 Somewhere Road, Fitzroy VIC 3065'),
+            (3, 'Northcote 3070'),
+            (4, ''),
+        ])
+
+    def test_search(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(sorted(self.index.search('somewhere')), [1, 2])
+        self.assertEqual(sorted(self.index.search('NORTH')), [1, 3])
+        self.assertEqual(self.index.search('some north'), [1])
+        self.assertEqual(self.index.search('12 somewhere'), [2])
+        self.assertEqual(self.index.search('nowhere'), [])
+        self.assertEqual(self.index.search(' , '), [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search('somewhere', limit=1)), 1)
+
+
+class AutocompleteTestCase(TestCase):
+
+    def setUp(self):
+        self.addCleanup(reset_autocomplete_index)
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.northcote = Locality.objects.create(name='Northcote', postal_code='3070', state=vic)
+        self.address = Address.objects.create(
+            street_number='1', route='Somewhere Street', locality=self.northcote, raw='x',
+            formatted='1 Somewhere Street, Northcote VIC 3070, Australia')
+        Address.objects.create(raw='Somewhere else')
+
+    def check_search(self):
+        results = search('somewhere north')
+        self.assertEqual([r['id'] for r in results], [self.address.pk])
+        self.assertEqual(results[0]['type'], 'address')
+        self.assertEqual(results[0]['state_code'], 'VIC')
+        self.assertEqual(results[0]['formatted'], self.address.formatted)
+        results = search('3070')
+        self.assertEqual([(r['type'], r['id']) for r in results],
+                         [('address', self.address.pk), ('locality', self.northcote.pk)])
+        self.assertEqual(results[1]['label'], 'Northcote, Victoria 3070, Australia')
+
+    def test_database(self):
+        if connection.vendor == 'sqlite':
+            # The migrated schema has the FTS index and its triggers, so that's what's searched.
+            self.assertTrue(_supports_database_search(connection))
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(len(search('somewhere street')), 1)
+            self.assertIn(FTS_TABLE, queries[0]['sql'])
+            # Kept in step with updates by the triggers.
+            Address.objects.filter(pk=self.address.pk).update(formatted='1 Somewhere St, Northcote')
+            self.assertEqual(search('street'), [])
+            Address.objects.filter(pk=self.address.pk).update(formatted=self.address.formatted)
+        with self.settings(DJ_ADDRESS_AUTOCOMPLETE_BACKEND='database'):
+            self.check_search()
+
+    @override_settings(DJ_ADDRESS_AUTOCOMPLETE_BACKEND='memory')
+    def test_memory(self):
+        self.check_search()
+        Address.objects.create(raw='x', formatted='3 Other Street, Northcote')
+        self.assertEqual(search('other'), [])
+        reset_autocomplete_index()
+        self.assertEqual(len(search('other')), 1)
+
+    @override_settings(DJ_ADDRESS_AUTOCOMPLETE_BACKEND='memory', DJ_ADDRESS_AUTOCOMPLETE_INDEX_MAX_ITEMS=2)
+    def test_memory_max_items(self):
+        newest = Address.objects.create(raw='y', formatted='3 Other Street, Northcote')
+        with self.assertLogs('dj_address.autocomplete', 'WARNING'):
+            self.assertEqual(len(memory_index.get()), 2)
+        # The locality and the newest address.
+        self.assertEqual([r['id'] for r in search('northcote')], [newest.pk, self.northcote.pk])
+
+    @override_settings(DJ_ADDRESS_AUTOCOMPLETE_BACKEND='memory', DJ_ADDRESS_AUTOCOMPLETE_INDEX_TTL=0)
+    def test_memory_stale_while_rebuilding(self):
+        index = memory_index.get()
+        # Another thread is rebuilding it, so the old one is searched meanwhile.
+        with memory_index._building:
+            self.assertIs(memory_index.get(), index)
+        self.assertIsNot(memory_index.get(), index)
+
+    def test_view(self):
+        url = reverse('dj_address:autocomplete')
+        response = self.client.get(url, {'q': 'somewhere'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['id'] for r in response.json()['results']], [self.address.pk])
+        self.assertEqual(self.client.get(url, {'q': 'so'}).json(), {'results': []})
+        self.assertEqual(len(self.client.get(url, {'q': 'northcote', 'limit': '1'}).json()['results']), 1)
+        self.assertEqual(len(self.client.get(url, {'q': 'northcote', 'limit': 'x'}).json()['results']), 2)
+        self.assertEqual(self.client.post(url, {'q': 'somewhere'}).status_code, 405)
+
+    def test_widget(self):
+        self.assertNotIn('data-autocomplete-url', AddressWidget().render('address', None))
+        html = AddressWidget(autocomplete_url='/address/autocomplete/').render('address', None)
+        self.assertIn('data-autocomplete-url="/address/autocomplete/"', html)
+        with self.settings(DJ_ADDRESS_AUTOCOMPLETE_URL='/search/'):
+            self.assertIn('data-autocomplete-url="/search/"', AddressWidget().render('address', None))
@@ -0,0 +1,176 @@
+from unittest import mock
+
+import requests
+
+from django.core.cache import cache
+from django.forms import ValidationError
+from django.test import TestCase, override_settings
+
+from dj_address.cache import GeocodeCache, LRUCache, geocode_cache, hierarchy_cache
+from dj_address.geocoders import GeocodeRaw
+from dj_address.models import Country, Locality, to_python
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_stats(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=2)
+        with mock.patch('dj_address.cache.time.monotonic', return_value=100):
+            cache.set('a', 1, ttl=10)
+        with mock.patch('dj_address.cache.time.monotonic', return_value=105):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('dj_address.cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+
+
+class HierarchyCacheTestCase(TestCase):
+
+    def setUp(self):
+        hierarchy_cache.clear()
+        hierarchy_cache.reset_stats()
+        self.ad = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU'
+        }
+
+    def tearDown(self):
+        hierarchy_cache.clear()
+
+    def test_hierarchy_lookups_are_cached(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            to_python(self.ad)
+        self.assertEqual(len(hierarchy_cache), 3)
+        # Only the address itself needs to be looked up now.
+        with self.assertNumQueries(1):
+            to_python(dict(self.ad))
+        self.assertEqual(hierarchy_cache.hits, 3)
+
+    def test_not_cached_before_commit(self):
+        to_python(self.ad)
+        self.assertEqual(len(hierarchy_cache), 0)
+
+    def test_invalidated_on_change(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            address = to_python(self.ad)
+        Country.objects.get(name='Australia').save()
+        self.assertEqual(len(hierarchy_cache), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            to_python(self.ad)
+        Locality.objects.get(pk=address.locality_id).delete()
+        self.assertEqual(len(hierarchy_cache), 0)
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, results):
+        self.results = results
+
+    def json(self):
+        return {'results': self.results, 'status': 'OK'}
+
+
+def google_result(street_number='10897', route='S River Front Pkwy', subpremise='200'):
+    components = [
+        {'long_name': street_number, 'short_name': street_number, 'types': ['street_number']},
+        {'long_name': route, 'short_name': route, 'types': ['route']},
+        {'long_name': 'South Jordan', 'short_name': 'South Jordan', 'types': ['locality', 'political']},
+        {'long_name': 'Utah', 'short_name': 'UT', 'types': ['administrative_area_level_1', 'political']},
+        {'long_name': 'United States', 'short_name': 'US', 'types': ['country', 'political']},
+        {'long_name': '84095', 'short_name': '84095', 'types': ['postal_code']},
+    ]
+    if subpremise:
+        components.insert(0, {'long_name': subpremise, 'short_name': subpremise, 'types': ['subpremise']})
+    return {
+        'address_components': components,
+        'formatted_address': '%s %s #%s, South Jordan, UT 84095, USA' % (street_number, route, subpremise),
+        'geometry': {'location': {'lat': 40.56, 'lng': -111.9}, 'location_type': 'ROOFTOP'},
+    }
+
+
+class GeocodeCacheTestCase(TestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        geocode_cache.clear()
+        geocode_cache.reset_stats()
+        cache.clear()
+
+    def tearDown(self):
+        geocode_cache.clear()
+        cache.clear()
+
+    def test_result_is_cached(self):
+        with mock.patch.object(requests.Session, 'get', return_value=FakeResponse([google_result()])) as get:
+            first = GeocodeRaw(self.raw).geocode()
+            second = GeocodeRaw('  10897 south river front parkway #200,  South Jordan, UT').geocode()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(first['subpremise'], second['subpremise'])
+        self.assertEqual(second['raw'], '  10897 south river front parkway #200,  South Jordan, UT')
+        self.assertEqual(geocode_cache.stats()['local_hits'], 1)
+
+    def test_shared_tier(self):
+        with mock.patch.object(requests.Session, 'get', return_value=FakeResponse([google_result()])) as get:
+            GeocodeRaw(self.raw).geocode()
+            geocode_cache.clear()
+            GeocodeRaw(self.raw).geocode()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(geocode_cache.stats()['shared_hits'], 1)
+
+    def test_negative_caching(self):
+        raw = '1 Nowhere Street, Dublin, UT 84095'
+        results = [google_result(), google_result(street_number='1')]
+        with mock.patch.object(requests.Session, 'get', return_value=FakeResponse(results)) as get:
+            for _ in range(2):
+                with self.assertRaisesMessage(ValidationError, 'Too many results for %s' % raw):
+                    GeocodeRaw(raw).geocode()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(geocode_cache.stats()['negative_hits'], 1)
+
+    @override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+    def test_disabled(self):
+        disabled = GeocodeCache(maxsize=0)
+        with mock.patch('dj_address.geocoders.geocode_cache', disabled), \
+                mock.patch.object(requests.Session, 'get', return_value=FakeResponse([google_result()])) as get:
+            GeocodeRaw(self.raw).geocode()
+            GeocodeRaw(self.raw).geocode()
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(disabled.stats()['misses'], 2)
+
+    def test_settings_are_part_of_key(self):
+        key = geocode_cache.key(self.raw)
+        with override_settings(DJ_ADDRESS_IGNORE_MISSING_SUBPREMISE=False):
+            self.assertNotEqual(key, geocode_cache.key(self.raw))
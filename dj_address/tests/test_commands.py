@@ -0,0 +1,318 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+from importlib.util import find_spec
+from io import StringIO
+from unittest import mock, skipIf
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from dj_address.cache import geocode_cache
+from dj_address.forms import AddressField
+from dj_address.geocoders import ReplayGeocoder
+from dj_address.models import Address, GeocodeJob, to_python
+from dj_address.testing import StubGeocodeServer
+
+from .test_geocoders import REPLAY_FILE
+
+
+class ImportAddressesTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.ad = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU',
+            'latitude': '-37.77',
+            'longitude': '145.0',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def write_jsonl(self, name, records):
+        return self.write(name, ''.join(json.dumps(record) + '\n' for record in records))
+
+    def call(self, *args, **options):
+        out = StringIO()
+        call_command('import_addresses', *args, stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_csv(self):
+        fields = list(self.ad)
+        rows = [','.join(fields), ','.join('"%s"' % self.ad[f] for f in fields), 'Somewhere' + ',' * (len(fields) - 1)]
+        out = self.call(self.write('addresses.csv', '\n'.join(rows) + '\n'))
+        self.assertIn('Imported 2 records', out)
+        address = Address.objects.get(street_number='1')
+        self.assertEqual(address.locality.state.country.code, 'AU')
+        self.assertEqual(address.latitude, -37.77)
+        self.assertTrue(Address.objects.filter(raw='Somewhere', locality=None).exists())
+
+    def test_matches_to_python(self):
+        existing = to_python(dict(self.ad, latitude=None, longitude=None))
+        path = self.write_jsonl('addresses.jsonl', [self.ad, 'Somewhere', 'Somewhere', {'raw': 'Somewhere'}])
+        self.call(path, batch_size=2)
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(Address.objects.exclude(raw='Somewhere').get(), existing)
+
+    def test_checkpoint_resume(self):
+        path = self.write_jsonl('addresses.jsonl', ['Place %d' % i for i in range(5)])
+        checkpoint = self.write('checkpoint', '3\n')
+        out = self.call(path, batch_size=1, checkpoint=checkpoint)
+        self.assertIn('Resuming after 3 records', out)
+        self.assertEqual(sorted(Address.objects.values_list('raw', flat=True)), ['Place 3', 'Place 4'])
+        with open(checkpoint) as f:
+            self.assertEqual(f.read(), '5\n')
+        self.call(path, checkpoint=checkpoint)
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_invalid_input(self):
+        with self.assertRaisesMessage(CommandError, 'Unknown input format'):
+            self.call(self.write('addresses.txt', 'Somewhere\n'))
+        with self.assertRaisesMessage(CommandError, 'Invalid JSON on line 2'):
+            self.call(self.write('addresses.jsonl', '"Somewhere"\n{\n'))
+
+    def test_invalid_records(self):
+        records = [
+            'Place 1',
+            dict(self.ad, country='Somewhere Else', country_code='Far too long'),
+            dict(self.ad, latitude='north'),
+            'Place 2',
+        ]
+        path = self.write_jsonl('addresses.jsonl', records)
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        err = StringIO()
+        out = StringIO()
+        call_command('import_addresses', path, batch_size=10, checkpoint=checkpoint, stdout=out, stderr=err)
+        self.assertIn('Imported 2 records', out.getvalue())
+        self.assertIn('Skipped 2 invalid records', out.getvalue())
+        self.assertIn('Skipped the record on line 2: Invalid country code (too long)', err.getvalue())
+        self.assertIn("Skipped the record on line 3: Invalid value for latitude: 'north'", err.getvalue())
+        self.assertEqual(sorted(Address.objects.values_list('raw', flat=True)), ['Place 1', 'Place 2'])
+        with open(checkpoint) as f:
+            self.assertEqual(f.read(), '4\n')
+        with self.assertRaisesMessage(CommandError, 'Could not import the record on line 2'):
+            self.call(self.write_jsonl('invalid.jsonl', records[:2]), stop_on_error=True)
+
+    @override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None,
+                       DJ_ADDRESS_GEOCODER='dj_address.geocoders.ReplayGeocoder',
+                       DJ_ADDRESS_GEOCODER_OPTIONS={'path': REPLAY_FILE})
+    def test_geocode(self):
+        geocode_cache.clear()
+        self.addCleanup(geocode_cache.clear)
+        raw = '10897 South River Front Parkway #200, South Jordan, UT'
+        path = self.write_jsonl('addresses.jsonl', [
+            raw, {'raw': '1 Nowhere Street, Dublin, UT 84095'}, self.ad,
+            # Too short to geocode, so the geocoder hands it back as it was.
+            'Somewhere',
+        ])
+        out = self.call(path, geocode=True)
+        self.assertIn('Geocoded 1, 2 could not be geocoded', out)
+        address = Address.objects.get(subpremise='200')
+        self.assertEqual(address.locality.name, 'South Jordan')
+        self.assertEqual(address.raw, raw)
+        self.assertIsNone(Address.objects.get(raw='1 Nowhere Street, Dublin, UT 84095').locality)
+        self.assertIsNone(Address.objects.get(raw='Somewhere').locality)
+
+
+class ExportAddressesTestCase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.au = to_python({
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU',
+            'latitude': -37.77,
+            'longitude': 145.0,
+        })
+        self.us = to_python({
+            'raw': '209 Joralemon Street, Brooklyn, NY, United States',
+            'street_number': '209',
+            'route': 'Joralemon St',
+            'locality': 'Brooklyn',
+            'postal_code': '11201',
+            'state': 'New York',
+            'state_code': 'NY',
+            'country': 'United States',
+            'country_code': 'US',
+        })
+        self.raw = to_python('Somewhere')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def call(self, *args, **options):
+        out = StringIO()
+        call_command('export_addresses', *args, stdout=out, **options)
+        return out.getvalue()
+
+    def read_jsonl(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_jsonl(self):
+        path = os.path.join(self.dir, 'addresses.jsonl')
+        # A single query joining the hierarchy, read in chunks.
+        with self.assertNumQueries(1):
+            out = self.call(path, chunk_size=2)
+        self.assertIn('Exported 3 addresses', out)
+        rows = self.read_jsonl(path)
+        self.assertEqual([row['id'] for row in rows], [self.au.pk, self.us.pk, self.raw.pk])
+        self.assertEqual(rows[0], dict(self.au.as_dict(), id=self.au.pk))
+        self.assertIsNone(rows[2]['country'])
+
+    def test_csv(self):
+        path = os.path.join(self.dir, 'addresses.csv')
+        self.call(path)
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1]['state_code'], 'NY')
+        self.assertEqual(float(rows[0]['latitude']), -37.77)
+
+    def test_split_by_country(self):
+        out = self.call(self.dir, split_by_country=True, format='jsonl')
+        self.assertIn('Exported 3 addresses', out)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['AU.jsonl', 'US.jsonl', 'unidentified.jsonl'])
+        self.assertEqual([row['id'] for row in self.read_jsonl(os.path.join(self.dir, 'US.jsonl'))], [self.us.pk])
+        self.assertEqual([row['raw'] for row in self.read_jsonl(os.path.join(self.dir, 'unidentified.jsonl'))],
+                         ['Somewhere'])
+
+    @skipIf(find_spec('pyarrow'), 'pyarrow is installed')
+    def test_parquet_needs_pyarrow(self):
+        with self.assertRaisesMessage(CommandError, 'requires pyarrow'):
+            self.call(os.path.join(self.dir, 'addresses.parquet'))
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None,
+                   DJ_ADDRESS_GEOCODER='dj_address.geocoders.ReplayGeocoder',
+                   DJ_ADDRESS_GEOCODER_OPTIONS={'path': REPLAY_FILE})
+class GeocodeWorkerTestCase(TestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        geocode_cache.clear()
+        self.addCleanup(geocode_cache.clear)
+
+    def enqueue(self, raw):
+        # Geocoding inline would fail on this geocoder.
+        return AddressField(enqueue=True, geocoder=object()).to_python({'raw': raw})
+
+    def call(self, **options):
+        out = StringIO()
+        call_command('geocode_worker', once=True, stdout=out, **options)
+        return out.getvalue()
+
+    def test_form_enqueues(self):
+        address = self.enqueue(self.raw)
+        self.assertIsNone(address.locality)
+        self.assertTrue(address.needs_geocode)
+        self.assertEqual(address.geocode_job.attempts, 0)
+        self.assertEqual(self.enqueue(self.raw), address)
+        self.assertEqual(GeocodeJob.objects.count(), 1)
+
+    def test_geocoded_in_place(self):
+        address = self.enqueue(self.raw)
+        out = self.call()
+        self.assertIn('Geocoded 1 addresses, merging 0', out)
+        address.refresh_from_db()
+        self.assertEqual(address.locality.name, 'South Jordan')
+        self.assertEqual(address.subpremise, '200')
+        self.assertEqual(address.raw, self.raw)
+        self.assertFalse(address.needs_geocode)
+        self.assertFalse(GeocodeJob.objects.exists())
+
+    def test_merged_into_existing(self):
+        existing = to_python(ReplayGeocoder(path=REPLAY_FILE).geocode(self.raw))
+        address = self.enqueue(self.raw)
+        self.assertNotEqual(address, existing)
+        self.assertIn('merging 1', self.call())
+        self.assertEqual(list(Address.objects.all()), [existing])
+
+    def test_not_good_enough(self):
+        address = self.enqueue('1 Nowhere Street, Dublin, UT 84095')
+        self.assertIn('1 could not be geocoded', self.call())
+        address.refresh_from_db()
+        self.assertIsNone(address.locality)
+        self.assertFalse(address.needs_geocode)
+        self.assertFalse(GeocodeJob.objects.exists())
+
+    @override_settings(DJ_ADDRESS_GEOCODE_RETRIES=0)
+    def test_no_answer(self):
+        address = self.enqueue(self.raw)
+        with StubGeocodeServer(statuses=[503] * 4) as server:
+            with self.settings(DJ_ADDRESS_GEOCODER='dj_address.geocoders.LocalHTTPGeocoder',
+                               DJ_ADDRESS_GEOCODER_OPTIONS={}, DJ_ADDRESS_GEOCODER_URL=server.url):
+                self.assertIn('1 will be retried', self.call())
+                # Not until its lease is up.
+                self.assertIn('0 will be retried', self.call())
+                self.assertIn('1 were dropped', self.call(lease=0, max_attempts=2))
+        # Each attempt asks twice, for the raw and then the formatted address.
+        self.assertEqual(len(server.requests), 4)
+        address.refresh_from_db()
+        self.assertTrue(address.needs_geocode)
+        self.assertFalse(GeocodeJob.objects.exists())
+
+    def test_geocoder_error(self):
+        poison = self.enqueue('1 Poison Street, Nowhere')
+        address = self.enqueue(self.raw)
+        geocode = ReplayGeocoder.geocode
+
+        def side_effect(geocoder, raw, **kwargs):
+            if raw == poison.raw:
+                raise IndexError('list index out of range')
+            return geocode(geocoder, raw, **kwargs)
+
+        with mock.patch.object(ReplayGeocoder, 'geocode', autospec=True, side_effect=side_effect):
+            self.assertIn('Geocoded 1 addresses, merging 0 into existing ones; 0 could not be geocoded, '
+                          '1 will be retried', self.call())
+            job = GeocodeJob.objects.get()
+            self.assertEqual(job.address, poison)
+            self.assertEqual(job.last_error, 'IndexError: list index out of range (attempt 1)')
+            # Claimed again straight away, until it runs out of attempts.
+            self.assertIn('1 will be retried and 1 were dropped', self.call(lease=0, max_attempts=3))
+        address.refresh_from_db()
+        self.assertEqual(address.locality.name, 'South Jordan')
+        poison.refresh_from_db()
+        self.assertTrue(poison.needs_geocode)
+        self.assertFalse(GeocodeJob.objects.exists())
+
+    def test_flagged(self):
+        Address.objects.create(raw=self.raw, needs_geocode=True)
+        self.assertIn('Queued 1 flagged addresses.', self.call(flagged=True))
+        self.assertEqual(Address.objects.get().locality.name, 'South Jordan')
+
+    def test_claim(self):
+        for i in range(3):
+            GeocodeJob.objects.enqueue(Address.objects.create(raw='%d Somewhere' % i))
+        first = GeocodeJob.objects.claim(2)
+        second = GeocodeJob.objects.claim(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(GeocodeJob.objects.claim(2), [])
+        # Jobs whose worker didn't finish them in time are claimed again.
+        self.assertEqual(len(GeocodeJob.objects.claim(5, lease=0)), 3)
@@ -0,0 +1,99 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from dj_address import geohash
+from dj_address.dedupe import find_duplicate_addresses, find_duplicate_localities, merge, normalize_route
+from dj_address.models import Address, Country, Locality, State
+
+
+class GeohashTestCase(SimpleTestCase):
+
+    def test_encode(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash.encode(42.6, -5.6, 5), 'ezs42')
+        self.assertRaises(ValueError, geohash.encode, 91, 0)
+
+    def test_bbox(self):
+        min_lat, min_lng, max_lat, max_lng = geohash.bbox('ezs42')
+        self.assertTrue(min_lat <= 42.6 <= max_lat)
+        self.assertTrue(min_lng <= -5.6 <= max_lng)
+        self.assertAlmostEqual(max_lat - min_lat, 180 / 2 ** 12)
+        self.assertRaises(ValueError, geohash.bbox, 'ezs4a')
+
+
+class DedupeTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        self.vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        self.northcote = Locality.objects.create(name='Northcote', postal_code='3070', state=self.vic)
+        self.fitzroy = Locality.objects.create(name='Fitzroy', postal_code='3065', state=self.vic)
+
+    def address(self, street_number='1', route='Somewhere Street', locality=None, **kwargs):
+        return Address.objects.create(street_number=street_number, route=route,
+                                      locality=locality or self.northcote, raw=kwargs.pop('raw', 'x'), **kwargs)
+
+    def test_normalize_route(self):
+        self.assertEqual(normalize_route('Somewhere  Street'), 'somewhere st')
+        self.assertEqual(normalize_route('somewhere st.'), 'somewhere st')
+
+    def test_find_duplicate_addresses(self):
+        first = self.address()
+        complete = self.address(route='somewhere st.', formatted='1 Somewhere St', latitude=-37.77, longitude=145.0)
+        self.address(subpremise='2')
+        self.address(locality=self.fitzroy)
+        raw = Address.objects.create(raw='Someplace, Victoria')
+        raw_dupe = Address.objects.create(raw='someplace victoria')
+        self.assertEqual(find_duplicate_addresses(), [[complete.pk, first.pk], [raw.pk, raw_dupe.pk]])
+
+    def test_same_building(self):
+        a = self.address(latitude=-37.7701, longitude=145.0001)
+        b = self.address(route='Highway 1', latitude=-37.7701, longitude=145.0001)
+        self.address(street_number='3', route='Highway 1', latitude=-37.7701, longitude=145.0001)
+        self.assertEqual(find_duplicate_addresses(), [[a.pk, b.pk]])
+
+    def test_max_block_size(self):
+        # Stored before addresses were unique, so without fingerprints.
+        Address.objects.bulk_create([Address(raw='Someplace') for _ in range(3)])
+        with self.assertLogs('dj_address.dedupe', 'WARNING'):
+            self.assertEqual(find_duplicate_addresses(max_block_size=2), [])
+
+    def test_merge_localities(self):
+        dupe = Locality.objects.create(name='northcote', postal_code='3070', state=self.vic)
+        Locality.objects.create(name='Northcote', postal_code='3071', state=self.vic)
+        moved = self.address(locality=dupe)
+        groups = find_duplicate_localities()
+        self.assertEqual(groups, [[self.northcote.pk, dupe.pk]])
+        stats = merge(Locality, groups)
+        self.assertEqual(stats, {'groups': 1, 'deleted': 1, 'references': {'dj_address.address.locality': 1}})
+        self.assertFalse(Locality.objects.filter(pk=dupe.pk).exists())
+        moved.refresh_from_db()
+        self.assertEqual(moved.locality, self.northcote)
+        self.assertEqual(moved.fingerprint, Address(
+            street_number='1', route='Somewhere Street', locality=self.northcote).set_fingerprint())
+
+    def test_merge_dry_run(self):
+        addresses = Address.objects.bulk_create([
+            Address(street_number='1', route='Somewhere Street', locality=self.northcote, raw='x') for _ in range(3)
+        ])
+        stats = merge(Address, find_duplicate_addresses(), dry_run=True)
+        self.assertEqual(stats['deleted'], 2)
+        self.assertEqual(Address.objects.count(), 3)
+        merge(Address, find_duplicate_addresses(), batch_size=1)
+        self.assertEqual(list(Address.objects.all()), addresses[:1])
+
+    def test_command(self):
+        dupe = Locality.objects.create(name='Northcote ', postal_code='3070', state=self.vic)
+        self.address()
+        self.address(locality=dupe)
+        out = StringIO()
+        call_command('merge_duplicate_addresses', localities=True, dry_run=True, stdout=out)
+        self.assertIn('Would merge 1 duplicate localities in 1 groups.', out.getvalue())
+        self.assertIn('Would merge 1 duplicate addresses', out.getvalue())
+        out = StringIO()
+        call_command('merge_duplicate_addresses', localities=True, stdout=out)
+        self.assertIn('Merged 1 duplicate localities', out.getvalue())
+        self.assertIn('Merged 1 duplicate addresses', out.getvalue())
+        self.assertEqual(Address.objects.count(), 1)
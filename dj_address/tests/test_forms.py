@@ -1,17 +1,27 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError as CoreValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.forms import ValidationError, Form
+from dj_address.cache import geocode_cache
 from dj_address.forms import AddressField, AddressWidget
+from dj_address.models import Address
+
+from .test_geocoders import REPLAY_FILE
 
 
 class TestForm(Form):
     address = AddressField()
 
 
+# Answered from recorded Geocoding API responses, so these run without a network.
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None,
+                   DJ_ADDRESS_GEOCODER='dj_address.geocoders.ReplayGeocoder',
+                   DJ_ADDRESS_GEOCODER_OPTIONS={'path': REPLAY_FILE})
 class AddressFieldTestCase(TestCase):
 
     def setUp(self):
+        geocode_cache.clear()
+        self.addCleanup(geocode_cache.clear)
         self.form = TestForm()
         self.field = self.form.base_fields['address']
         self.missing_state = {
@@ -333,3 +343,18 @@ class AddressWidgetTestCase(TestCase):
         self.assertEqual('150', wid.attrs['size'])
         html = wid.render('test', None)
         self.assertNotEqual(-1, html.find('size="150"'))
+
+    def test_render_escapes_values(self):
+        html = AddressWidget().render('test', {'route': '"><script>', 'formatted': '<b>'})
+        self.assertIn('name="test_route" data-geo="route" value="&quot;&gt;&lt;script&gt;"', html)
+        self.assertIn('value="&lt;b&gt;"', html)
+        self.assertNotIn('<script>', html)
+
+    def test_render_instance_without_queries(self):
+        address = Address.objects.create(raw='Someplace', formatted='Someplace')
+        field = AddressField()
+        with self.assertNumQueries(0):
+            html = field.widget.render('test', field.prepare_value(address))
+        self.assertIn('name="test_formatted" data-geo="formatted_address" value="Someplace"', html)
+        with self.assertNumQueries(1):
+            field.widget.render('test', address.pk)
@@ -0,0 +1,386 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.forms import Form
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from dj_address.cache import geocode_cache
+from dj_address.forms import AddressField
+from dj_address.geocoders import (
+    AsyncGeocoder, GoogleGeocoder, LocalHTTPGeocoder, ReplayGeocoder, get_geocoder,
+)
+from dj_address.models import Address
+from dj_address.ratelimit import CacheRateLimiter, CombinedRateLimiter, DailyQuota, FileTokenBucket, TokenBucket
+from dj_address.sessions import reset_session
+from dj_address.singleflight import CacheSingleFlight
+from dj_address.testing import StubGeocodeServer
+
+from .test_cache import google_result
+
+
+REPLAY_FILE = os.path.join(os.path.dirname(__file__), 'fixtures', 'geocode_replay.json')
+
+
+def collect(geocoder, raws):
+    async def run():
+        return [result async for result in geocoder.geocode_many(raws)]
+    return asyncio.run(run())
+
+
+class TokenBucketTestCase(SimpleTestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertFalse(bucket.acquire(timeout=0.01))
+        self.assertTrue(bucket.acquire(timeout=1))
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, TokenBucket, 0)
+
+    def test_file_bucket_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bucket')
+            # Two buckets on the same file, as two processes would have.
+            first = FileTokenBucket(rate=10, capacity=2, path=path)
+            second = FileTokenBucket(rate=10, capacity=2, path=path)
+            self.assertTrue(first.try_acquire())
+            self.assertTrue(second.try_acquire())
+            self.assertFalse(first.try_acquire())
+            self.assertTrue(second.acquire(timeout=1))
+
+
+class SharedLimitTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_cache_rate_limiter(self):
+        limiter = CacheRateLimiter(rate=2, key='test')
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(CacheRateLimiter(rate=2, key='test').try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        self.assertTrue(limiter.acquire(timeout=1.1))
+
+    def test_combined_rate_limiter(self):
+        shared = CacheRateLimiter(rate=2, key='test')
+        limiter = CombinedRateLimiter(TokenBucket(rate=100, capacity=100), shared)
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(shared.try_acquire())
+        # The local bucket has plenty left, but the shared limit is used up.
+        self.assertFalse(limiter.try_acquire())
+        self.assertFalse(limiter.acquire(timeout=0.01))
+
+    def test_daily_quota(self):
+        quota = DailyQuota(2)
+        self.assertTrue(quota.try_consume())
+        self.assertTrue(quota.try_consume())
+        self.assertFalse(quota.try_consume())
+        self.assertEqual(quota.used(), 2)
+        self.assertEqual(quota.remaining(), 0)
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+class AsyncGeocoderTestCase(SimpleTestCase):
+
+    def setUp(self):
+        reset_session()
+        geocode_cache.clear()
+        self.raws = ['%d South River Front Parkway #200, South Jordan, UT' % (10890 + i) for i in range(6)]
+        self.responses = {
+            raw: {'results': [google_result(street_number=raw.split()[0])], 'status': 'OK'}
+            for raw in self.raws
+        }
+
+    def tearDown(self):
+        reset_session()
+        geocode_cache.clear()
+
+    def test_geocode_many(self):
+        bad = '1 Nowhere Street, Dublin, UT 84095'
+        self.responses[bad] = {'results': [google_result(), google_result()], 'status': 'OK'}
+        with StubGeocodeServer(self.responses) as server:
+            results = collect(AsyncGeocoder(GoogleGeocoder(url=server.url), concurrency=3), self.raws + [bad])
+        self.assertEqual(len(results), 7)
+        values = {raw: (value, error) for raw, value, error in results}
+        self.assertEqual(values[self.raws[0]][0]['street_number'], '10890')
+        self.assertEqual(values[bad][1].code, 'too_many_results')
+
+    def test_concurrency(self):
+        with StubGeocodeServer(self.responses, delay=0.2) as server:
+            start = time.monotonic()
+            collect(AsyncGeocoder(GoogleGeocoder(url=server.url), concurrency=6), self.raws)
+            elapsed = time.monotonic() - start
+        self.assertLess(elapsed, 0.2 * len(self.raws) / 2)
+
+    def test_rate_limit(self):
+        with StubGeocodeServer(self.responses) as server:
+            start = time.monotonic()
+            collect(AsyncGeocoder(GoogleGeocoder(url=server.url), concurrency=6, qps=20, burst=1), self.raws)
+            elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, (len(self.raws) - 1) / 20)
+
+    def test_rate_limit_within_shared_limit(self):
+        shared = TokenBucket(rate=1000)
+        geocoder = AsyncGeocoder(GoogleGeocoder(rate_limiter=shared), qps=20)
+        self.assertIsInstance(geocoder.geocoder.rate_limiter, CombinedRateLimiter)
+        self.assertIn(shared, geocoder.geocoder.rate_limiter.limiters)
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+class CoalescingTestCase(SimpleTestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        reset_session()
+        geocode_cache.clear()
+        self.addCleanup(reset_session)
+        self.addCleanup(geocode_cache.clear)
+        # The same input, as different users might type it.
+        self.raws = [self.raw, self.raw.upper(), '  ' + self.raw, self.raw.replace(' ', '  ')] * 2
+
+    def responses(self, results):
+        # Whichever of them is asked for first.
+        return {raw: {'results': results, 'status': 'OK'} for raw in self.raws}
+
+    def geocode_all(self, server):
+        geocoder = GoogleGeocoder(url=server.url)
+
+        def geocode(raw):
+            try:
+                return geocoder.geocode(raw)
+            except ValidationError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=len(self.raws)) as executor:
+            return list(executor.map(geocode, self.raws))
+
+    def test_result_is_shared(self):
+        with StubGeocodeServer(self.responses([google_result()]), delay=0.2) as server:
+            values = self.geocode_all(server)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual([value['raw'] for value in values], self.raws)
+        self.assertEqual({value['street_number'] for value in values}, {'10897'})
+
+    def test_error_is_shared(self):
+        with StubGeocodeServer(self.responses([google_result(), google_result()]), delay=0.2) as server:
+            errors = self.geocode_all(server)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual({e.code for e in errors}, {'too_many_results'})
+        self.assertEqual(len({id(e) for e in errors}), len(errors))
+
+    def test_disabled(self):
+        with self.settings(DJ_ADDRESS_GEOCODE_COALESCE=False):
+            with StubGeocodeServer(self.responses([google_result()]), delay=0.2) as server:
+                self.geocode_all(server)
+        self.assertEqual(len(server.requests), len(self.raws))
+
+
+class CacheSingleFlightTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.calls = 0
+        self.started = threading.Event()
+
+    def slow(self, outcome):
+        def func():
+            self.calls += 1
+            self.started.set()
+            time.sleep(0.2)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return func
+
+    def run_two(self, outcome):
+        # Each thread has its own flight, as each process would.
+        def do():
+            try:
+                return CacheSingleFlight(interval=0.01).do('test', self.slow(outcome))
+            except Exception as e:
+                return e, None
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(do)
+            self.started.wait(1)
+            second = executor.submit(do)
+            return first.result(), second.result()
+
+    def test_result_is_shared(self):
+        first, second = self.run_two({'street_number': '1'})
+        self.assertEqual(first, ({'street_number': '1'}, False))
+        self.assertEqual(second, ({'street_number': '1'}, True))
+        self.assertEqual(self.calls, 1)
+
+    def test_error_is_shared(self):
+        first, second = self.run_two(ValidationError('Too many results', code='too_many_results'))
+        self.assertEqual(first[0].code, 'too_many_results')
+        self.assertEqual(second[0].code, 'too_many_results')
+        self.assertEqual(self.calls, 1)
+
+    def test_lock_released_without_outcome(self):
+        first, second = self.run_two(RuntimeError('Boom'))
+        self.assertIsInstance(second[0], RuntimeError)
+        self.assertEqual(self.calls, 2)
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+class BackendTestCase(TestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        geocode_cache.clear()
+
+    def tearDown(self):
+        geocode_cache.clear()
+
+    def test_default_backend(self):
+        self.assertIsInstance(get_geocoder(), GoogleGeocoder)
+        self.assertIs(get_geocoder(), get_geocoder())
+
+    @override_settings(DJ_ADDRESS_GEOCODER='dj_address.geocoders.ReplayGeocoder',
+                       DJ_ADDRESS_GEOCODER_OPTIONS={'path': REPLAY_FILE})
+    def test_form_field_uses_configured_backend(self):
+        class TestForm(Form):
+            address = AddressField()
+
+        field = TestForm().fields['address']
+        res = field.to_python({'raw': self.raw})
+        self.assertEqual('South Jordan', res.locality.name)
+        self.assertEqual('200', res.subpremise)
+        with self.assertRaisesMessage(ValidationError, 'Too many results'):
+            field.to_python({'raw': '1 Nowhere Street, Dublin, UT 84095'})
+
+    def test_replay_miss(self):
+        geocoder = ReplayGeocoder(path=REPLAY_FILE)
+        self.assertEqual(geocoder.fetch('Somewhere else entirely, UT').json()['status'], 'ZERO_RESULTS')
+        with self.assertRaisesMessage(ValidationError, 'No results for 1 Not In The File Street'):
+            geocoder.geocode('1 Not In The File Street, Nowhere, XX 00000')
+
+    def test_replay_record(self):
+        payload = {'results': [google_result()], 'status': 'OK'}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'recorded.json')
+            with StubGeocodeServer({self.raw: payload}) as server:
+                ReplayGeocoder(path=path, record=True, url=server.url).geocode(self.raw)
+            with open(path) as f:
+                self.assertEqual(json.load(f), {self.raw: payload})
+            value = ReplayGeocoder(path=path).geocode(self.raw)
+        self.assertEqual(value['street_number'], '10897')
+
+    def test_local_http(self):
+        payload = {'results': [google_result()], 'status': 'OK'}
+        with StubGeocodeServer({self.raw: payload}) as server:
+            with override_settings(DJ_ADDRESS_GEOCODER='dj_address.geocoders.LocalHTTPGeocoder',
+                                   DJ_ADDRESS_GEOCODER_URL=server.url):
+                value = get_geocoder().geocode(self.raw)
+        self.assertEqual(value['locality'], 'South Jordan')
+
+    def test_local_http_needs_url(self):
+        self.assertRaises(ImproperlyConfigured, LocalHTTPGeocoder)
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None, DJ_ADDRESS_GEOCODER='dj_address.geocoders.LocalHTTPGeocoder')
+class GeocodeLimitsTestCase(TestCase):
+
+    def setUp(self):
+        geocode_cache.clear()
+        cache.clear()
+        self.addCleanup(geocode_cache.clear)
+        self.addCleanup(cache.clear)
+        self.raws = ['%d South River Front Parkway #200, South Jordan, UT' % (10890 + i) for i in range(2)]
+        responses = {
+            raw: {'results': [google_result(street_number=raw.split()[0])], 'status': 'OK'}
+            for raw in self.raws
+        }
+        self.server = StubGeocodeServer(responses).start()
+        self.addCleanup(self.server.stop)
+
+    def resolve(self, raw):
+        class TestForm(Form):
+            address = AddressField()
+
+        with self.assertLogs('dj_address.geocoders', 'WARNING') if raw == self.raws[1] else nullcontext():
+            return TestForm().fields['address'].to_python({'raw': raw})
+
+    def check_degrades_to_raw(self):
+        self.assertEqual(self.resolve(self.raws[0]).locality.name, 'South Jordan')
+        address = self.resolve(self.raws[1])
+        self.assertIsNone(address.locality)
+        self.assertEqual(address.raw, self.raws[1])
+        self.assertTrue(address.needs_geocode)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_quota_exceeded(self):
+        with self.settings(DJ_ADDRESS_GEOCODER_URL=self.server.url, DJ_ADDRESS_GEOCODER_DAILY_QUOTA=1):
+            self.check_degrades_to_raw()
+
+    def test_throttled(self):
+        with self.settings(DJ_ADDRESS_GEOCODER_URL=self.server.url,
+                           DJ_ADDRESS_GEOCODER_RATE_LIMITER='dj_address.ratelimit.TokenBucket',
+                           DJ_ADDRESS_GEOCODER_RATE_LIMITER_OPTIONS={'rate': 0.01, 'capacity': 1},
+                           DJ_ADDRESS_GEOCODER_RATE_LIMIT_TIMEOUT=0):
+            self.check_degrades_to_raw()
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+class DeadlineTestCase(TestCase):
+    raw = '10897 South River Front Parkway #201, South Jordan, UT'
+
+    def setUp(self):
+        reset_session()
+        geocode_cache.clear()
+        self.addCleanup(reset_session)
+        self.addCleanup(geocode_cache.clear)
+
+    def resolve(self, server, deadline_ms):
+        field = AddressField(geocoder=GoogleGeocoder(url=server.url), deadline_ms=deadline_ms)
+        start = time.monotonic()
+        with self.assertLogs('dj_address.geocoders', 'WARNING'):
+            address = field.to_python({'raw': self.raw})
+        return address, time.monotonic() - start
+
+    def test_slow_request(self):
+        with StubGeocodeServer({self.raw: {'results': [google_result()], 'status': 'OK'}}, delay=1) as server:
+            address, elapsed = self.resolve(server, 100)
+        self.assertLess(elapsed, 0.5)
+        self.assertIsNone(address.locality)
+        self.assertTrue(address.needs_geocode)
+
+    @override_settings(DJ_ADDRESS_SUBPREMISE_GEOCODE_RETRY_WITH_REPLACE=True, DJ_ADDRESS_SUBPREMISE_REPLACE_ONLY=False)
+    def test_retry_is_skipped(self):
+        # The subpremise doesn't match, so it would be retried; but that would take another 0.2s.
+        result = dict(google_result(), partial_match=True)
+        with StubGeocodeServer({self.raw: {'results': [result], 'status': 'OK'}}, delay=0.2) as server:
+            address, elapsed = self.resolve(server, 300)
+        self.assertEqual(len(server.requests), 1)
+        self.assertLess(elapsed, 0.3)
+        self.assertTrue(address.needs_geocode)
+
+    def test_setting(self):
+        with StubGeocodeServer({self.raw: {'results': [google_result()], 'status': 'OK'}}, delay=1) as server:
+            with self.settings(DJ_ADDRESS_GEOCODE_DEADLINE_MS=100):
+                address, elapsed = self.resolve(server, None)
+        self.assertLess(elapsed, 0.5)
+        self.assertTrue(address.needs_geocode)
+
+    def test_within_deadline(self):
+        with StubGeocodeServer({self.raw: {'results': [google_result(subpremise='201')], 'status': 'OK'}}) as server:
+            field = AddressField(geocoder=GoogleGeocoder(url=server.url), deadline_ms=5000)
+            address = field.to_python({'raw': self.raw})
+        self.assertEqual(address.subpremise, '201')
+        self.assertFalse(address.needs_geocode)
@@ -0,0 +1,93 @@
+import socket
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from dj_address import metrics
+from dj_address.cache import geocode_cache, hierarchy_cache
+from dj_address.geocoders import GoogleGeocoder
+from dj_address.models import to_python
+from dj_address.sessions import reset_session
+from dj_address.testing import StubGeocodeServer
+
+from .test_cache import google_result
+
+
+@override_settings(DJ_ADDRESS_METRICS_SINK='dj_address.metrics.MemorySink',
+                   DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None, DJ_ADDRESS_GEOCODE_BACKOFF_FACTOR=0)
+class MetricsTestCase(TestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        reset_session()
+        geocode_cache.clear()
+        hierarchy_cache.clear()
+        self.addCleanup(reset_session)
+        self.addCleanup(geocode_cache.clear)
+        self.sink = metrics.get_sink()
+
+    def test_disabled(self):
+        with self.settings(DJ_ADDRESS_METRICS_SINK=None):
+            self.assertIsNone(metrics.get_sink())
+            self.assertFalse(metrics.enabled(metrics.address_resolved))
+            to_python('Somewhere')
+        self.assertEqual(self.sink.count('to_python.queries'), 0)
+
+    def test_to_python(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        metrics.address_resolved.connect(receiver)
+        self.addCleanup(metrics.address_resolved.disconnect, receiver)
+        to_python('Somewhere')
+        to_python({'raw': 'Somewhere', 'locality': 'Northcote', 'state': 'Victoria', 'country': 'Australia'})
+        self.assertEqual(len(self.sink.times('to_python')), 2)
+        self.assertEqual(self.sink.count('to_python.queries', value_type='str'), 3)
+        self.assertEqual(received[0]['queries'], 3)
+        self.assertEqual(received[1]['value_type'], 'dict')
+        self.assertEqual(self.sink.count('cache.hierarchy', result='miss'), 3)
+
+    def test_geocode_request(self):
+        payload = {'results': [google_result()], 'status': 'OK'}
+        with StubGeocodeServer({self.raw: payload}, statuses=[503]) as server:
+            geocoder = GoogleGeocoder(url=server.url)
+            geocoder.geocode(self.raw)
+            geocoder.geocode(self.raw)
+        self.assertEqual(len(self.sink.times('geocode.request', status=200)), 1)
+        self.assertEqual(self.sink.count('geocode.request.retries'), 1)
+        self.assertEqual(self.sink.count('cache.geocode', result='miss'), 1)
+        self.assertEqual(self.sink.count('cache.geocode', result='local_hit'), 1)
+
+    def test_subpremise_retry(self):
+        raw = '10897 South River Front Parkway #201, South Jordan, UT'
+        result = dict(google_result(), partial_match=True)
+        with StubGeocodeServer({raw: {'results': [result], 'status': 'OK'}}) as server:
+            value = GoogleGeocoder(url=server.url).geocode(raw)
+        self.assertEqual(value['subpremise'], '201')
+        self.assertEqual(self.sink.count('geocode.subpremise', branch='replace_only'), 1)
+
+
+class StatsdSinkTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(1)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+
+    def receive(self):
+        return self.server.recv(1024).decode('utf-8')
+
+    def test_statsd(self):
+        sink = metrics.StatsdSink(port=self.port)
+        sink.timing('geocode.request', 12.5, {'status': 200})
+        self.assertEqual(self.receive(), 'dj_address.geocode.request.200:12.500|ms')
+        sink.incr('to_python.queries', 3)
+        self.assertEqual(self.receive(), 'dj_address.to_python.queries:3|c')
+
+    def test_dogstatsd(self):
+        sink = metrics.StatsdSink(port=self.port, prefix='', dogstatsd=True)
+        sink.incr('cache.geocode', tags={'result': 'miss'})
+        self.assertEqual(self.receive(), 'cache.geocode:1|c|#result:miss')
@@ -1,8 +1,13 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
 from django.test import TestCase
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import signals
 from django.core.exceptions import ValidationError
 from dj_address.models import Address, Country, State, Locality, AddressField
-from dj_address.models import to_python
+from dj_address.models import to_python, _get_country, _get_locality
 
 
 class CountryTestCase(TestCase):
@@ -339,3 +344,363 @@ class AddressFieldTestCase(TestCase):
     #     self.assertEqual(test.address.locality.state.code, self.ad1_dict['state_code'])
     #     self.assertEqual(test.address.locality.state.country.name, self.ad1_dict['country'])
     #     self.assertEqual(test.address.locality.state.country.code, self.ad1_dict['country_code'])
+
+
+class BulkResolveTestCase(TestCase):
+
+    def setUp(self):
+        self.ad1_dict = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU'
+        }
+        self.ad2_dict = {
+            'raw': '209 Joralemon Street, Brooklyn, NY, United States',
+            'street_number': '209',
+            'route': 'Joralemon St',
+            'sublocality': 'Brooklyn',
+            'postal_code': '11201',
+            'state': 'New York',
+            'state_code': 'NY',
+            'country': 'United States',
+            'country_code': 'US',
+        }
+
+    def test_matches_single_path(self):
+        existing = to_python(self.ad1_dict)
+        res = Address.objects.bulk_resolve([self.ad2_dict, self.ad1_dict, None])
+        self.assertEqual(res[1], existing)
+        self.assertIsNone(res[2])
+        self.assertEqual(res[0].locality.name, 'Brooklyn')
+        self.assertEqual(res[0].locality.state.code, 'NY')
+        self.assertEqual(res[0].formatted, '209 Joralemon St, Brooklyn, New York 11201, United States')
+        self.assertEqual(to_python(self.ad2_dict), res[0])
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_deduplicates(self):
+        res = Address.objects.bulk_resolve([self.ad1_dict, dict(self.ad1_dict), {'raw': 'Someplace'},
+                                            {'raw': 'Someplace'}])
+        self.assertEqual(res[0], res[1])
+        self.assertEqual(res[2], res[3])
+        self.assertEqual(Address.objects.count(), 2)
+        self.assertEqual(Country.objects.count(), 1)
+
+    def test_raw_values(self):
+        inconsistent = {'raw': 'Somewhere', 'locality': 'Northcote', 'country': 'Australia'}
+        res = Address.objects.bulk_resolve(['Someplace', 'someplace ', inconsistent, {'raw': 'Someplace'}])
+        self.assertEqual(res[0], res[1])
+        self.assertEqual(res[0], res[3])
+        self.assertEqual(res[2].raw, 'Somewhere')
+        self.assertIsNone(res[2].locality)
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_constant_queries(self):
+        values = [dict(self.ad1_dict, street_number=str(i), raw='%d Somewhere Street' % i) for i in range(50)]
+        # Fetch, insert and re-fetch each of the four levels, plus look for addresses without a
+        # fingerprint, all inside a savepoint.
+        with self.assertNumQueries(15):
+            res = Address.objects.bulk_resolve(values)
+        self.assertEqual(len({a.pk for a in res}), 50)
+
+    def test_invalid_code_rolls_back(self):
+        ad = dict(self.ad1_dict, country_code='Something else')
+        self.assertRaises(ValueError, Address.objects.bulk_resolve, [self.ad2_dict, ad])
+        self.assertEqual(Country.objects.count(), 0)
+
+
+class FingerprintTestCase(TestCase):
+
+    def setUp(self):
+        self.ad = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        }
+
+    def test_computed_on_save(self):
+        address = Address.objects.create(raw='Somewhere')
+        self.assertEqual(len(address.fingerprint), 40)
+        address.raw = 'Elsewhere'
+        address.save(update_fields=['raw'])
+        address.refresh_from_db()
+        self.assertEqual(address.fingerprint, Address(raw='Elsewhere').set_fingerprint())
+
+    def test_saved_as_copy_of_another(self):
+        first = Address.objects.create(raw='Somewhere')
+        second = Address.objects.create(raw='Elsewhere')
+        second.raw = 'somewhere'
+        second.save()
+        self.assertEqual(Address.objects.get(pk=second.pk).fingerprint, '')
+        # Duplicates left without a fingerprint can still be edited.
+        second.formatted = 'Somewhere'
+        second.save()
+        self.assertEqual(Address.objects.get(pk=first.pk).fingerprint, first.fingerprint)
+        self.assertEqual(Address.objects.get(pk=second.pk).formatted, 'Somewhere')
+
+    def test_ignores_case_and_whitespace(self):
+        first = to_python(self.ad)
+        second = to_python(dict(self.ad, route='somewhere  street', raw='1 somewhere street'))
+        self.assertEqual(first, second)
+        self.assertEqual(to_python('Some  Place'), to_python('some place'))
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_raw_never_matches_components(self):
+        address = to_python(self.ad)
+        self.assertNotEqual(to_python(self.ad['raw']), address)
+
+    def test_fallback_for_rows_without_fingerprint(self):
+        address = to_python(self.ad)
+        raw = to_python('Someplace')
+        Address.objects.update(fingerprint='')
+        self.assertEqual(to_python(self.ad), address)
+        self.assertEqual(to_python('Someplace'), raw)
+        self.assertEqual(Address.objects.bulk_resolve([self.ad, 'Someplace']), [address, raw])
+        self.assertEqual(Address.objects.count(), 2)
+        with self.settings(DJ_ADDRESS_FINGERPRINT_FALLBACK=False):
+            self.assertNotEqual(to_python('Someplace'), raw)
+
+    def test_fallback_for_raw_values_sharing_a_prefix(self):
+        # Only the indexed prefix is compared in the database.
+        raws = ['12 Some Long Street Name, North', '12 Some Long Street Name, South']
+        addresses = [to_python(raw) for raw in raws]
+        Address.objects.update(fingerprint='')
+        self.assertEqual([to_python(raw) for raw in reversed(raws)], addresses[::-1])
+        self.assertEqual(Address.objects.bulk_resolve(raws), addresses)
+        self.assertEqual(Address.objects.count(), 2)
+
+    def test_backfill_command(self):
+        addresses = [to_python(self.ad)] + [to_python('Place %d' % i) for i in range(5)]
+        Address.objects.update(fingerprint='')
+        out = StringIO()
+        call_command('backfill_address_fingerprints', chunk_size=2, stdout=out)
+        self.assertIn('Updated 6 addresses', out.getvalue())
+        for address in addresses:
+            self.assertEqual(Address.objects.get(pk=address.pk).fingerprint, address.fingerprint)
+
+    def test_backfill_command_duplicates(self):
+        first = to_python(self.ad)
+        locality = first.locality
+        # Saved before fingerprints, so nothing kept them apart.
+        Address.objects.bulk_create([
+            Address(street_number='1', route='Somewhere Street', locality=locality, raw='1 Somewhere St %d' % i)
+            for i in range(3)
+        ] + [Address(raw='Somewhere')])
+        Address.objects.update(fingerprint='')
+        out = StringIO()
+        call_command('backfill_address_fingerprints', chunk_size=2, stdout=out)
+        self.assertIn('Updated 2 addresses', out.getvalue())
+        self.assertIn('Left 3 duplicate addresses without a fingerprint', out.getvalue())
+        self.assertEqual(Address.objects.get(pk=first.pk).fingerprint, first.fingerprint)
+        self.assertEqual(Address.objects.filter(fingerprint='').count(), 3)
+        # Running it again leaves them be.
+        out = StringIO()
+        call_command('backfill_address_fingerprints', stdout=out)
+        self.assertIn('Updated 0 addresses', out.getvalue())
+        self.assertEqual(Address.objects.filter(fingerprint='').count(), 3)
+
+
+class UpsertTestCase(TestCase):
+
+    def setUp(self):
+        self.au = Country.objects.create(name='Australia', code='AU')
+        self.au_vic = State.objects.create(name='Victoria', code='VIC', country=self.au)
+        self.ad = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'country': 'Australia',
+        }
+
+    def test_existing_row(self):
+        # The insert does nothing, and the stored row is fetched.
+        with self.assertNumQueries(2):
+            country = _get_country('Australia', '')
+        self.assertEqual(country, self.au)
+        self.assertEqual(country.code, 'AU')
+
+    def test_new_row_single_statement(self):
+        with self.assertNumQueries(1):
+            locality = _get_locality('Northcote', '3070', self.au_vic)
+        self.assertEqual(locality, Locality.objects.get(name='Northcote'))
+        self.assertIs(locality.state, self.au_vic)
+
+    def test_signals(self):
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append((sender, instance.pk, created))
+
+        signals.post_save.connect(receiver)
+        self.addCleanup(signals.post_save.disconnect, receiver)
+        address = to_python(self.ad)
+        raw = to_python('Somewhere')
+        self.assertEqual(saved, [
+            (Locality, address.locality_id, True),
+            (Address, address.pk, True),
+            (Address, raw.pk, True),
+        ])
+        # Nothing is saved when the rows already exist.
+        to_python(self.ad)
+        to_python('Somewhere')
+        self.assertEqual(len(saved), 3)
+
+    def test_long_code_for_existing_row(self):
+        self.assertEqual(_get_country('Australia', 'Something else'), self.au)
+        self.assertRaises(ValueError, _get_country, 'New Zealand', 'Something else')
+
+    def test_fallback_without_upsert(self):
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            locality = _get_locality('Northcote', '3070', self.au_vic)
+            self.assertEqual(_get_locality('Northcote', '3070', self.au_vic), locality)
+        self.assertEqual(Locality.objects.count(), 1)
+
+    def test_unique_addresses(self):
+        # As the geocoder leaves it; NULLs mustn't let duplicates through.
+        first = to_python(dict(self.ad, subpremise=None))
+        self.assertIsNone(first.subpremise)
+        # Inserted as they are, as a concurrent writer's would be: `save` leaves copies of rows it
+        # can see without a fingerprint.
+        copy = Address(street_number='1', route='Somewhere Street', locality=first.locality, raw='1 Somewhere St')
+        copy.set_fingerprint()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Address.objects.bulk_create([copy])
+        Address.objects.create(raw='Somewhere')
+        copy = Address(raw='somewhere')
+        copy.set_fingerprint()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Address.objects.bulk_create([copy])
+
+    def test_address_saved_concurrently(self):
+        first = to_python(self.ad)
+        # Another writer saves the address between our lookup and insert.
+        with mock.patch('dj_address.models.Address.objects.filter', return_value=Address.objects.none()):
+            second = to_python(dict(self.ad, raw='1 Somewhere St, Northcote'))
+        self.assertEqual(first, second)
+        self.assertEqual(second.raw, self.ad['raw'])
+        self.assertEqual(Address.objects.count(), 1)
+
+    def test_constraint_in_migrations(self):
+        out = StringIO()
+        call_command('makemigrations', 'dj_address', check=True, dry_run=True, stdout=out)
+        self.assertIn('No changes detected', out.getvalue())
+
+
+class WithComponentsTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        localities = [Locality.objects.create(name='Locality %d' % i, postal_code='30%02d' % i, state=vic)
+                      for i in range(5)]
+        for i in range(20):
+            Address.objects.create(street_number=str(i), route='Some Street', locality=localities[i % 5],
+                                   raw='%d Some Street' % i)
+
+    def test_str_and_as_dict_constant_queries(self):
+        with self.assertNumQueries(1):
+            rendered = [(str(a), a.as_dict()) for a in Address.objects.with_components()]
+        self.assertEqual(len(rendered), 20)
+        self.assertEqual(rendered[0][1]['country_code'], 'AU')
+
+    def test_without_components(self):
+        with self.assertNumQueries(1 + 20 * 3):
+            [str(a) for a in Address.objects.all()]
+
+    def test_deconstruct(self):
+        self.assertNotIn('with_components', AddressField().deconstruct()[3])
+        self.assertTrue(AddressField(with_components=True).deconstruct()[3]['with_components'])
+
+
+class SpatialQueryTestCase(TestCase):
+
+    def setUp(self):
+        self.melbourne = Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        self.northcote = Address.objects.create(raw='Northcote', latitude=-37.7697, longitude=144.9971)
+        self.sydney = Address.objects.create(raw='Sydney', latitude=-33.8688, longitude=151.2093)
+        self.fiji = Address.objects.create(raw='Suva', latitude=-18.1416, longitude=178.4419)
+        self.samoa = Address.objects.create(raw='Apia', latitude=-13.8333, longitude=-171.7667)
+        Address.objects.create(raw='Nowhere')
+
+    def test_near(self):
+        res = list(Address.objects.near(-37.8136, 144.9631, 10))
+        self.assertEqual(res, [self.melbourne, self.northcote])
+        self.assertAlmostEqual(res[0].distance, 0)
+        self.assertAlmostEqual(res[1].distance, 5.72, places=2)
+        res = list(Address.objects.near(-37.8136, 144.9631, 750))
+        self.assertEqual(res, [self.melbourne, self.northcote, self.sydney])
+        self.assertAlmostEqual(res[2].distance, 714, delta=1)
+
+    def test_near_antimeridian(self):
+        res = Address.objects.near(-18.1416, 178.4419, 1200)
+        self.assertEqual(list(res), [self.fiji, self.samoa])
+
+    def test_near_pole(self):
+        self.assertEqual(Address.objects.near(-90, 0, 7000).count(), 3)
+
+    def test_within_bbox(self):
+        self.assertEqual(set(Address.objects.within_bbox(-38, 144, -33, 152)),
+                         {self.melbourne, self.northcote, self.sydney})
+        self.assertEqual(set(Address.objects.within_bbox(-20, 178, -10, -170)), {self.fiji, self.samoa})
+
+
+class GeohashQueryTestCase(TestCase):
+
+    def setUp(self):
+        self.melbourne = Address.objects.create(raw='Melbourne', latitude=-37.8136, longitude=144.9631)
+        self.northcote = Address.objects.create(raw='Northcote', latitude=-37.7697, longitude=144.9971)
+        self.sydney = Address.objects.create(raw='Sydney', latitude=-33.8688, longitude=151.2093)
+        self.nowhere = Address.objects.create(raw='Nowhere')
+
+    def test_computed_on_save(self):
+        self.assertEqual(self.melbourne.geohash, 'r1r0fsnzv41c')
+        self.assertEqual(self.nowhere.geohash, '')
+        self.nowhere.latitude, self.nowhere.longitude = -37.8136, 144.9631
+        self.nowhere.save(update_fields=['latitude', 'longitude'])
+        self.assertEqual(Address.objects.get(pk=self.nowhere.pk).geohash, 'r1r0fsnzv41c')
+
+    def test_bulk_resolve(self):
+        res = Address.objects.bulk_resolve([{'raw': 'Somewhere', 'latitude': -37.8136, 'longitude': 144.9631}])
+        self.assertEqual(Address.objects.get(pk=res[0].pk).geohash, 'r1r0fsnzv41c')
+
+    def test_invalid_coordinates(self):
+        address = to_python({'raw': 'Out of range', 'latitude': 123.0, 'longitude': 10.0})
+        self.assertEqual(Address.objects.get(pk=address.pk).latitude, 123.0)
+        self.assertEqual(address.geohash, '')
+        res = Address.objects.bulk_resolve([{'raw': 'Also out of range', 'latitude': 10.0, 'longitude': 200.0}])
+        self.assertEqual(Address.objects.get(pk=res[0].pk).geohash, '')
+        self.nowhere.latitude, self.nowhere.longitude = -91.0, 0.0
+        self.nowhere.save()
+        self.assertEqual(Address.objects.get(pk=self.nowhere.pk).geohash, '')
+
+    def test_in_geohash(self):
+        self.assertEqual(set(Address.objects.in_geohash('r1r')), {self.melbourne, self.northcote})
+        self.assertEqual(list(Address.objects.in_geohash('R1R0')), [self.melbourne])
+        self.assertEqual(list(Address.objects.in_geohash('r3gx2')), [self.sydney])
+        self.assertEqual(Address.objects.in_geohash('').count(), 3)
+        self.assertRaises(ValueError, Address.objects.in_geohash, 'r1a')
+
+    def test_count_by_geohash(self):
+        self.assertEqual(list(Address.objects.count_by_geohash(3)),
+                         [{'cell': 'r1r', 'count': 2}, {'cell': 'r3g', 'count': 1}])
+        self.assertEqual(list(Address.objects.filter(raw='Sydney').count_by_geohash(1)),
+                         [{'cell': 'r', 'count': 1}])
+
+    def test_backfill_command(self):
+        Address.objects.update(geohash='')
+        out = StringIO()
+        call_command('backfill_address_geohashes', chunk_size=1, stdout=out)
+        self.assertIn('Updated 3 addresses', out.getvalue())
+        self.assertEqual(Address.objects.get(pk=self.melbourne.pk).geohash, 'r1r0fsnzv41c')
@@ -0,0 +1,54 @@
+from django.test import SimpleTestCase, override_settings
+
+from dj_address.cache import geocode_cache
+from dj_address.geocoders import GoogleGeocoder
+from dj_address.sessions import get_session, get_timeout, reset_session
+from dj_address.testing import StubGeocodeServer
+
+from .test_cache import google_result
+
+
+@override_settings(DJ_ADDRESS_GEOCODE_BACKOFF_FACTOR=0, DJ_ADDRESS_GEOCODE_CACHE_ALIAS=None)
+class SessionTestCase(SimpleTestCase):
+    raw = '10897 South River Front Parkway #200, South Jordan, UT'
+
+    def setUp(self):
+        reset_session()
+        geocode_cache.clear()
+
+    def tearDown(self):
+        reset_session()
+        geocode_cache.clear()
+
+    def test_shared(self):
+        self.assertIs(get_session(), get_session())
+
+    def test_reset(self):
+        session = get_session()
+        reset_session()
+        self.assertIsNot(session, get_session())
+
+    @override_settings(DJ_ADDRESS_GEOCODE_CONNECT_TIMEOUT=1, DJ_ADDRESS_GEOCODE_READ_TIMEOUT=2)
+    def test_timeout(self):
+        self.assertEqual(get_timeout(), (1, 2))
+
+    def test_retries_server_errors(self):
+        payload = {'results': [google_result()], 'status': 'OK'}
+        with StubGeocodeServer({self.raw: payload}, statuses=[503, 429]) as server:
+            response = get_session().get(server.url, params={'address': self.raw}, timeout=get_timeout())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 3)
+
+    @override_settings(DJ_ADDRESS_GEOCODE_RETRIES=1)
+    def test_gives_up(self):
+        with StubGeocodeServer(statuses=[503, 503, 503]) as server:
+            response = get_session().get(server.url, timeout=get_timeout())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_geocode_against_stub(self):
+        payload = {'results': [google_result()], 'status': 'OK'}
+        with StubGeocodeServer({self.raw: payload}) as server:
+            value = GoogleGeocoder(url=server.url).geocode(self.raw)
+        self.assertEqual(value['subpremise'], '200')
+        self.assertEqual(value['locality'], 'South Jordan')
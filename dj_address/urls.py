@@ -0,0 +1,10 @@
+from django.urls import path
+
+from . import views
+
+
+app_name = 'dj_address'
+
+urlpatterns = [
+    path('autocomplete/', views.autocomplete, name='autocomplete'),
+]
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+
+from .autocomplete import search
+
+
+@require_GET
+def autocomplete(request):
+    """Return stored addresses and localities matching the `q` parameter, as JSON.
+
+    Queries shorter than `DJ_ADDRESS_AUTOCOMPLETE_MIN_LENGTH` characters return no results, and at
+    most `DJ_ADDRESS_AUTOCOMPLETE_LIMIT` are returned, or fewer if `limit` asks for them.
+    """
+    query = request.GET.get('q', '').strip()
+    max_limit = getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_LIMIT', 10)
+    try:
+        limit = min(int(request.GET.get('limit', max_limit)), max_limit)
+    except ValueError:
+        limit = max_limit
+    if len(query) < getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_MIN_LENGTH', 3) or limit < 1:
+        return JsonResponse({'results': []})
+    return JsonResponse({'results': search(query, limit)})
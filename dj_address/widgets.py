@@ -1,7 +1,9 @@
+from functools import lru_cache
+
 import django
 from django import forms
 from django.conf import settings
-from django.utils.safestring import mark_safe
+from django.utils.html import format_html
 
 from .models import Address
 
@@ -10,6 +12,16 @@ USE_DJANGO_JQUERY = getattr(settings, 'USE_DJANGO_JQUERY', False)
 JQUERY_URL = getattr(settings, 'JQUERY_URL', 'https://ajax.googleapis.com/ajax/libs/jquery/2.2.0/jquery.min.js')
 
 
+@lru_cache(maxsize=None)
+def _components_template(components):
+    """Build, once per list of components, the `format_html` template of the hidden inputs."""
+    elems = ['<div id="{name}_components">']
+    for com in components:
+        elems.append('<input type="hidden" name="{name}_%s" data-geo="%s" value="{%s}" />' % (com[0], com[1], com[0]))
+    elems.append('</div>')
+    return '\n'.join(elems)
+
+
 class AddressWidget(forms.TextInput):
     components = [('country', 'country'), ('country_code', 'country_short'),
                   ('locality', 'locality'), ('sublocality', 'sublocality'),
@@ -45,7 +57,10 @@ class AddressWidget(forms.TextInput):
 
             js.extend(jquery_paths)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, autocomplete_url=None, **kwargs):
+        # The URL of the autocomplete view (see dj_address.urls) to search stored addresses before
+        # Google, or None for DJ_ADDRESS_AUTOCOMPLETE_URL; if neither is set, only Google is used.
+        self.autocomplete_url = autocomplete_url
         attrs = kwargs.get('attrs', {})
         classes = attrs.get('class', '')
         classes += (' ' if classes else '') + 'address'
@@ -54,32 +69,34 @@ class AddressWidget(forms.TextInput):
         super(AddressWidget, self).__init__(*args, **kwargs)
 
     def render(self, name, value, attrs=None, **kwargs):
-        # Can accept None, a dictionary of values or an Address object.
+        # Can accept None, a dictionary of values, an Address object, or its pk. Forms of an
+        # AddressField pass the Address itself, with its components if they were selected, so
+        # rendering needs no queries; see `prefetch_addresses` for formsets with initial pks.
         if value in (None, ''):
             ad = {}
         elif isinstance(value, dict):
             ad = value
-        elif isinstance(value, int):
-            ad = Address.objects.get(pk=value)
-            ad = ad.as_dict()
-        else:
+        elif isinstance(value, Address):
             ad = value.as_dict()
+        else:
+            ad = Address.objects.with_components().get(pk=value).as_dict()
 
         # Add a visible field for the raw input, and a suite of hidden fields
         # for each individual component.
         # TODO: we could add a button that, on clicking, submits a request to the Google Geocode API
         #       since the Autocomplete API doesn't handle subpremise, but for now I'll handle it
         #       elsewhere.
-        elems = [
-            super(AddressWidget, self).render(name, ad.get('formatted', None), attrs, **kwargs)
-        ]
-        elems.append('<div id="%s_components">' % name)
-        for com in self.components:
-            elems.append('<input type="hidden" name="%s_%s" data-geo="%s" value="%s" />' % (
-                name, com[0], com[1], ad.get(com[0], ''))
-            )
-        elems.append('</div>')
-        return mark_safe('\n'.join(elems))
+        autocomplete_url = self.autocomplete_url or getattr(settings, 'DJ_ADDRESS_AUTOCOMPLETE_URL', None)
+        if autocomplete_url:
+            attrs = dict(attrs or {}, **{'data-autocomplete-url': str(autocomplete_url)})
+        # format_html escapes every value.
+        values = {com[0]: '' if ad.get(com[0]) is None else ad[com[0]] for com in self.components}
+        return format_html(
+            '{}\n' + _components_template(tuple(self.components)),
+            super(AddressWidget, self).render(name, ad.get('formatted', None), attrs, **kwargs),
+            name=name,
+            **values
+        )
 
     def value_from_datadict(self, data, files, name):
         raw = data.get(name, '')
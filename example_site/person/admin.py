@@ -11,6 +11,7 @@ class PersonAdmin(admin.ModelAdmin):
         'id',
         'address',
     )
+    list_select_related = ('address__locality__state__country',)
 
     formfield_overrides = {
         AddressField: {
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:18
+
+import dj_address.models
+import django.db.models.deletion
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dj_address', '0003_auto_20190222_2348'),
+        ('person', '0002_auto_20190222_2348'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='person',
+            name='address',
+            field=dj_address.models.AddressField(on_delete=django.db.models.deletion.PROTECT, to='dj_address.address', with_components=True),
+        ),
+    ]
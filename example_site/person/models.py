@@ -1,14 +1,17 @@
 from django.db import models
-from dj_address.models import AddressField
+from dj_address.models import AddressField, BulkAddressQuerySet
 
 
 class Person(models.Model):
     """Model definition for Person."""
 
     address = AddressField(
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        with_components=True,
     )
 
+    objects = BulkAddressQuerySet.as_manager()
+
     class Meta:
         """Meta definition for Person."""
 
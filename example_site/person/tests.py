@@ -1,3 +1,134 @@
+from unittest import mock
+
+from django.db import transaction
+from django.forms import modelformset_factory
 from django.test import TestCase
 
-# Create your tests here.
+from dj_address.dedupe import merge
+from dj_address.forms import prefetch_addresses
+from dj_address.models import Address, Country, Locality, State
+
+from .models import Person
+
+
+class PersonAddressTestCase(TestCase):
+
+    def setUp(self):
+        au = Country.objects.create(name='Australia', code='AU')
+        vic = State.objects.create(name='Victoria', code='VIC', country=au)
+        for i in range(10):
+            locality = Locality.objects.create(name='Locality %d' % i, state=vic)
+            address = Address.objects.create(street_number=str(i), route='Some Street', locality=locality,
+                                             raw='%d Some Street' % i)
+            Person.objects.create(address=address)
+
+    def test_list_renders_in_constant_queries(self):
+        with self.assertNumQueries(2):
+            rendered = [str(p.address) for p in Person.objects.prefetch_related('address')]
+        self.assertEqual(rendered[0], '0 Some Street, Locality 0, Victoria, Australia')
+
+    def test_single_address_in_one_query(self):
+        person = Person.objects.first()
+        with self.assertNumQueries(1):
+            str(person.address)
+
+    def test_formset_renders_in_constant_queries(self):
+        PersonFormSet = modelformset_factory(Person, fields=['address'], extra=0)
+        formset = PersonFormSet(queryset=Person.objects.order_by('pk'))
+        with self.assertNumQueries(2):
+            prefetch_addresses(formset)
+            html = formset.as_p()
+        self.assertIn('value="Locality 9"', html)
+        # Addresses already loaded with the instances are used as they are.
+        people = Person.objects.order_by('pk').select_related('address__locality__state__country')
+        formset = PersonFormSet(queryset=people)
+        with self.assertNumQueries(1):
+            prefetch_addresses(formset)
+            formset.as_p()
+
+    def test_merge_repoints_address_fields(self):
+        keep, merged = Address.objects.order_by('pk')[:2]
+        merged_person = Person.objects.get(address=merged)
+        stats = merge(Address, [[keep.pk, merged.pk]])
+        self.assertEqual(stats['references']['person.person.address'], 1)
+        merged_person.refresh_from_db()
+        self.assertEqual(merged_person.address, keep)
+        self.assertEqual(Person.objects.count(), 10)
+
+
+class LazyAddressTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(Person._meta.get_field('address'), 'lazy', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ad = {
+            'raw': '1 Somewhere Street, Northcote, Victoria 3070, VIC, AU',
+            'street_number': '1',
+            'route': 'Somewhere Street',
+            'locality': 'Northcote',
+            'postal_code': '3070',
+            'state': 'Victoria',
+            'state_code': 'VIC',
+            'country': 'Australia',
+            'country_code': 'AU',
+        }
+
+    def test_assignment_is_deferred(self):
+        with self.assertNumQueries(0):
+            people = [Person(address=self.ad) for _ in range(100)]
+            people[0].full_clean()
+        self.assertEqual(Address.objects.count(), 0)
+        people[0].save()
+        self.assertEqual(people[0].address.locality.name, 'Northcote')
+        self.assertEqual(Person.objects.get().address_id, people[0].address_id)
+
+    def test_read_resolves(self):
+        person = Person()
+        person.address = 'Somewhere'
+        self.assertIsNone(person.address_id)
+        self.assertEqual(person.address.raw, 'Somewhere')
+        self.assertIsNotNone(person.address_id)
+
+    def test_reassignment_replaces_pending(self):
+        address = Address.objects.create(raw='Elsewhere')
+        person = Person(address='Somewhere')
+        person.address = address
+        person.save()
+        self.assertEqual(Address.objects.get(), address)
+
+    def test_rollback_leaves_no_address(self):
+        person = Person(address=self.ad)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                person.save()
+                raise ValueError
+        self.assertEqual(Address.objects.count(), 0)
+
+    def test_bulk_create(self):
+        existing = Address.objects.create(raw='Elsewhere')
+
+        def create(n):
+            people = [Person(address=dict(self.ad, street_number=str(i))) for i in range(n)]
+            people.append(Person(address='Somewhere'))
+            people.append(Person(address=existing))
+            return Person.objects.bulk_create(people)
+
+        # The same queries whatever the number of objects.
+        with self.assertNumQueries(17):
+            create(5)
+        Person.objects.all().delete()
+        Address.objects.exclude(pk=existing.pk).delete()
+        Country.objects.all().delete()
+        with self.assertNumQueries(17):
+            people = create(50)
+        self.assertEqual(people[49].address.street_number, '49')
+        self.assertEqual(Person.objects.filter(address__raw='Somewhere').count(), 1)
+        self.assertEqual(Person.objects.filter(address=existing).count(), 1)
+
+    def test_bulk_update(self):
+        people = Person.objects.bulk_create([Person(address='Somewhere') for _ in range(3)])
+        for i, person in enumerate(people):
+            person.address = 'Place %d' % i
+        Person.objects.bulk_update(people, ['address'])
+        self.assertEqual(sorted(p.address.raw for p in Person.objects.all()), ['Place 0', 'Place 1', 'Place 2'])
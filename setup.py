@@ -39,6 +39,7 @@ setup(
     include_package_data=True,
     package_data={'': ['*.txt', '*.js', '*.html', '*.*']},
     install_requires=['setuptools'],
+    extras_require={'parquet': ['pyarrow']},
     zip_safe=False,
 
 )